@@ -167,6 +167,48 @@ carbon_port = 2003
 # --server option on dedicated secure build server hosts.
 build_server_always = False
 
+# The CPUs and memory (in MiB) that each build gets when running several of
+# them at once with 'fdroid build --jobs'. The number of builds running at
+# the same time is cut down to what the machine can fit, the memory is used
+# as the maximum Java heap size of gradle, maven and ant, and the CPUs as the
+# number of parallel jobs for ndk-build. Setting build_job_memory to 0 leaves
+# the heap size alone.
+# build_job_cpus = 1
+# build_job_memory = 2048
+
+# Builds that failed are not tried again with the same recipe, srclibs and
+# tools for this many seconds, unless --retry-failed is given. After that
+# they are retried, as the failure may have been down to something like the
+# network.
+# build_failure_ttl = 604800
+
+# When checking apps for updates with 'fdroid checkupdates --jobs', how many
+# checks can talk to the same host at once, and the minimum time in seconds
+# between the start of two of them.
+# checkupdates_host_jobs = 2
+# checkupdates_host_delay = 1
+
+# How often 'fdroid checkupdates --gplay' queries the Play Store: one request
+# every gplay_interval seconds on average, with bursts of up to gplay_burst
+# requests. With --jobs, that many requests can be waiting for a reply at
+# once. The results are kept for gplay_cache_ttl seconds, so runs within
+# that time don't query the same apps again.
+# gplay_interval = 2
+# gplay_burst = 10
+# gplay_cache_ttl = 86400
+
+# With 'fdroid checkupdates --scheduled', apps are only checked once they are
+# due. An app is due once checkupdates_backoff times the time it had gone
+# without a new version has passed since its last check, but never more
+# often than every checkupdates_min_interval days, and at least every
+# checkupdates_max_interval days. checkupdates_time_budget limits how long
+# in seconds a run should take, based on how long the checks took last time.
+# Set it to 0 to check all the apps that are due.
+# checkupdates_backoff = 0.25
+# checkupdates_min_interval = 1
+# checkupdates_max_interval = 30
+# checkupdates_time_budget = 3600
+
 # Limit in number of characters that fields can take up
 # Only the fields listed here are supported, defaults shown
 char_limits = {
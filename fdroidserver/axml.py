@@ -0,0 +1,834 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+#
+# axml.py - part of the FDroid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Reads the binary AndroidManifest.xml and resources.arsc out of an apk, so
+# that the information 'aapt dump badging' gives us can be had without
+# running aapt (twice) for every apk. The signing certificate is read from
+# the signature block directly too, instead of starting getsig in a JVM.
+
+import base64
+import hashlib
+import re
+import struct
+import zipfile
+import zlib
+
+# Chunk types, see ResourceTypes.h in the Android framework
+RES_STRING_POOL_TYPE = 0x0001
+RES_TABLE_TYPE = 0x0002
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+RES_TABLE_PACKAGE_TYPE = 0x0200
+RES_TABLE_TYPE_TYPE = 0x0201
+
+UTF8_FLAG = 1 << 8
+NO_ENTRY = 0xFFFFFFFF
+FLAG_COMPLEX = 0x0001
+
+# Value types
+TYPE_REFERENCE = 0x01
+TYPE_STRING = 0x03
+TYPE_FIRST_INT = 0x10
+TYPE_LAST_INT = 0x1f
+
+# Framework attribute ids
+ATTR_LABEL = 0x01010001
+ATTR_ICON = 0x01010002
+ATTR_NAME = 0x01010003
+ATTR_DEBUGGABLE = 0x0101000f
+ATTR_MIN_SDK_VERSION = 0x0101020c
+ATTR_VERSION_CODE = 0x0101021b
+ATTR_VERSION_NAME = 0x0101021c
+ATTR_TARGET_SDK_VERSION = 0x01010270
+ATTR_MAX_SDK_VERSION = 0x01010271
+ATTR_REQUIRED = 0x0101028e
+
+DENSITY_DEFAULT = 0
+DENSITY_MEDIUM = 160
+DENSITY_ANY = 0xfffe
+
+SIGNATURE_BLOCK = re.compile(r'^META-INF/[^/]*\.(RSA|DSA|EC)$')
+
+# Object identifiers for the JAR signatures that are verified here, DER
+# encoded without the tag and length
+OID_RSA = '2a864886f70d010101'.decode('hex')
+OID_RSA_SIGNATURES = set(x.decode('hex') for x in [
+    '2a864886f70d010105',     # sha1WithRSAEncryption
+    '2a864886f70d01010b',     # sha256WithRSAEncryption
+    '2a864886f70d01010c',     # sha384WithRSAEncryption
+    '2a864886f70d01010d',     # sha512WithRSAEncryption
+    ])
+DIGEST_OIDS = dict((x.decode('hex'), h) for x, h in [
+    ('2b0e03021a', 'sha1'),
+    ('608648016503040201', 'sha256'),
+    ('608648016503040202', 'sha384'),
+    ('608648016503040203', 'sha512'),
+    ])
+# As named in MANIFEST.MF and the .SF file
+DIGEST_NAMES = [
+    ('SHA1', 'sha1'),
+    ('SHA-256', 'sha256'),
+    ('SHA-384', 'sha384'),
+    ('SHA-512', 'sha512'),
+    ]
+
+PERM = 'android.permission.'
+FEAT = 'android.hardware.'
+
+
+class AXMLException(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+def _header(data, offset):
+    """Returns (type, header size, chunk size) of the chunk at offset"""
+    if offset + 8 > len(data):
+        raise AXMLException("Truncated chunk at offset %d" % offset)
+    return struct.unpack_from('<HHI', data, offset)
+
+
+def _string_pool(data, offset):
+    """Decodes the string pool chunk at offset into a list of utf-8 strings"""
+    ctype, hsize, size = _header(data, offset)
+    if ctype != RES_STRING_POOL_TYPE:
+        raise AXMLException("Expected a string pool at offset %d" % offset)
+    count, _, flags, strings_start, _ = struct.unpack_from('<IIIII', data, offset + 8)
+    utf8 = flags & UTF8_FLAG
+    offsets = struct.unpack_from('<%dI' % count, data, offset + hsize)
+    base = offset + strings_start
+    strings = []
+    for o in offsets:
+        pos = base + o
+        if utf8:
+            # Length in characters, then in bytes, each one or two bytes
+            n = ord(data[pos])
+            pos += 2 if n & 0x80 else 1
+            n = ord(data[pos])
+            if n & 0x80:
+                n = ((n & 0x7f) << 8) | ord(data[pos + 1])
+                pos += 2
+            else:
+                pos += 1
+            s = data[pos:pos + n].decode('utf-8', 'replace')
+        else:
+            n = struct.unpack_from('<H', data, pos)[0]
+            if n & 0x8000:
+                n = ((n & 0x7fff) << 16) | struct.unpack_from('<H', data, pos + 2)[0]
+                pos += 4
+            else:
+                pos += 2
+            s = data[pos:pos + n * 2].decode('utf-16le', 'replace')
+        strings.append(s.encode('utf-8'))
+    return strings
+
+
+def parse_xml(data):
+    """Decodes a binary xml file.
+
+    :returns: a list of (depth, tag, attrs) for all start tags in document
+              order, where attrs maps the framework attribute id (or the
+              plain name for attributes without one) to (type, data, string).
+    """
+    ctype, hsize, size = _header(data, 0)
+    if ctype != RES_XML_TYPE:
+        raise AXMLException("Not a binary xml file")
+    strings = []
+    resmap = []
+    elements = []
+    depth = 0
+    offset = hsize
+    while offset < min(size, len(data)):
+        ctype, chsize, csize = _header(data, offset)
+        if csize < 8:
+            raise AXMLException("Invalid chunk size at offset %d" % offset)
+        if ctype == RES_STRING_POOL_TYPE:
+            strings = _string_pool(data, offset)
+        elif ctype == RES_XML_RESOURCE_MAP_TYPE:
+            n = (csize - chsize) / 4
+            resmap = struct.unpack_from('<%dI' % n, data, offset + chsize)
+        elif ctype == RES_XML_START_ELEMENT_TYPE:
+            ext = offset + chsize
+            _, name, astart, asize, acount = struct.unpack_from('<IIHHH', data, ext)
+            attrs = {}
+            for i in range(acount):
+                a = ext + astart + i * asize
+                _, aname, raw, _, _, vtype, vdata = struct.unpack_from('<IIIHBBI', data, a)
+                if aname < len(resmap) and resmap[aname]:
+                    key = resmap[aname]
+                else:
+                    key = strings[aname]
+                if raw != NO_ENTRY:
+                    string = strings[raw]
+                elif vtype == TYPE_STRING:
+                    string = strings[vdata]
+                else:
+                    string = None
+                attrs[key] = (vtype, vdata, string)
+            elements.append((depth, strings[name], attrs))
+            depth += 1
+        elif ctype == RES_XML_END_ELEMENT_TYPE:
+            depth -= 1
+        offset += csize
+    return elements
+
+
+class ResourceTable():
+    """The parts of resources.arsc needed to resolve references"""
+
+    def __init__(self, data):
+        # resid -> list of (config, vtype, vdata)
+        self.entries = {}
+        self.densities = set()
+        self.strings = []
+
+        ctype, hsize, size = _header(data, 0)
+        if ctype != RES_TABLE_TYPE:
+            raise AXMLException("Not a resource table")
+        offset = hsize
+        while offset < min(size, len(data)):
+            ctype, chsize, csize = _header(data, offset)
+            if csize < 8:
+                raise AXMLException("Invalid chunk size at offset %d" % offset)
+            if ctype == RES_STRING_POOL_TYPE:
+                self.strings = _string_pool(data, offset)
+            elif ctype == RES_TABLE_PACKAGE_TYPE:
+                self._package(data, offset, chsize, csize)
+            offset += csize
+
+    def _package(self, data, start, hsize, size):
+        pkgid = struct.unpack_from('<I', data, start + 8)[0]
+        offset = start + hsize
+        while offset < start + size:
+            ctype, chsize, csize = _header(data, offset)
+            if csize < 8:
+                raise AXMLException("Invalid chunk size at offset %d" % offset)
+            if ctype == RES_TABLE_TYPE_TYPE:
+                self._type(data, offset, chsize, pkgid)
+            offset += csize
+
+    def _type(self, data, start, hsize, pkgid):
+        typeid, _, _, count, entries_start = struct.unpack_from('<BBHII', data, start + 8)
+        config = data[start + 20:start + hsize]
+        density = 0
+        if len(config) >= 16:
+            density = struct.unpack_from('<H', config, 14)[0]
+        self.densities.add(density)
+        offsets = struct.unpack_from('<%dI' % count, data, start + hsize)
+        for i, o in enumerate(offsets):
+            if o == NO_ENTRY:
+                continue
+            pos = start + entries_start + o
+            _, flags = struct.unpack_from('<HH', data, pos)
+            if flags & FLAG_COMPLEX:
+                continue
+            _, _, vtype, vdata = struct.unpack_from('<HBBI', data, pos + 8)
+            resid = (pkgid << 24) | (typeid << 16) | i
+            self.entries.setdefault(resid, []).append((config, vtype, vdata))
+
+    def resolve(self, vtype, vdata, density=DENSITY_DEFAULT):
+        """Follows references, choosing among the configurations the way aapt
+        does for a device without a locale at the given density.
+
+        :returns: (type, data, string) of the final value
+        """
+        seen = set()
+        while vtype == TYPE_REFERENCE and vdata not in seen:
+            seen.add(vdata)
+            best = None
+            for candidate in self.entries.get(vdata, []):
+                if not _config_matches(candidate[0]):
+                    continue
+                if best is None or _config_better(candidate[0], best[0], density):
+                    best = candidate
+            if best is None:
+                break
+            _, vtype, vdata = best
+        string = None
+        if vtype == TYPE_STRING and vdata < len(self.strings):
+            string = self.strings[vdata]
+        return (vtype, vdata, string)
+
+
+def _config_matches(config):
+    """Only the default locale and no mcc/mnc qualifiers, like aapt"""
+    return config[4:12].strip('\0') == ''
+
+
+def _config_density(config):
+    if len(config) < 16:
+        return DENSITY_DEFAULT
+    return struct.unpack_from('<H', config, 14)[0]
+
+
+def _specificity(config):
+    """Number of qualifiers set other than the density and the sdk version"""
+    rest = config[4:14] + config[16:24] + config[28:]
+    return len(rest) - rest.count('\0')
+
+
+def _config_better(this, other, requested):
+    """Port of ResTable_config::isBetterThan, restricted to density"""
+    d1 = _config_density(this)
+    d2 = _config_density(other)
+    if d1 == d2:
+        return _specificity(this) < _specificity(other)
+    if d1 == DENSITY_ANY:
+        return True
+    if d2 == DENSITY_ANY:
+        return False
+    h = d1 or DENSITY_MEDIUM
+    l = d2 or DENSITY_MEDIUM
+    if requested in (DENSITY_DEFAULT, DENSITY_ANY):
+        requested = DENSITY_MEDIUM
+    bigger = True
+    if l > h:
+        h, l = l, h
+        bigger = False
+    if requested >= h:
+        return bigger
+    if l >= requested:
+        return not bigger
+    # Scaling down is considered twice as good as scaling up
+    if ((2 * l) - requested) * h > requested * requested:
+        return not bigger
+    return bigger
+
+
+def _int(value):
+    vtype, vdata, string = value
+    if TYPE_FIRST_INT <= vtype <= TYPE_LAST_INT:
+        return vdata
+    if string is not None:
+        try:
+            return int(string)
+        except ValueError:
+            pass
+    return None
+
+
+def get_apk_info(apkfile):
+    """Gets the same information out of an apk as 'aapt dump badging'
+
+    :param apkfile: path to the apk file
+    :returns: a dict with id, versioncode, version, name, icons_src,
+              sdkversion, targetsdkversion, maxsdkversion, permissions,
+              features, nativecode and debuggable. Values that the apk
+              doesn't set are left out, or empty for the lists.
+    :raises AXMLException: if the apk, its manifest or its resources can't
+              be read, whatever the reason.
+    """
+    try:
+        return _read_apk_info(apkfile)
+    except AXMLException, e:
+        if apkfile in e.value:
+            raise
+        raise AXMLException("Could not read %s: %s" % (apkfile, e))
+    except (IOError, zipfile.BadZipfile, zlib.error, struct.error,
+            IndexError, KeyError, ValueError, UnicodeDecodeError), e:
+        # A damaged apk only fails itself, like it did with aapt
+        raise AXMLException("Could not read %s: %s: %s"
+                            % (apkfile, e.__class__.__name__, e))
+
+
+def _read_apk_info(apkfile):
+    apk = zipfile.ZipFile(apkfile, 'r')
+    try:
+        try:
+            manifest = apk.read('AndroidManifest.xml')
+        except KeyError:
+            raise AXMLException("No AndroidManifest.xml in " + apkfile)
+        try:
+            resources = ResourceTable(apk.read('resources.arsc'))
+        except KeyError:
+            resources = None
+        names = apk.namelist()
+    finally:
+        apk.close()
+
+    elements = parse_xml(manifest)
+
+    def value(attrs, key, density=DENSITY_DEFAULT):
+        if key not in attrs:
+            return None
+        vtype, vdata, _ = attrs[key]
+        if resources is None or vtype != TYPE_REFERENCE:
+            return attrs[key]
+        return resources.resolve(vtype, vdata, density)
+
+    def string(attrs, key):
+        v = value(attrs, key)
+        if v is None or v[2] is None:
+            return None
+        return v[2]
+
+    info = {
+        'permissions': [],
+        'features': [],
+        'icons_src': {},
+        'nativecode': [],
+        'debuggable': False,
+        }
+    declared = set()
+    application = None
+    launchable = None
+    activity = None
+    in_filter = False
+    is_main = is_launcher = False
+
+    for depth, tag, attrs in elements:
+        if depth == 0:
+            if tag != 'manifest':
+                raise AXMLException("Root element is not <manifest> in " + apkfile)
+            if 'package' in attrs:
+                info['id'] = attrs['package'][2]
+            code = _int(value(attrs, ATTR_VERSION_CODE) or (0, 0, None))
+            if code is not None:
+                info['versioncode'] = code
+            info['version'] = string(attrs, ATTR_VERSION_NAME) or ''
+            continue
+        if depth == 1:
+            activity = None
+            if tag == 'application':
+                application = attrs
+                debuggable = value(attrs, ATTR_DEBUGGABLE)
+                info['debuggable'] = bool(debuggable and debuggable[1])
+            elif tag == 'uses-sdk':
+                for key, field in [(ATTR_MIN_SDK_VERSION, 'sdkversion'),
+                                   (ATTR_TARGET_SDK_VERSION, 'targetsdkversion'),
+                                   (ATTR_MAX_SDK_VERSION, 'maxsdkversion')]:
+                    v = value(attrs, key)
+                    if v is None:
+                        continue
+                    n = _int(v)
+                    info[field] = str(n) if n is not None else v[2]
+            elif tag == 'uses-permission':
+                name = string(attrs, ATTR_NAME)
+                if name and name not in info['permissions']:
+                    info['permissions'].append(name)
+            elif tag == 'uses-feature':
+                name = string(attrs, ATTR_NAME)
+                if name:
+                    declared.add(name)
+                    required = value(attrs, ATTR_REQUIRED)
+                    if (required is None or required[1]) and name not in info['features']:
+                        info['features'].append(name)
+        elif depth == 2 and application is not None:
+            activity = None
+            if tag in ('activity', 'activity-alias'):
+                activity = attrs
+            in_filter = False
+        elif depth == 3 and activity is not None:
+            in_filter = tag == 'intent-filter'
+            is_main = is_launcher = False
+        elif depth == 4 and activity is not None and in_filter:
+            name = string(attrs, ATTR_NAME)
+            if tag == 'action' and name == 'android.intent.action.MAIN':
+                is_main = True
+            elif tag == 'category' and name == 'android.intent.category.LAUNCHER':
+                is_launcher = True
+            if is_main and is_launcher and launchable is None:
+                launchable = activity
+
+    if 'targetsdkversion' not in info and 'sdkversion' in info:
+        info['targetsdkversion'] = info['sdkversion']
+    try:
+        target = int(info.get('targetsdkversion', 0))
+    except ValueError:
+        # A codename for an sdk that isn't released yet
+        target = 10000
+
+    _add_implied_permissions(info['permissions'], target)
+    _add_implied_features(info['features'], declared, info['permissions'], target)
+
+    # Label and icon, falling back to the launchable activity
+    info['name'] = ''
+    for attrs in [application, launchable]:
+        if attrs is None:
+            continue
+        label = string(attrs, ATTR_LABEL)
+        if label:
+            info['name'] = label
+            break
+    for attrs in [application, launchable]:
+        if attrs is None or ATTR_ICON not in attrs:
+            continue
+        icon = string(attrs, ATTR_ICON)
+        if icon:
+            info['icons_src']['-1'] = icon
+        if resources is not None:
+            for density in sorted(resources.densities):
+                v = value(attrs, ATTR_ICON, density)
+                if v[2]:
+                    info['icons_src'][str(density or DENSITY_MEDIUM)] = v[2]
+        break
+
+    abis = set()
+    for name in names:
+        parts = name.split('/')
+        if len(parts) == 3 and parts[0] == 'lib' and parts[1] and parts[2]:
+            abis.add(parts[1])
+    info['nativecode'] = sorted(abis)
+
+    return info
+
+
+def _add_implied_permissions(permissions, target):
+    """Permissions that the system grants implicitly, as listed by aapt"""
+
+    def add(perm):
+        if PERM + perm not in permissions:
+            permissions.append(PERM + perm)
+
+    if target < 4:
+        add('WRITE_EXTERNAL_STORAGE')
+        add('READ_PHONE_STATE')
+    if PERM + 'WRITE_EXTERNAL_STORAGE' in permissions:
+        add('READ_EXTERNAL_STORAGE')
+    if target < 16:
+        if PERM + 'READ_CONTACTS' in permissions:
+            add('READ_CALL_LOG')
+        if PERM + 'WRITE_CONTACTS' in permissions:
+            add('WRITE_CALL_LOG')
+
+
+def _add_implied_features(features, declared, permissions, target):
+    """Features implied by the permissions, as listed by aapt"""
+
+    def add(feature):
+        if FEAT + feature not in declared and FEAT + feature not in features:
+            features.append(FEAT + feature)
+
+    def has(*perms):
+        for perm in perms:
+            if PERM + perm in permissions:
+                return True
+        return False
+
+    if has('CAMERA'):
+        add('camera')
+        add('camera.autofocus')
+    if has('ACCESS_FINE_LOCATION'):
+        add('location.gps')
+    if has('ACCESS_COARSE_LOCATION', 'ACCESS_MOCK_LOCATION'):
+        add('location.network')
+    if has('ACCESS_FINE_LOCATION', 'ACCESS_COARSE_LOCATION',
+           'ACCESS_MOCK_LOCATION', 'ACCESS_LOCATION_EXTRA_COMMANDS',
+           'INSTALL_LOCATION_PROVIDER'):
+        add('location')
+    if has('BLUETOOTH', 'BLUETOOTH_ADMIN') and target > 4:
+        add('bluetooth')
+    if has('RECORD_AUDIO'):
+        add('microphone')
+    if has('ACCESS_WIFI_STATE', 'CHANGE_WIFI_STATE',
+           'CHANGE_WIFI_MULTICAST_STATE'):
+        add('wifi')
+    if has('CALL_PHONE', 'CALL_PRIVILEGED', 'MODIFY_PHONE_STATE',
+           'PROCESS_OUTGOING_CALLS', 'READ_SMS', 'RECEIVE_SMS',
+           'RECEIVE_MMS', 'RECEIVE_WAP_PUSH', 'SEND_SMS',
+           'WRITE_APN_SETTINGS', 'WRITE_SMS'):
+        add('telephony')
+    if FEAT + 'touchscreen.multitouch.distinct' in features \
+            or FEAT + 'touchscreen.multitouch.jazzhand' in features:
+        add('touchscreen.multitouch')
+    add('touchscreen')
+
+
+def _der(data, pos, end):
+    """Returns (tag, content start, content end) of the DER element at pos"""
+    if pos + 2 > end:
+        raise AXMLException("Truncated DER element")
+    tag = ord(data[pos])
+    length = ord(data[pos + 1])
+    pos += 2
+    if length & 0x80:
+        n = length & 0x7f
+        if n == 0 or n > 4 or pos + n > end:
+            raise AXMLException("Unsupported DER length")
+        length = int(data[pos:pos + n].encode('hex'), 16)
+        pos += n
+    if pos + length > end:
+        raise AXMLException("Truncated DER element")
+    return tag, pos, pos + length
+
+
+def _der_children(data, start, end):
+    """Yields (tag, element start, content start, content end) of the DER
+    elements between start and end"""
+    pos = start
+    while pos < end:
+        tag, cstart, cend = _der(data, pos, end)
+        yield tag, pos, cstart, cend
+        pos = cend
+
+
+def get_signer_certificates(block):
+    """Gets the certificates and the number of signers out of a PKCS#7
+    SignedData signature block, as found in META-INF/*.RSA and friends.
+
+    :returns: (list of DER encoded certificates, number of signers)
+    """
+    tag, start, end = _der(block, 0, len(block))
+    children = list(_der_children(block, start, end))
+    # ContentInfo: contentType, [0] content
+    if tag != 0x30 or len(children) != 2 or children[1][0] != 0xa0:
+        raise AXMLException("Not a PKCS#7 ContentInfo")
+    tag, start, end = _der(block, children[1][2], children[1][3])
+    if tag != 0x30:
+        raise AXMLException("Not a PKCS#7 SignedData")
+    # SignedData: version, digestAlgorithms, contentInfo,
+    # [0] certificates, [1] crls, signerInfos
+    certs = []
+    signers = 0
+    for tag, estart, cstart, cend in _der_children(block, start, end):
+        if tag == 0xa0:
+            certs = [block[s:e] for _, s, _, e in _der_children(block, cstart, cend)]
+        elif tag == 0x31:
+            # digestAlgorithms comes first and is a SET too
+            signers = len(list(_der_children(block, cstart, cend)))
+    return certs, signers
+
+
+def get_signer_info(block):
+    """Gets the only SignerInfo out of a PKCS#7 SignedData signature block.
+
+    :returns: (digest algorithm, digest encryption algorithm, encrypted
+              digest), or None if there isn't exactly one signer or it has
+              authenticated attributes, which aren't checked here.
+    """
+    tag, start, end = _der(block, 0, len(block))
+    children = list(_der_children(block, start, end))
+    tag, start, end = _der(block, children[1][2], children[1][3])
+    signerinfos = [c for c in _der_children(block, start, end) if c[0] == 0x31]
+    if len(signerinfos) != 2:
+        return None
+    signers = list(_der_children(block, signerinfos[1][2], signerinfos[1][3]))
+    if len(signers) != 1:
+        return None
+    # SignerInfo: version, issuerAndSerialNumber, digestAlgorithm,
+    # [0] authenticatedAttributes, digestEncryptionAlgorithm,
+    # encryptedDigest, [1] unauthenticatedAttributes
+    fields = list(_der_children(block, signers[0][2], signers[0][3]))
+    if len(fields) < 5 or fields[3][0] == 0xa0:
+        return None
+
+    def oid(field):
+        algorithm = list(_der_children(block, field[2], field[3]))
+        if not algorithm or algorithm[0][0] != 0x06:
+            raise AXMLException("Bad algorithm identifier")
+        return block[algorithm[0][2]:algorithm[0][3]]
+
+    if fields[4][0] != 0x04:
+        raise AXMLException("Bad encrypted digest")
+    return oid(fields[2]), oid(fields[3]), block[fields[4][2]:fields[4][3]]
+
+
+def get_rsa_public_key(cert):
+    """Gets (modulus, exponent) out of a DER encoded certificate, or None
+    if it doesn't have an RSA key"""
+    tag, start, end = _der(cert, 0, len(cert))
+    tbs = list(_der_children(cert, start, end))[0]
+    fields = list(_der_children(cert, tbs[2], tbs[3]))
+    if fields[0][0] == 0xa0:
+        fields = fields[1:]
+    # serialNumber, signature, issuer, validity, subject, subjectPublicKeyInfo
+    spki = list(_der_children(cert, fields[5][2], fields[5][3]))
+    algorithm = list(_der_children(cert, spki[0][2], spki[0][3]))
+    if cert[algorithm[0][2]:algorithm[0][3]] != OID_RSA:
+        return None
+    # The BIT STRING starts with the number of unused bits
+    tag, start, end = _der(cert, spki[1][2] + 1, spki[1][3])
+    n, e = [int(cert[c:ce].encode('hex'), 16)
+            for _, _, c, ce in _der_children(cert, start, end)]
+    return n, e
+
+
+def verify_rsa(cert, digestalg, signature, data):
+    """Checks a PKCS#1 v1.5 RSA signature of data"""
+    key = get_rsa_public_key(cert)
+    if key is None:
+        return None
+    n, e = key
+    size = (n.bit_length() + 7) // 8
+    decrypted = '%x' % pow(int(signature.encode('hex'), 16), e, n)
+    decrypted = decrypted.rjust(size * 2, '0').decode('hex')
+    # 00 01 FF .. FF 00 DigestInfo
+    if not decrypted.startswith('\x00\x01\xff'):
+        return False
+    sep = decrypted.find('\x00', 2)
+    if sep < 0 or decrypted[2:sep] != '\xff' * (sep - 2):
+        return False
+    info = decrypted[sep + 1:]
+    try:
+        tag, start, end = _der(info, 0, len(info))
+        if end != len(info):
+            return False
+        algorithm, digest = list(_der_children(info, start, end))
+        oid = list(_der_children(info, algorithm[2], algorithm[3]))[0]
+    except (AXMLException, ValueError, IndexError):
+        return False
+    if DIGEST_OIDS.get(info[oid[2]:oid[3]]) != digestalg:
+        return False
+    return info[digest[2]:digest[3]] == hashlib.new(digestalg, data).digest()
+
+
+def _manifest_sections(data):
+    """Splits a JAR manifest or .SF file into its sections, as dicts of their
+    attributes with continuation lines joined up"""
+    sections = []
+    attrs = {}
+    name = None
+    for line in data.splitlines():
+        if not line:
+            # A blank line ends the section
+            if attrs:
+                sections.append(attrs)
+            attrs = {}
+            name = None
+        elif line.startswith(' ') and name is not None:
+            attrs[name] += line[1:]
+        elif ':' in line:
+            name, value = line.split(':', 1)
+            attrs[name] = value.strip()
+    if attrs:
+        sections.append(attrs)
+    return sections
+
+
+def _digest_of(attrs, suffix):
+    """The first digest in attrs that we know of, as (hash name, digest)"""
+    for name, hashname in DIGEST_NAMES:
+        if name + suffix in attrs:
+            return hashname, base64.b64decode(attrs[name + suffix])
+    return None, None
+
+
+def verify_jar(apk, blockname):
+    """Checks the JAR signature of an apk, like the Java JarFile does.
+
+    That is, the signature block signs the .SF file, the .SF file has the
+    digest of the whole manifest, and the manifest has the digest of every
+    file in the apk outside of META-INF.
+
+    :param apk: the apk as an open ZipFile
+    :param blockname: the name of its signature block
+    :returns: True if it all checks out, False if anything doesn't match,
+              or None if the apk is signed in a way that isn't checked here,
+              like with DSA or EC keys, and getsig needs to be asked.
+    """
+    block = apk.read(blockname)
+    certs, _ = get_signer_certificates(block)
+    signer = get_signer_info(block)
+    if len(certs) != 1 or signer is None:
+        return None
+    digestoid, encryptionoid, signature = signer
+    if encryptionoid != OID_RSA and encryptionoid not in OID_RSA_SIGNATURES:
+        return None
+    if digestoid not in DIGEST_OIDS:
+        return None
+
+    try:
+        sf = apk.read(blockname.rsplit('.', 1)[0] + '.SF')
+        manifest = apk.read('META-INF/MANIFEST.MF')
+    except KeyError:
+        return False
+    verified = verify_rsa(certs[0], DIGEST_OIDS[digestoid], signature, sf)
+    if not verified:
+        return verified
+
+    hashname, digest = _digest_of(_manifest_sections(sf)[0], '-Digest-Manifest')
+    if hashname is None:
+        # Only signed per entry, which getsig can check
+        return None
+    if hashlib.new(hashname, manifest).digest() != digest:
+        return False
+
+    entries = {}
+    for attrs in _manifest_sections(manifest)[1:]:
+        if 'Name' in attrs:
+            entries[attrs['Name']] = attrs
+    for info in apk.infolist():
+        name = info.filename
+        if name.endswith('/') or name.startswith('META-INF/'):
+            continue
+        hashname, digest = _digest_of(entries.get(name, {}), '-Digest')
+        if hashname is None:
+            return False
+        h = hashlib.new(hashname)
+        f = apk.open(info)
+        try:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                h.update(chunk)
+        finally:
+            f.close()
+        if h.digest() != digest:
+            return False
+    return True
+
+
+def get_signature(apkfile):
+    """Gets the signature of an apk the way getsig does, that is the md5 of
+    the lowercase hex encoding of the signing certificate, after checking
+    that the apk is signed with it.
+
+    :returns: the signature, or None if the apk is signed in a way that only
+              getsig can tell, like with several signers, a certificate
+              chain or a key other than RSA.
+    :raises AXMLException: if the apk isn't signed, or the signature doesn't
+              match its contents.
+    """
+    try:
+        apk = zipfile.ZipFile(apkfile, 'r')
+    except (IOError, zipfile.BadZipfile), e:
+        raise AXMLException("Could not open %s: %s" % (apkfile, e))
+    try:
+        blocks = [n for n in apk.namelist() if SIGNATURE_BLOCK.match(n)]
+        if not blocks:
+            raise AXMLException("Not signed")
+        if len(blocks) != 1:
+            return None
+        block = apk.read(blocks[0])
+        try:
+            certs, signers = get_signer_certificates(block)
+        except AXMLException:
+            return None
+        if len(certs) != 1 or signers != 1:
+            return None
+        try:
+            verified = verify_jar(apk, blocks[0])
+        except (AXMLException, ValueError, IndexError, TypeError):
+            # Anything unexpected is left to getsig
+            return None
+        except (zipfile.BadZipfile, zlib.error, IOError), e:
+            raise AXMLException("Could not read %s: %s" % (apkfile, e))
+    finally:
+        apk.close()
+    if verified is None:
+        return None
+    if not verified:
+        raise AXMLException("The signature of %s doesn't match its contents"
+                            % apkfile)
+    return hashlib.md5(certs[0].encode('hex')).hexdigest()
@@ -27,14 +27,23 @@ import tarfile
 import traceback
 import time
 import json
+import hashlib
+import sqlite3
+import threading
+import multiprocessing
+import Queue
 from ConfigParser import ConfigParser
 from optparse import OptionParser, OptionError
 from distutils.version import LooseVersion
+from distutils.spawn import find_executable
 import logging
 
 import common
 import metadata
-from common import FDroidException, BuildException, VCSException, FDroidPopen, SilentPopen
+import axml
+from axml import AXMLException
+from common import FDroidException, BuildException, VCSException, FDroidPopen
+from common import PopenResult, build_failure_detail
 
 try:
     import paramiko
@@ -385,10 +394,10 @@ def build_server(app, thisbuild, vcs, build_dir, output_dir, force):
             cmdline += ' --verbose'
         cmdline += " %s:%s" % (app['id'], thisbuild['vercode'])
         chan.exec_command('bash -c ". ~/.bsenv && ' + cmdline + '"')
-        output = ''
+        output = PopenResult()
         while not chan.exit_status_ready():
             while chan.recv_ready():
-                output += chan.recv(1024)
+                output.add(chan.recv(1024))
             time.sleep(0.1)
         logging.info("...getting exit status")
         returncode = chan.recv_exit_status()
@@ -396,11 +405,12 @@ def build_server(app, thisbuild, vcs, build_dir, output_dir, force):
             get = chan.recv(1024)
             if len(get) == 0:
                 break
-            output += get
+            output.add(get)
         if returncode != 0:
             raise BuildException(
                 "Build.py failed on server for {0}:{1}".format(
-                    app['id'], thisbuild['version']), output)
+                    app['id'], thisbuild['version']),
+                build_failure_detail(output, app, thisbuild))
 
         # Retrieve the built files...
         logging.info("Retrieving build output...")
@@ -417,7 +427,8 @@ def build_server(app, thisbuild, vcs, build_dir, output_dir, force):
         except:
             raise BuildException(
                 "Build failed for %s:%s - missing output files".format(
-                    app['id'], thisbuild['version']), output)
+                    app['id'], thisbuild['version']),
+                build_failure_detail(output, app, thisbuild))
         ftp.close()
 
     finally:
@@ -426,15 +437,31 @@ def build_server(app, thisbuild, vcs, build_dir, output_dir, force):
         release_vm()
 
 
-def adapt_gradle(build_dir):
-    for root, dirs, files in os.walk(build_dir):
-        if 'build.gradle' in files:
-            path = os.path.join(root, 'build.gradle')
-            logging.debug("Adapting build.gradle at %s" % path)
+build_tools_version = re.compile(r'buildToolsVersion([ =]*)["\'][0-9\.]*["\']')
+
+
+def adapt_gradle(root, dirs, files):
+    if 'build.gradle' in files:
+        path = os.path.join(root, 'build.gradle')
+        logging.debug("Adapting build.gradle at %s" % path)
+
+        common.regsub_file(build_tools_version,
+                           lambda m: 'buildToolsVersion%s"%s"' % (m.group(1), config['build_tools']),
+                           path)
 
-            FDroidPopen(['sed', '-i',
-                         r's@buildToolsVersion\([ =]*\)["\'][0-9\.]*["\']@buildToolsVersion\1"'
-                         + config['build_tools'] + '"@g', path])
+
+def remove_gradle_wrapper(root, dirs, files):
+    # Don't remove possibly necessary 'gradle' dirs if 'gradlew' is not there
+    if 'gradlew' in files:
+        logging.debug("Getting rid of Gradle wrapper stuff in %s" % root)
+        os.remove(os.path.join(root, 'gradlew'))
+        files.remove('gradlew')
+        if 'gradlew.bat' in files:
+            os.remove(os.path.join(root, 'gradlew.bat'))
+            files.remove('gradlew.bat')
+        if 'gradle' in dirs:
+            shutil.rmtree(os.path.join(root, 'gradle'))
+            dirs.remove('gradle')
 
 
 def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_dir, tmp_dir, force, onserver):
@@ -473,9 +500,9 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
         logging.info("Cleaning Gradle project...")
         cmd = [config['gradle'], 'clean']
 
-        adapt_gradle(build_dir)
+        common.visit_source(build_dir, [adapt_gradle])
         for name, number, libpath in srclibpaths:
-            adapt_gradle(libpath)
+            common.visit_source(libpath, [adapt_gradle])
 
         p = FDroidPopen(cmd, cwd=root_dir)
 
@@ -488,22 +515,17 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
 
     if p is not None and p.returncode != 0:
         raise BuildException("Error cleaning %s:%s" %
-                             (app['id'], thisbuild['version']), p.output)
-
-    for root, dirs, files in os.walk(build_dir):
-        # Don't remove possibly necessary 'gradle' dirs if 'gradlew' is not there
-        if 'gradlew' in files:
-            logging.debug("Getting rid of Gradle wrapper stuff in %s" % root)
-            os.remove(os.path.join(root, 'gradlew'))
-            if 'gradlew.bat' in files:
-                os.remove(os.path.join(root, 'gradlew.bat'))
-            if 'gradle' in dirs:
-                shutil.rmtree(os.path.join(root, 'gradle'))
-
-    if not options.skipscan:
-        # Scan before building...
+                             (app['id'], thisbuild['version']),
+                             build_failure_detail(p, app, thisbuild))
+
+    if options.skipscan:
+        common.visit_source(build_dir, [remove_gradle_wrapper])
+    else:
+        # Scan before building, getting rid of the Gradle wrapper stuff on
+        # the way...
         logging.info("Scanning source for common problems...")
-        count = common.scan_source(build_dir, root_dir, thisbuild)
+        count = common.scan_source(build_dir, root_dir, thisbuild,
+                                   [remove_gradle_wrapper])
         if count > 0:
             if force:
                 logging.warn('Scanner found %d problems:' % count)
@@ -554,7 +576,8 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
 
         if p.returncode != 0:
             raise BuildException("Error running build command for %s:%s" %
-                                 (app['id'], thisbuild['version']), p.output)
+                                 (app['id'], thisbuild['version']),
+                                 build_failure_detail(p, app, thisbuild))
 
     # Build native stuff if required...
     if thisbuild['buildjni'] and thisbuild['buildjni'] != ['no']:
@@ -563,7 +586,8 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
 
         if jni_components == ['yes']:
             jni_components = ['']
-        cmd = [os.path.join(config['ndk_path'], "ndk-build"), "-j1"]
+        cmd = [os.path.join(config['ndk_path'], "ndk-build"),
+               "-j%d" % config['build_job_cpus']]
         for d in jni_components:
             if d:
                 logging.info("Building native code in '%s'" % d)
@@ -582,7 +606,8 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
                 del manifest_text
             p = FDroidPopen(cmd, cwd=os.path.join(root_dir, d))
             if p.returncode != 0:
-                raise BuildException("NDK build failed for %s:%s" % (app['id'], thisbuild['version']), p.output)
+                raise BuildException("NDK build failed for %s:%s" % (app['id'], thisbuild['version']),
+                                     build_failure_detail(p, app, thisbuild))
 
     p = None
     # Build the release...
@@ -712,12 +737,13 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
         bindir = os.path.join(root_dir, 'bin')
 
     if p is not None and p.returncode != 0:
-        raise BuildException("Build failed for %s:%s" % (app['id'], thisbuild['version']), p.output)
+        raise BuildException("Build failed for %s:%s" % (app['id'], thisbuild['version']),
+                             build_failure_detail(p, app, thisbuild))
     logging.info("Successfully built version " + thisbuild['version'] + ' of ' + app['id'])
 
     if thisbuild['type'] == 'maven':
         stdout_apk = '\n'.join([
-            line for line in p.output.splitlines() if any(a in line for a in ('.apk', '.ap_'))])
+            line for line in p.iterlines() if any(a in line for a in ('.apk', '.ap_'))])
         m = re.match(r".*^\[INFO\] .*apkbuilder.*/([^/]*)\.apk",
                      stdout_apk, re.S | re.M)
         if not m:
@@ -753,7 +779,7 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
             src = os.path.join(dd, 'build', 'apk', name + '.apk')
     elif thisbuild['type'] == 'ant':
         stdout_apk = '\n'.join([
-            line for line in p.output.splitlines() if '.apk' in line])
+            line for line in p.iterlines() if '.apk' in line])
         src = re.match(r".*^.*Creating (.+) for release.*$.*", stdout_apk,
                        re.S | re.M).group(1)
         src = os.path.join(bindir, src)
@@ -761,47 +787,29 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
         src = os.path.join(root_dir, thisbuild['output'])
         src = os.path.normpath(src)
 
-    # Make sure it's not debuggable...
-    if common.isApkDebuggable(src, config):
-        raise BuildException("APK is debuggable")
-
     # By way of a sanity check, make sure the version and version
     # code in our new apk match what we expect...
     logging.debug("Checking " + src)
     if not os.path.exists(src):
         raise BuildException("Unsigned apk is not at expected location of " + src)
 
-    p = SilentPopen([config['aapt'], 'dump', 'badging', src])
+    try:
+        apkinfo = axml.get_apk_info(src)
+    except AXMLException, e:
+        raise BuildException("Failed to read the built apk", str(e))
 
+    # Make sure it's not debuggable...
+    if apkinfo['debuggable']:
+        raise BuildException("APK is debuggable")
+
+    foundid = apkinfo.get('id')
     vercode = None
-    version = None
-    foundid = None
-    nativecode = None
-    for line in p.output.splitlines():
-        if line.startswith("package:"):
-            pat = re.compile(".*name='([a-zA-Z0-9._]*)'.*")
-            m = pat.match(line)
-            if m:
-                foundid = m.group(1)
-            pat = re.compile(".*versionCode='([0-9]*)'.*")
-            m = pat.match(line)
-            if m:
-                vercode = m.group(1)
-            pat = re.compile(".*versionName='([^']*)'.*")
-            m = pat.match(line)
-            if m:
-                version = m.group(1)
-        elif line.startswith("native-code:"):
-            nativecode = line[12:]
-
-    # Ignore empty strings or any kind of space/newline chars that we don't
-    # care about
-    if nativecode is not None:
-        nativecode = nativecode.strip()
-        nativecode = None if not nativecode else nativecode
+    if 'versioncode' in apkinfo:
+        vercode = str(apkinfo['versioncode'])
+    version = apkinfo['version']
 
     if thisbuild['buildjni'] and thisbuild['buildjni'] != ['no']:
-        if nativecode is None:
+        if not apkinfo['nativecode']:
             raise BuildException("Native code should have been built but none was packaged")
     if thisbuild['novcheck']:
         vercode = thisbuild['vercode']
@@ -841,6 +849,159 @@ def build_local(app, thisbuild, vcs, build_dir, output_dir, srclib_dir, extlib_d
                     os.path.join(output_dir, tarname))
 
 
+def get_build_fingerprint(app, thisbuild):
+    """Hash everything that goes into a build.
+
+    That is the app id and repo, the version name and code, the flags of the
+    build recipe and the patches it applies, the srclibs it uses and their metadata, and the tools set in the
+    config along with when they were last changed. Note that the commit is
+    hashed as written in the recipe, so a tag that gets moved upstream doesn't
+    change the fingerprint, which is why failures are only remembered for
+    build_failure_ttl seconds.
+    """
+    h = hashlib.sha1()
+
+    def add(value):
+        h.update(repr(value))
+        h.update('\0')
+
+    add(app['id'])
+    add(app['Repo Type'])
+    add(app['Repo'])
+    # Only the keys that come from the metadata, as building adds others
+    add(thisbuild['version'])
+    add(thisbuild['vercode'])
+    for flag in metadata.flag_defaults:
+        add((flag, thisbuild.get(flag)))
+    for patch in thisbuild['patch']:
+        patch_path = os.path.join('metadata', app['id'], patch.strip())
+        if os.path.isfile(patch_path):
+            with open(patch_path, 'rb') as f:
+                add(f.read())
+    for lib in thisbuild['srclibs']:
+        srclib = metadata.srclibs.get(common.srclibname(lib), {})
+        add(sorted(srclib.items()))
+    tools = [
+        ('sdk_path', config.get('sdk_path')),
+        ('ndk_path', config.get('ndk_path')),
+        ('build_tools', os.path.join(config.get('sdk_path', ''), 'build-tools',
+                                     config.get('build_tools', ''))),
+        ]
+    for k in ['ant', 'mvn3', 'gradle']:
+        tool = config.get(k)
+        if tool and not os.path.isabs(tool):
+            tool = find_executable(tool)
+        tools.append((k, tool))
+    for k, path in tools:
+        # Upgrading a tool changes its modification time, which stands in
+        # for its version here
+        mtime = None
+        if path and os.path.exists(path):
+            mtime = os.path.getmtime(os.path.realpath(path))
+        add((k, path, mtime))
+    return h.hexdigest()
+
+
+class BuildDB:
+    """Records the outcome of builds, along with the fingerprint of their
+    inputs, in an sqlite database in tmp/.
+
+    This is used to skip builds that failed before when nothing that goes
+    into them has changed since. The database is shared between the build
+    threads, so all access goes through a lock.
+    """
+
+    # Increase this when the layout of the table changes, which throws away
+    # the old entries.
+    schema_version = 1
+
+    def __init__(self, path=os.path.join('tmp', 'builddb.db')):
+        self.path = path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.schema_version:
+            logging.debug("Creating build database version %d" % self.schema_version)
+            self.db.execute('DROP TABLE IF EXISTS builds')
+            self.db.execute('CREATE TABLE builds (appid TEXT, vercode TEXT, '
+                            'fingerprint TEXT, status TEXT, time REAL, '
+                            'reason TEXT, PRIMARY KEY (appid, vercode))')
+            self.db.execute('PRAGMA user_version = %d' % self.schema_version)
+            self.db.commit()
+
+    def known_failure(self, app, thisbuild, fingerprint, since):
+        """Get when and why a build with this fingerprint failed, if that
+        was after the time given.
+
+        :returns: (time, reason) or None if it is not known to fail
+        """
+        with self.lock:
+            row = self.db.execute('SELECT time, reason FROM builds WHERE '
+                                  'appid = ? AND vercode = ? AND '
+                                  'fingerprint = ? AND status = ? AND '
+                                  'time > ?',
+                                  (app['id'], thisbuild['vercode'],
+                                   fingerprint, 'failed', since)).fetchone()
+        return row
+
+    def record(self, app, thisbuild, fingerprint, status, reason=None):
+        """Record the outcome of a build, which is 'succeeded' or 'failed'"""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO builds VALUES '
+                            '(?, ?, ?, ?, ?, ?)',
+                            (app['id'], thisbuild['vercode'], fingerprint,
+                             status, time.time(), reason))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def need_build(app, thisbuild, output_dir, also_check_dir, repo_dir, test):
+    """Check whether a build is enabled and its output doesn't exist yet,
+    or we are in test mode."""
+
+    dest_apk = common.getapkname(app, thisbuild)
+
+    dest = os.path.join(output_dir, dest_apk)
+    dest_repo = os.path.join(repo_dir, dest_apk)
+
+    if not test:
+        if os.path.exists(dest) or os.path.exists(dest_repo):
+            return False
+
+        if also_check_dir:
+            dest_also = os.path.join(also_check_dir, dest_apk)
+            if os.path.exists(dest_also):
+                return False
+
+    if thisbuild['disable']:
+        return False
+
+    return True
+
+
+def get_known_failure(app, thisbuild, test, force):
+    """Get when and why the build failed recently with the same inputs, as
+    (time, reason), unless it should be retried anyway."""
+    if not builddb or test or force or options.retry_failed:
+        return None
+    return builddb.known_failure(app, thisbuild,
+                                 get_build_fingerprint(app, thisbuild),
+                                 time.time() - config['build_failure_ttl'])
+
+
+class KnownBuildFailure(BuildException):
+    """A build that was skipped, as it failed recently with the same inputs"""
+    pass
+
+
 def trybuild(app, thisbuild, build_dir, output_dir, also_check_dir, srclib_dir, extlib_dir,
              tmp_dir, repo_dir, vcs, test, server, force, onserver):
     """
@@ -858,25 +1019,22 @@ def trybuild(app, thisbuild, build_dir, output_dir, also_check_dir, srclib_dir,
        ones.
 
     :returns: True if the build was done, False if it wasn't necessary.
+    :raises KnownBuildFailure: if it failed recently with the same inputs.
     """
 
-    dest_apk = common.getapkname(app, thisbuild)
-
-    dest = os.path.join(output_dir, dest_apk)
-    dest_repo = os.path.join(repo_dir, dest_apk)
-
-    if not test:
-        if os.path.exists(dest) or os.path.exists(dest_repo):
-            return False
-
-        if also_check_dir:
-            dest_also = os.path.join(also_check_dir, dest_apk)
-            if os.path.exists(dest_also):
-                return False
-
-    if thisbuild['disable']:
+    if not need_build(app, thisbuild, output_dir, also_check_dir, repo_dir, test):
         return False
 
+    failure = get_known_failure(app, thisbuild, test, force)
+    if failure:
+        raise KnownBuildFailure(
+            "Skipped version %s (%s) of %s, it failed at %s with the same "
+            "inputs: %s" % (thisbuild['version'], thisbuild['vercode'],
+                            app['id'],
+                            time.strftime("%Y-%m-%d %H:%M:%SZ",
+                                          time.gmtime(failure[0])),
+                            failure[1]))
+
     logging.info("Building version %s (%s) of %s" % (
         thisbuild['version'], thisbuild['vercode'], app['id']))
 
@@ -891,6 +1049,241 @@ def trybuild(app, thisbuild, build_dir, output_dir, also_check_dir, srclib_dir,
     return True
 
 
+def build_app(app, output_dir, also_check_dir, srclib_dir, extlib_dir,
+              tmp_dir, repo_dir, log_dir):
+    """Run all the builds of an app.
+
+    Returns a list of (build, exception, wikilog) for the builds that were
+    attempted, where exception is None for the ones that succeeded. With
+    --stop, the remaining builds are skipped after the first failure.
+    """
+
+    results = []
+    first = True
+
+    for thisbuild in app['builds']:
+        try:
+
+            # For the first build of a particular app, we need to set up
+            # the source repo. We can reuse it on subsequent builds, if
+            # there are any.
+            if first:
+                build_dir = get_app_build_dir(app)
+
+                # Set up vcs interface and make sure we have the latest code...
+                logging.debug("Getting {0} vcs interface for {1}"
+                              .format(app['Repo Type'], app['Repo']))
+                vcs = common.getvcs(app['Repo Type'], app['Repo'], build_dir)
+
+                first = False
+
+            logging.debug("Checking " + thisbuild['version'])
+            if trybuild(app, thisbuild, build_dir, output_dir,
+                        also_check_dir, srclib_dir, extlib_dir,
+                        tmp_dir, repo_dir, vcs, options.test,
+                        options.server, options.force,
+                        options.onserver):
+                if builddb:
+                    builddb.record(app, thisbuild,
+                                   get_build_fingerprint(app, thisbuild),
+                                   'succeeded')
+                results.append((thisbuild, None, "Build succeeded"))
+        except KnownBuildFailure as kbf:
+            # Not recorded again, so that it gets retried once the original
+            # failure is old enough
+            logging.error("Could not build app %s: %s" % (app['id'], kbf))
+            results.append((thisbuild, kbf, kbf.get_wikitext()))
+        except BuildException as be:
+            # Only build failures are recorded, as vcs and other errors are
+            # often down to the network or the machine rather than the build
+            if builddb:
+                builddb.record(app, thisbuild,
+                               get_build_fingerprint(app, thisbuild),
+                               'failed', str(be.value))
+            logfile = open(os.path.join(log_dir, app['id'] + '.log'), 'a+')
+            logfile.write(str(be))
+            logfile.close()
+            reason = str(be).split('\n', 1)[0] if options.verbose else str(be)
+            logging.error("Could not build app %s due to BuildException: %s" % (
+                app['id'], reason))
+            results.append((thisbuild, be, be.get_wikitext()))
+        except VCSException as vcse:
+            reason = str(vcse).split('\n', 1)[0] if options.verbose else str(vcse)
+            logging.error("VCS error while building app %s: %s" % (
+                app['id'], reason))
+            results.append((thisbuild, vcse, str(vcse)))
+        except Exception as e:
+            logging.error("Could not build app %s due to unknown error: %s" % (
+                app['id'], traceback.format_exc()))
+            results.append((thisbuild, e, str(e)))
+
+        if options.stop and results and results[-1][1] is not None:
+            break
+
+    return results
+
+
+def get_app_build_dir(app):
+    """The directory the source of an app is checked out in"""
+    if app['Repo Type'] == 'srclib':
+        return os.path.join('build', 'srclib', app['Repo'])
+    return os.path.join('build', app['id'])
+
+
+def get_build_dirs(app):
+    """All the directories that building an app writes to, and that no other
+    build can be using at the same time."""
+    dirs = set([get_app_build_dir(app)])
+    for thisbuild in app['builds']:
+        for lib in thisbuild['srclibs']:
+            dirs.add(os.path.join('build', 'srclib', common.srclibname(lib)))
+        if thisbuild['type'] == 'kivy':
+            dirs.add('python-for-android')
+    return dirs
+
+
+def get_job_limit(jobs):
+    """Work out how many builds can run at once.
+
+    This is the number of jobs asked for, cut down so that each of them
+    gets the CPUs and memory set by build_job_cpus and build_job_memory in
+    the config.
+    """
+    if jobs > 1 and (options.server or options.onserver):
+        logging.warn("Builds can't run in parallel on the build server, using one job")
+        jobs = 1
+    cpus = max(1, config['build_job_cpus'])
+    memory = config['build_job_memory']
+    if jobs > 1:
+        jobs = min(jobs, max(1, multiprocessing.cpu_count() // cpus))
+        if memory:
+            total = get_total_memory()
+            if total:
+                jobs = min(jobs, max(1, total // memory))
+        logging.info("Running up to %d builds at once" % jobs)
+
+    if memory:
+        for var in ['GRADLE_OPTS', 'MAVEN_OPTS', 'ANT_OPTS']:
+            opts = os.environ.get(var, '')
+            os.environ[var] = (opts + ' -Xmx%dm' % memory).strip()
+
+    return jobs
+
+
+def get_total_memory():
+    """The total memory of this machine in MiB, or None if it's unknown"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+class BuildScheduler:
+    """Hands out the apps to build to the worker threads.
+
+    An app is only handed out once none of the directories it builds in are
+    in use by an app that is still being built, so that the builds never
+    step on each other's checkouts.
+    """
+
+    def __init__(self, apps):
+        self.pending = list(enumerate(apps))
+        self.busy = set()
+        self.stopped = False
+        self.cond = threading.Condition()
+
+    def next(self):
+        """Wait for an app that can be built, and claim its directories.
+
+        Returns (index, app, dirs), or None when there is nothing left to
+        build.
+        """
+        with self.cond:
+            while True:
+                if self.stopped or not self.pending:
+                    return None
+                for i, (n, app) in enumerate(self.pending):
+                    dirs = get_build_dirs(app)
+                    if not dirs & self.busy:
+                        del self.pending[i]
+                        self.busy |= dirs
+                        return n, app, dirs
+                self.cond.wait()
+
+    def done(self, dirs):
+        """Release the directories of an app that has been built"""
+        with self.cond:
+            self.busy -= dirs
+            self.cond.notify_all()
+
+    def stop(self):
+        """Don't hand out any more apps"""
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+
+def build_apps(apps, jobs, *args):
+    """Build the given apps, running up to jobs of them at once.
+
+    Yields (app, results) with the results of build_app, in the same order
+    as apps, as soon as each app and all the ones before it are done. The
+    remaining args are passed on to build_app.
+    """
+
+    if jobs <= 1:
+        for app in apps:
+            yield app, build_app(app, *args)
+        return
+
+    scheduler = BuildScheduler(apps)
+    done = Queue.Queue()
+
+    def worker():
+        while True:
+            job = scheduler.next()
+            if job is None:
+                break
+            n, app, dirs = job
+            # Tell the output of the builds running at the same time apart
+            common.popen_output.prefix = '%s: ' % app['id']
+            try:
+                results = build_app(app, *args)
+            finally:
+                common.popen_output.prefix = None
+                scheduler.done(dirs)
+            done.put((n, results))
+
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    finished = {}
+    n = 0
+    try:
+        while n < len(apps) and any(t.is_alive() for t in threads):
+            try:
+                # A timeout keeps the wait interruptible with Ctrl-C
+                i, results = done.get(True, 1)
+            except Queue.Empty:
+                continue
+            finished[i] = results
+            while n in finished:
+                yield apps[n], finished.pop(n)
+                n += 1
+    finally:
+        # Let the builds that are still running finish, but don't start any
+        # new ones
+        scheduler.stop()
+        for t in threads:
+            t.join()
+
+
 def parse_commandline():
     """Parse the command line. Returns options, args."""
 
@@ -921,6 +1314,12 @@ def parse_commandline():
                       help="Build all applications available")
     parser.add_option("-w", "--wiki", default=False, action="store_true",
                       help="Update the wiki")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="Number of apps to build in parallel. Default is 1")
+    parser.add_option("--retry-failed", action="store_true", default=False,
+                      help="Retry builds that failed before, even if nothing has changed since")
+    parser.add_option("--prefetch", type="int", default=0, metavar="N",
+                      help="Fetch the repositories of all the builds first, N at a time")
     options, args = parser.parse_args()
 
     # Force --stop with --on-server to get correct exit code
@@ -934,11 +1333,12 @@ def parse_commandline():
 
 options = None
 config = None
+builddb = None
 
 
 def main():
 
-    global options, config
+    global options, config, builddb
 
     options, args = parse_commandline()
     if not args and not options.all:
@@ -984,7 +1384,9 @@ def main():
     extlib_dir = os.path.join(build_dir, 'extlib')
 
     # Read all app and srclib metadata
-    allapps = metadata.read_metadata(xref=not options.onserver)
+    # Only read the metadata of the apps we were asked to build, if any
+    appids = common.read_pkg_args(args, True).keys() or None
+    allapps = metadata.read_metadata(xref=not options.onserver, appids=appids)
 
     apps = common.read_app_args(args, allapps, True)
     apps = [app for app in apps if (options.force or not app['Disabled']) and
@@ -1007,75 +1409,56 @@ def main():
                              path=config['wiki_path'])
         site.login(config['wiki_user'], config['wiki_password'])
 
+    if not options.onserver:
+        builddb = BuildDB(os.path.join(tmp_dir, 'builddb.db'))
+
+    if options.prefetch > 0 and not options.onserver:
+        vcslist = []
+        for app in apps:
+            builds = [b for b in app['builds']
+                      if need_build(app, b, output_dir, also_check_dir,
+                                    repo_dir, options.test)
+                      and not get_known_failure(app, b, options.test,
+                                                options.force)]
+            if builds:
+                try:
+                    vcslist.append(common.getvcs(app['Repo Type'], app['Repo'],
+                                                 get_app_build_dir(app)))
+                    vcslist += common.getsrclibsvcs(builds)
+                except VCSException:
+                    # This will be reported when building the app
+                    pass
+        common.prefetch(vcslist, options.prefetch)
+
     # Build applications...
+    jobs = get_job_limit(options.jobs)
     failed_apps = {}
     build_succeeded = []
-    for app in apps:
-
-        first = True
-
-        for thisbuild in app['builds']:
-            wikilog = None
-            try:
-
-                # For the first build of a particular app, we need to set up
-                # the source repo. We can reuse it on subsequent builds, if
-                # there are any.
-                if first:
-                    if app['Repo Type'] == 'srclib':
-                        build_dir = os.path.join('build', 'srclib', app['Repo'])
-                    else:
-                        build_dir = os.path.join('build', app['id'])
-
-                    # Set up vcs interface and make sure we have the latest code...
-                    logging.debug("Getting {0} vcs interface for {1}"
-                                  .format(app['Repo Type'], app['Repo']))
-                    vcs = common.getvcs(app['Repo Type'], app['Repo'], build_dir)
-
-                    first = False
-
-                logging.debug("Checking " + thisbuild['version'])
-                if trybuild(app, thisbuild, build_dir, output_dir,
-                            also_check_dir, srclib_dir, extlib_dir,
-                            tmp_dir, repo_dir, vcs, options.test,
-                            options.server, options.force,
-                            options.onserver):
+    builds = build_apps(apps, jobs, output_dir, also_check_dir, srclib_dir,
+                        extlib_dir, tmp_dir, repo_dir, log_dir)
+    try:
+        for app, results in builds:
+            for thisbuild, e, wikilog in results:
+                if e is None:
                     build_succeeded.append(app)
-                    wikilog = "Build succeeded"
-            except BuildException as be:
-                logfile = open(os.path.join(log_dir, app['id'] + '.log'), 'a+')
-                logfile.write(str(be))
-                logfile.close()
-                reason = str(be).split('\n', 1)[0] if options.verbose else str(be)
-                logging.error("Could not build app %s due to BuildException: %s" % (
-                    app['id'], reason))
-                if options.stop:
-                    sys.exit(1)
-                failed_apps[app['id']] = be
-                wikilog = be.get_wikitext()
-            except VCSException as vcse:
-                reason = str(vcse).split('\n', 1)[0] if options.verbose else str(vcse)
-                logging.error("VCS error while building app %s: %s" % (
-                    app['id'], reason))
-                if options.stop:
-                    sys.exit(1)
-                failed_apps[app['id']] = vcse
-                wikilog = str(vcse)
-            except Exception as e:
-                logging.error("Could not build app %s due to unknown error: %s" % (
-                    app['id'], traceback.format_exc()))
-                if options.stop:
-                    sys.exit(1)
-                failed_apps[app['id']] = e
-                wikilog = str(e)
-
-            if options.wiki and wikilog:
-                try:
-                    newpage = site.Pages[app['id'] + '/lastbuild']
-                    txt = "Build completed at " + time.strftime("%Y-%m-%d %H:%M:%SZ", time.gmtime()) + "\n\n" + wikilog
-                    newpage.save(txt, summary='Build log')
-                except:
-                    logging.error("Error while attempting to publish build log")
+                else:
+                    if options.stop:
+                        builds.close()
+                        sys.exit(1)
+                    failed_apps[app['id']] = e
+
+                if options.wiki and wikilog:
+                    try:
+                        newpage = site.Pages[app['id'] + '/lastbuild']
+                        txt = "Build completed at " + time.strftime("%Y-%m-%d %H:%M:%SZ", time.gmtime()) + "\n\n" + wikilog
+                        newpage.save(txt, summary='Build log')
+                    except:
+                        logging.error("Error while attempting to publish build log")
+    finally:
+        # Make sure no build is still using the database before closing it
+        builds.close()
+        if builddb:
+            builddb.close()
 
     for app in build_succeeded:
         logging.info("success: %s" % (app['id']))
@@ -21,12 +21,22 @@
 import sys
 import os
 import re
+import urllib
 import urllib2
 import time
 import subprocess
 from optparse import OptionParser
 import traceback
 import HTMLParser
+import cPickle
+import tempfile
+import base64
+import urlparse
+import httplib
+import socket
+import threading
+import collections
+import multiprocessing.dummy
 from distutils.version import LooseVersion
 import logging
 
@@ -36,6 +46,213 @@ from common import VCSException, FDroidException
 from metadata import MetaDataException
 
 
+# Get the functions for manifest_paths and parse_androidmanifests to check
+# for and read files at a tag, rather than in the working tree. Each file is
+# only read once.
+def tag_file_readers(vcs, tag):
+    contents = {}
+
+    def getfile(path):
+        if path not in contents:
+            contents[path] = vcs.getfile(tag, os.path.relpath(path, vcs.local))
+        return contents[path]
+
+    def isfile(path):
+        return getfile(path) is not None
+
+    def readlines(path):
+        return getfile(path).splitlines(True)
+
+    return isfile, readlines
+
+
+class HTTPFetcher:
+    """Downloads the pages used by check_http.
+
+    Each url is only fetched once per run, however many apps use it, and
+    connections are kept open for reuse, one per host and thread. Pages that
+    come with an ETag or Last-Modified header are kept in tmp/, so that later
+    runs only download them again if they changed. Failures raise an
+    FDroidException.
+
+    Like urllib2, it goes through the proxies set in the environment with
+    http_proxy and https_proxy, except for the hosts in no_proxy, and sends
+    the same User-Agent.
+    """
+
+    timeout = 20
+    max_redirects = 5
+    user_agent = 'Python-urllib/%s' % sys.version[:3]
+
+    def __init__(self, path=os.path.join('tmp', 'httpcache.pickle')):
+        self.path = path
+        self.lock = threading.Lock()
+        self.urllocks = {}
+        self.pages = {}
+        self.local = threading.local()
+        self.changed = False
+        self.store = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    self.store = cPickle.load(f)
+            except Exception, e:
+                logging.warn("Ignoring invalid http cache: %s" % e)
+
+    def save(self):
+        """Write the pages with an ETag or Last-Modified to tmp/"""
+        if not self.changed:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(self.store, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile, self.path)
+        except (IOError, OSError), e:
+            logging.warn("Could not write the http cache: %s" % e)
+
+    def fetch(self, url):
+        """Get the contents of a url"""
+        with self.lock:
+            if url not in self.urllocks:
+                self.urllocks[url] = threading.Lock()
+            urllock = self.urllocks[url]
+        # Apps checked at the same time wait for each other's downloads of
+        # the same url, rather than downloading it twice. Failures are kept
+        # too, so a dead url is only tried once.
+        with urllock:
+            if url not in self.pages:
+                try:
+                    self.pages[url] = (self.download(url), None)
+                except FDroidException, e:
+                    self.pages[url] = (None, e)
+            page, e = self.pages[url]
+        if e:
+            raise e
+        return page
+
+    def download(self, url):
+        logging.debug("...requesting {0}".format(url))
+        for i in range(self.max_redirects + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https'):
+                try:
+                    return urllib2.urlopen(url, None, self.timeout).read()
+                except (urllib2.URLError, IOError), e:
+                    raise FDroidException("Failed to fetch %s: %s" % (url, e))
+
+            headers = {'User-Agent': self.user_agent}
+            with self.lock:
+                stored = self.store.get(url)
+            if stored:
+                etag, modified, _ = stored
+                if etag:
+                    headers['If-None-Match'] = etag
+                if modified:
+                    headers['If-Modified-Since'] = modified
+
+            resp, page = self.request(parts, headers)
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader('location'):
+                url = urlparse.urljoin(url, resp.getheader('location'))
+                continue
+            if resp.status == 304 and stored:
+                return stored[2]
+            if resp.status != 200:
+                raise FDroidException("Failed to fetch %s: HTTP %d %s" % (url, resp.status, resp.reason))
+
+            etag = resp.getheader('etag')
+            modified = resp.getheader('last-modified')
+            with self.lock:
+                if etag or modified:
+                    self.store[url] = (etag, modified, page)
+                    self.changed = True
+                elif url in self.store:
+                    del self.store[url]
+                    self.changed = True
+            return page
+
+        raise FDroidException("Too many redirects fetching " + url)
+
+    def request(self, parts, headers):
+        """Make a request, reusing this thread's connection to the host if
+        there is one. Returns the response and its body."""
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        connections = self.local.connections
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        proxy = self.getproxy(parts)
+        if proxy and parts.scheme == 'http':
+            # Plain http goes to the proxy with the full url
+            path = urlparse.urlunsplit((parts.scheme, parts.netloc, path, '', ''))
+            headers = dict(headers)
+            headers.update(proxy[2])
+
+        # A kept-alive connection may have been closed by the server in the
+        # meantime, so a failure on one is retried on a new connection
+        for attempt in range(2):
+            reused = key in connections
+            if not reused:
+                connections[key] = self.connect(parts, proxy)
+            conn = connections[key]
+            try:
+                conn.request('GET', path, None, headers)
+                resp = conn.getresponse()
+                page = resp.read()
+            except (httplib.HTTPException, socket.error), e:
+                conn.close()
+                del connections[key]
+                if reused:
+                    continue
+                raise FDroidException("Failed to fetch %s: %s" % (urlparse.urlunsplit(parts), e))
+            if resp.will_close:
+                conn.close()
+                del connections[key]
+            return resp, page
+
+    def getproxy(self, parts):
+        """Get (host, port, headers) of the proxy to use for a url, or None
+        to connect to it directly"""
+        proxy = urllib.getproxies().get(parts.scheme)
+        if not proxy or urllib.proxy_bypass(parts.hostname):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxyparts = urlparse.urlsplit(proxy)
+        headers = {}
+        if proxyparts.username is not None:
+            credentials = '%s:%s' % (urllib.unquote(proxyparts.username),
+                                     urllib.unquote(proxyparts.password or ''))
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(credentials)
+        return proxyparts.hostname, proxyparts.port or 80, headers
+
+    def connect(self, parts, proxy):
+        if parts.scheme == 'https':
+            if proxy:
+                # Tunnel through the proxy with CONNECT
+                conn = httplib.HTTPSConnection(proxy[0], proxy[1], timeout=self.timeout)
+                conn.set_tunnel(parts.hostname, parts.port or 443, proxy[2])
+                return conn
+            return httplib.HTTPSConnection(parts.hostname, parts.port, timeout=self.timeout)
+        if proxy:
+            return httplib.HTTPConnection(proxy[0], proxy[1], timeout=self.timeout)
+        return httplib.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+
+
+http_fetcher = None
+
+
+def get_http_fetcher():
+    global http_fetcher
+    if http_fetcher is None:
+        http_fetcher = HTTPFetcher()
+    return http_fetcher
+
+
 # Check for a new version by looking at a document retrieved via HTTP.
 # The app's Update Check Data field is used to provide the information
 # required.
@@ -50,10 +267,7 @@ def check_http(app):
 
         vercode = "99999999"
         if len(urlcode) > 0:
-            logging.debug("...requesting {0}".format(urlcode))
-            req = urllib2.Request(urlcode, None)
-            resp = urllib2.urlopen(req, None, 20)
-            page = resp.read()
+            page = get_http_fetcher().fetch(urlcode)
 
             m = re.search(codeex, page)
             if not m:
@@ -63,10 +277,7 @@ def check_http(app):
         version = "??"
         if len(urlver) > 0:
             if urlver != '.':
-                logging.debug("...requesting {0}".format(urlver))
-                req = urllib2.Request(urlver, None)
-                resp = urllib2.urlopen(req, None, 20)
-                page = resp.read()
+                page = get_http_fetcher().fetch(urlver)
 
             m = re.search(verex, page)
             if not m:
@@ -128,17 +339,25 @@ def check_tags(app, pattern):
             pat = re.compile(pattern)
             tags = [tag for tag in tags if pat.match(tag)]
 
-        if repotype in ('git',):
+        if repotype in ('git', 'hg', 'bzr'):
             tags = vcs.latesttags(tags, 5)
 
         for tag in tags:
             logging.debug("Check tag: '{0}'".format(tag))
-            vcs.gotorevision(tag)
+
+            if repotype in ('git', 'hg', 'bzr'):
+                # Read the files straight from the tag, which is much
+                # quicker than checking it out
+                isfile, readlines = tag_file_readers(vcs, tag)
+            else:
+                vcs.gotorevision(tag)
+                isfile, readlines = os.path.isfile, file
 
             # Only process tags where the manifest exists...
-            paths = common.manifest_paths(build_dir, flavour)
+            paths = common.manifest_paths(build_dir, flavour, isfile)
             version, vercode, package = \
-                common.parse_androidmanifests(paths, app['Update Check Ignore'])
+                common.parse_androidmanifests(paths, app['Update Check Ignore'],
+                                              readlines)
             if not package or package != appid or not version or not vercode:
                 continue
 
@@ -268,11 +487,111 @@ def check_repotrunk(app, branch=None):
         return (None, msg)
 
 
-# Check for a new version by looking at the Google Play Store.
+class TokenBucket:
+    """Lets through one request every interval seconds on average, with
+    bursts of up to burst requests after a quiet period.
+
+    A request only waits when the bucket is out of tokens. The tokens are
+    handed out under a lock, so the bucket can be shared between threads.
+    """
+
+    def __init__(self, interval, burst):
+        self.interval = float(interval)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait until a request can go through"""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) / self.interval)
+            self.last = now
+            # Going below zero reserves a slot in the future, so that
+            # concurrent callers queue up rather than all waking up at once
+            self.tokens -= 1
+            wait = -self.tokens * self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """A token bucket per host, all with the same interval and burst"""
+
+    def __init__(self, interval, burst):
+        self.interval = interval
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def wait(self, host):
+        """Wait until a request can be made to host"""
+        if self.interval <= 0:
+            return
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.interval, self.burst)
+            bucket = self.buckets[host]
+        bucket.take()
+
+
+gplay_limiter = None
+gplay_cache_path = os.path.join('tmp', 'gplaycache.pickle')
+
+
+def load_gplay_cache():
+    """Load the results of earlier Play Store checks, as a dict of app ids to
+    (time, version, reason), leaving out the ones older than the TTL."""
+    if not os.path.exists(gplay_cache_path):
+        return {}
+    try:
+        with open(gplay_cache_path, 'rb') as f:
+            cache = cPickle.load(f)
+    except Exception, e:
+        logging.warn("Ignoring invalid Play Store cache: %s" % e)
+        return {}
+    oldest = time.time() - config['gplay_cache_ttl']
+    return dict((k, v) for k, v in cache.items() if v[0] >= oldest)
+
+
+def save_gplay_cache(cache):
+    try:
+        if not os.path.isdir(os.path.dirname(gplay_cache_path)):
+            os.makedirs(os.path.dirname(gplay_cache_path))
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(gplay_cache_path))
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, gplay_cache_path)
+    except (IOError, OSError), e:
+        logging.warn("Could not write the Play Store cache: %s" % e)
+
+
+# Check the version of an app in the Play Store. The result is stored in
+# cache, if given, unless it was a transient failure, and a result already
+# in there is used without asking the Play Store again.
 # Returns (None, "a message") if this didn't work, or (version, None) for
 # the details of the current version.
-def check_gplay(app):
-    time.sleep(15)
+def check_gplay(app, cache=None):
+    if cache is not None and app['id'] in cache:
+        _, version, reason = cache[app['id']]
+        return (version, reason)
+
+    global gplay_limiter
+    if gplay_limiter is None:
+        gplay_limiter = RateLimiter(config['gplay_interval'], config['gplay_burst'])
+    gplay_limiter.wait('play.google.com')
+
+    version, reason = fetch_gplay(app)
+    transient = reason is not None and (
+        reason.startswith('Failed:') or reason == '429' or reason.startswith('5'))
+    if cache is not None and not transient:
+        cache[app['id']] = (time.time(), version, reason)
+    return (version, reason)
+
+
+def fetch_gplay(app):
     url = 'https://play.google.com/store/apps/details?id=' + app['id']
     headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux i686; rv:18.0) Gecko/20100101 Firefox/18.0'}
     req = urllib2.Request(url, None, headers)
@@ -386,6 +705,9 @@ def fetch_autoname(app, tag):
     return commitmsg
 
 
+# Check an app for updates, and apply them to the app's metadata in memory.
+# Returns a description of the change, to be used as the commit message, or
+# None if there was nothing to change.
 def checkupdates_app(app, first=True):
 
     # If a change is made, commitmsg should be set to a description of it.
@@ -502,6 +824,12 @@ def checkupdates_app(app, first=True):
         else:
             logging.warn('Invalid auto update mode "' + mode + '" on ' + app['id'])
 
+    return commitmsg
+
+
+# Write the metadata of an app back after checkupdates_app changed it, and
+# commit it if asked to.
+def write_update(app, commitmsg):
     if commitmsg:
         metafile = os.path.join('metadata', app['id'] + '.txt')
         metadata.write_metadata(metafile, app)
@@ -516,6 +844,257 @@ def checkupdates_app(app, first=True):
                 sys.exit(1)
 
 
+def get_app_dir(app):
+    if app['Repo Type'] == 'srclib':
+        return os.path.join('build', 'srclib', app['Repo'])
+    return os.path.join('build/', app['id'])
+
+
+# Get the host that checking an app for updates mostly talks to, or None if
+# it doesn't need the network
+def get_app_host(app):
+    mode = app['Update Check Mode']
+    if mode in ('None', 'Static') or not mode:
+        return None
+    if mode == 'HTTP':
+        data = app['Update Check Data'] or ''
+        urls = [u for u in data.split('|')[::2] if u and u != '.']
+        if not urls:
+            return None
+        url = urls[0]
+    elif app['Repo Type'] == 'srclib':
+        if app['Repo'] not in metadata.srclibs:
+            return None
+        url = metadata.srclibs[app['Repo']]['Repo']
+    else:
+        url = app['Repo']
+    host = urlparse.urlparse(url.split(';')[0]).hostname
+    if not host:
+        # scp-like git urls, e.g. git@github.com:user/repo.git
+        m = re.match(r'^(?:[^@/]+@)?([^:/]+):', url)
+        host = m.group(1) if m else url
+    return host
+
+
+class HostLimiter:
+    """Limits how hard we hit each host when checking apps concurrently.
+
+    No more than jobs checks talk to the same host at once, and they start
+    at least delay seconds apart.
+    """
+
+    def __init__(self, jobs, delay):
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.ratelimiter = RateLimiter(delay, 1)
+
+    def acquire(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.Semaphore(self.jobs)
+            semaphore = self.semaphores[host]
+        semaphore.acquire()
+        self.ratelimiter.wait(host)
+
+    def release(self, host):
+        self.semaphores[host].release()
+
+
+def checkupdates_apps(apps, jobs):
+    """Check the given apps for updates, up to jobs of them at once.
+
+    Apps that share a source directory are checked one after the other, and
+    the per-host limits from the config are respected. Yields (app,
+    commitmsg, duration) in the same order as apps, as soon as each app and
+    all the ones before it are done. duration is how long the check took,
+    in seconds.
+    """
+
+    if jobs <= 1:
+        for app in apps:
+            logging.info("Processing " + app['id'] + '...')
+            start = time.time()
+            commitmsg = checkupdates_app(app)
+            yield app, commitmsg, time.time() - start
+        return
+
+    limiter = HostLimiter(config['checkupdates_host_jobs'],
+                          config['checkupdates_host_delay'])
+
+    groups = collections.OrderedDict()
+    for i, app in enumerate(apps):
+        groups.setdefault(get_app_dir(app), []).append(i)
+
+    def check_group(indexes):
+        results = []
+        for i in indexes:
+            app = apps[i]
+            host = get_app_host(app)
+            if host:
+                limiter.acquire(host)
+            try:
+                logging.info("Processing " + app['id'] + '...')
+                start = time.time()
+                commitmsg = checkupdates_app(app)
+                results.append((i, commitmsg, time.time() - start, None))
+            except Exception:
+                results.append((i, None, None, sys.exc_info()))
+            finally:
+                if host:
+                    limiter.release(host)
+        return results
+
+    logging.info("Checking %d apps using %d threads" % (len(apps), jobs))
+    pool = multiprocessing.dummy.Pool(jobs)
+    try:
+        finished = {}
+        n = 0
+        for results in pool.imap_unordered(check_group, groups.values()):
+            for i, commitmsg, duration, exc_info in results:
+                finished[i] = (commitmsg, duration, exc_info)
+            while n in finished:
+                commitmsg, duration, exc_info = finished.pop(n)
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                yield apps[n], commitmsg, duration
+                n += 1
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class CheckHistory:
+    """When each app was last checked for updates, when a check last found a
+    new version, and how long the last check took.
+
+    This is kept in stats/checkupdates.txt, with a line per app, and is used
+    by --scheduled to work out which apps are due for a check.
+    """
+
+    def __init__(self):
+        self.path = os.path.join('stats', 'checkupdates.txt')
+        self.apps = {}
+        if os.path.exists(self.path):
+            for line in file(self.path):
+                t = line.split()
+                if len(t) == 4:
+                    self.apps[t[0]] = (float(t[1]), float(t[2]), float(t[3]))
+        self.changed = False
+
+    def writeifchanged(self):
+        if self.changed:
+            if not os.path.exists('stats'):
+                os.mkdir('stats')
+            with open(self.path, 'w') as f:
+                for appid in sorted(self.apps):
+                    checked, changed, duration = self.apps[appid]
+                    f.write('%s %d %d %.1f\n' % (appid, checked, changed, duration))
+
+    # Record a check of an app, and whether it found a new version
+    def record(self, appid, updated, duration):
+        now = time.time()
+        if updated or appid not in self.apps:
+            # Apps we know nothing about are taken to have just changed, so
+            # that they start out being checked often
+            changed = now
+        else:
+            changed = self.apps[appid][1]
+        self.apps[appid] = (now, changed, duration)
+        self.changed = True
+
+    # How often an app should be checked. This is a fraction of the time it
+    # had gone without a new version by its last check, so that active apps
+    # are checked often and dormant ones back off, within the configured
+    # limits.
+    def interval(self, appid):
+        checked, changed, _ = self.apps[appid]
+        day = 24 * 3600
+        interval = (checked - changed) * config['checkupdates_backoff']
+        interval = max(interval, config['checkupdates_min_interval'] * day)
+        return min(interval, config['checkupdates_max_interval'] * day)
+
+    def schedule(self, apps, jobs):
+        """Pick the apps that are due for a check, most overdue first.
+
+        Apps that were never checked always come first. If the config sets a
+        time budget, apps stop being picked once the time their last checks
+        took, shared between the jobs, adds up to it.
+        """
+        now = time.time()
+        due = []
+        for app in apps:
+            if app['id'] not in self.apps:
+                due.append((float('inf'), app))
+                continue
+            checked = self.apps[app['id']][0]
+            interval = self.interval(app['id'])
+            # An hour of slack, so that runs at the same time every day
+            # don't miss apps that are due a little later than the run
+            if now - checked >= interval - 3600:
+                due.append(((now - checked) / interval, app))
+        due.sort(key=lambda d: d[0], reverse=True)
+
+        budget = config['checkupdates_time_budget']
+        scheduled = []
+        spent = 0.0
+        for _, app in due:
+            if app['id'] in self.apps:
+                duration = self.apps[app['id']][2]
+            else:
+                duration = 10.0
+            if budget and scheduled and spent + duration / jobs > budget:
+                break
+            spent += duration / jobs
+            scheduled.append(app)
+
+        logging.info("%d of %d apps are due for a check, checking %d of them"
+                     % (len(due), len(apps), len(scheduled)))
+        # Check them in the usual order, so that the commits are too
+        order = dict((app['id'], i) for i, app in enumerate(apps))
+        return sorted(scheduled, key=lambda app: order[app['id']])
+
+
+# Print the differences between the apps and their versions in the Play Store.
+# Up to jobs apps are checked at once, so that the time taken by each request
+# doesn't add to the rate limit, but they are reported in order.
+def check_gplay_apps(apps, cache, jobs=1):
+    def check(app):
+        version, reason = check_gplay(app, cache)
+        return (app, version, reason)
+
+    pool = multiprocessing.dummy.Pool(max(1, jobs))
+    try:
+        for app, version, reason in pool.imap(check, apps):
+            report_gplay(app, version, reason)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def report_gplay(app, version, reason):
+    if version is None:
+        if reason == '404':
+            logging.info("{0} is not in the Play Store".format(common.getappname(app)))
+        else:
+            logging.info("{0} encountered a problem: {1}".format(common.getappname(app), reason))
+    if version is not None:
+        stored = app['Current Version']
+        if not stored:
+            logging.info("{0} has no Current Version but has version {1} on the Play Store"
+                         .format(common.getappname(app), version))
+        elif LooseVersion(stored) < LooseVersion(version):
+            logging.info("{0} has version {1} on the Play Store, which is bigger than {2}"
+                         .format(common.getappname(app), version, stored))
+        else:
+            if stored != version:
+                logging.info("{0} has version {1} on the Play Store, which differs from {2}"
+                             .format(common.getappname(app), version, stored))
+            else:
+                logging.info("{0} has the same version {1} on the Play Store"
+                             .format(common.getappname(app), version))
+
+
 config = None
 options = None
 
@@ -538,49 +1117,70 @@ def main():
                       help="Commit changes")
     parser.add_option("--gplay", action="store_true", default=False,
                       help="Only print differences with the Play Store")
+    parser.add_option("--prefetch", type="int", default=0, metavar="N",
+                      help="Fetch the repositories of all the apps first, N at a time")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="Number of apps to check in parallel. Default is 1")
+    parser.add_option("--scheduled", action="store_true", default=False,
+                      help="Only check the apps that are due for a check, based on how often they got new versions")
     (options, args) = parser.parse_args()
 
     config = common.read_config(options)
 
     # Get all apps...
-    allapps = metadata.read_metadata()
+    # Only read the metadata of the apps we were asked to check, if any
+    appids = common.read_pkg_args(args, False).keys() or None
+    allapps = metadata.read_metadata(appids=appids)
 
     apps = common.read_app_args(args, allapps, False)
 
     if options.gplay:
-        for app in apps:
-            version, reason = check_gplay(app)
-            if version is None:
-                if reason == '404':
-                    logging.info("{0} is not in the Play Store".format(common.getappname(app)))
-                else:
-                    logging.info("{0} encountered a problem: {1}".format(common.getappname(app), reason))
-            if version is not None:
-                stored = app['Current Version']
-                if not stored:
-                    logging.info("{0} has no Current Version but has version {1} on the Play Store"
-                                 .format(common.getappname(app), version))
-                elif LooseVersion(stored) < LooseVersion(version):
-                    logging.info("{0} has version {1} on the Play Store, which is bigger than {2}"
-                                 .format(common.getappname(app), version, stored))
-                else:
-                    if stored != version:
-                        logging.info("{0} has version {1} on the Play Store, which differs from {2}"
-                                     .format(common.getappname(app), version, stored))
-                    else:
-                        logging.info("{0} has the same version {1} on the Play Store"
-                                     .format(common.getappname(app), version))
+        cache = load_gplay_cache()
+        try:
+            check_gplay_apps(apps, cache, options.jobs)
+        finally:
+            save_gplay_cache(cache)
         return
 
+    toprocess = []
     for app in apps:
 
         if options.autoonly and app['Auto Update Mode'] in ('None', 'Static'):
             logging.debug("Nothing to do for {0}...".format(app['id']))
             continue
 
-        logging.info("Processing " + app['id'] + '...')
+        toprocess.append(app)
 
-        checkupdates_app(app)
+    history = CheckHistory()
+    if options.scheduled:
+        toprocess = history.schedule(toprocess, max(1, options.jobs))
+    oldvercodes = dict((app['id'], app['Current Version Code']) for app in toprocess)
+
+    if options.prefetch > 0:
+        vcslist = []
+        for app in toprocess:
+            mode = app['Update Check Mode']
+            if not app['Repo Type'] or not mode.startswith(('Tags', 'RepoManifest', 'RepoTrunk')):
+                continue
+            try:
+                vcslist.append(common.getvcs(app['Repo Type'], app['Repo'], get_app_dir(app)))
+            except VCSException:
+                # This will be reported when checking the app
+                pass
+        common.prefetch(vcslist, options.prefetch)
+
+    # The changes are written and committed in the order of the apps, so
+    # the result doesn't depend on how the checks were scheduled
+    try:
+        for app, commitmsg, duration in checkupdates_apps(toprocess, options.jobs):
+            write_update(app, commitmsg)
+            history.record(app['id'],
+                           app['Current Version Code'] != oldvercodes[app['id']],
+                           duration)
+    finally:
+        history.writeifchanged()
+        if http_fetcher:
+            http_fetcher.save()
 
     logging.info("Finished.")
 
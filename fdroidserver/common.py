@@ -24,15 +24,20 @@ import shutil
 import glob
 import stat
 import subprocess
+import errno
+import tempfile
+import collections
 import time
-import operator
-import Queue
+import hashlib
 import threading
+import multiprocessing.dummy
+import operator
 import magic
 import logging
 from distutils.version import LooseVersion
 
 import metadata
+import axml
 
 config = None
 options = None
@@ -52,6 +57,18 @@ def get_default_config():
         'stats_to_carbon': False,
         'repo_maxage': 0,
         'build_server_always': False,
+        'build_job_cpus': 1,
+        'build_job_memory': 0,
+        'build_failure_ttl': 604800,
+        'checkupdates_host_jobs': 2,
+        'checkupdates_host_delay': 1,
+        'gplay_interval': 2,
+        'gplay_burst': 10,
+        'gplay_cache_ttl': 86400,
+        'checkupdates_backoff': 0.25,
+        'checkupdates_min_interval': 1,
+        'checkupdates_max_interval': 30,
+        'checkupdates_time_budget': 0,
         'keystore': os.path.join(os.getenv("HOME"), '.local', 'share', 'fdroidserver', 'keystore.jks'),
         'smartcardoptions': [],
         'char_limits': {
@@ -323,7 +340,26 @@ def getcvname(app):
     return '%s (%s)' % (app['Current Version'], app['Current Version Code'])
 
 
+# The vcs objects handed out by getvcs, by type, remote and local path. Reusing
+# them means that a repository only gets refreshed from its remote once per
+# run, however many times it is used.
+vcs_registry = {}
+vcs_registry_lock = threading.Lock()
+
+
 def getvcs(vcstype, remote, local):
+    if vcstype == 'srclib':
+        if local != 'build/srclib/' + remote:
+            raise VCSException("Error: srclib paths are hard-coded!")
+        return getsrclib(remote, 'build/srclib', raw=True)
+    key = (vcstype, remote, os.path.normpath(local))
+    with vcs_registry_lock:
+        if key not in vcs_registry:
+            vcs_registry[key] = newvcs(vcstype, remote, local)
+        return vcs_registry[key]
+
+
+def newvcs(vcstype, remote, local):
     if vcstype == 'git':
         return vcs_git(remote, local)
     if vcstype == 'svn':
@@ -334,13 +370,78 @@ def getvcs(vcstype, remote, local):
         return vcs_hg(remote, local)
     if vcstype == 'bzr':
         return vcs_bzr(remote, local)
-    if vcstype == 'srclib':
-        if local != 'build/srclib/' + remote:
-            raise VCSException("Error: srclib paths are hard-coded!")
-        return getsrclib(remote, 'build/srclib', raw=True)
     raise VCSException("Invalid vcs type " + vcstype)
 
 
+def prefetch(vcslist, jobs):
+    """Clone or update the given repositories, up to jobs of them at once.
+
+    This gets the network work out of the way before the repositories are
+    used. Errors are only logged here, as they come up again when the
+    repository is used.
+    """
+    unique = {}
+    for vcs in vcslist:
+        unique.setdefault(os.path.normpath(vcs.local), vcs)
+    vcslist = unique.values()
+    if not vcslist:
+        return
+
+    def fetch(vcs):
+        try:
+            vcs.prefetch()
+        except VCSException as e:
+            logging.warn("Could not fetch %s: %s" % (vcs.remote, e.value))
+
+    logging.info("Fetching %d repositories using %d threads"
+                 % (len(vcslist), jobs))
+    pool = multiprocessing.dummy.Pool(jobs)
+    try:
+        pool.map(fetch, vcslist, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def srclibname(spec):
+    """The name of the srclib in a srclib spec like 1:name/subdir@ref"""
+    name = spec.split('@')[0]
+    if ':' in name:
+        name = name.split(':', 1)[1]
+    return name.split('/', 1)[0]
+
+
+def getsrclibsvcs(builds):
+    """The vcs objects of all the srclibs used by the given builds"""
+    vcslist = []
+    for build in builds:
+        for spec in build['srclibs']:
+            name = srclibname(spec)
+            if name in metadata.srclibs:
+                vcslist.append(getsrclib(name, 'build/srclib', raw=True))
+    return vcslist
+
+
+# Local mirrors of the remote repositories, shared by all the checkouts of
+# the same remote. They are updated once per run, so the checkouts can be
+# created and refreshed from them without going to the network every time.
+mirrors_dir = os.path.join('build', '.mirrors')
+
+# The state of the mirrors in this run, by path: True once updated, False
+# if updating failed. The locks make sure that only one thread at a time
+# updates a mirror.
+mirror_state = {}
+mirror_locks = {}
+mirror_locks_lock = threading.Lock()
+
+
+def getmirrorlock(path):
+    with mirror_locks_lock:
+        if path not in mirror_locks:
+            mirror_locks[path] = threading.Lock()
+        return mirror_locks[path]
+
+
 def getsrclibvcs(name):
     if name not in metadata.srclibs:
         raise VCSException("Missing srclib " + name)
@@ -364,6 +465,7 @@ class vcs:
         self.clone_failed = False
         self.refreshed = False
         self.srclib = None
+        self.tagtimes = None
 
     def repotype(self):
         return None
@@ -380,6 +482,11 @@ class vcs:
         if self.clone_failed:
             raise VCSException("Downloading the repository already failed once, not trying again.")
 
+        # The tags can only change while the repository hasn't been
+        # refreshed yet
+        if not self.refreshed:
+            self.tagtimes = None
+
         # The .fdroidvcs-id file for a repo tells us what VCS type
         # and remote that directory was created from, allowing us to drop it
         # automatically if either of those things changes.
@@ -413,11 +520,69 @@ class vcs:
             with open(fdpath, 'w') as f:
                 f.write(cdata)
 
+    # Check whether rev is an immutable revision id that is already in the
+    # local repository (or the one at path), in which case there is no need
+    # to refresh it from the remote to check it out. Branches, tags and the
+    # like could have moved, so they never count.
+    def haverevision(self, rev, path=None):
+        return False
+
+    # Clone or update the local repository ahead of time, so that the later
+    # calls to gotorevision don't need to go to the network.
+    def prefetch(self):
+        self.gotorevision(None)
+        self.refreshed = True
+
     # Derived classes need to implement this. It's called once basic checking
     # has been performend.
     def gotorevisionx(self, rev):
         raise VCSException("This VCS type doesn't define gotorevisionx")
 
+    # The path of the local mirror of the remote repository
+    def mirrorpath(self):
+        key = hashlib.sha1(self.repotype() + ' ' + self.remote).hexdigest()
+        return os.path.abspath(os.path.join(mirrors_dir, key + '.' + self.repotype()))
+
+    # Create or update the local mirror of the remote repository, if that
+    # hasn't been done yet in this run, and return its path. Returns None if
+    # that failed, in which case the remote has to be used directly. If the
+    # mirror already has rev, it is used as it is.
+    def getmirror(self, rev=None):
+        path = self.mirrorpath()
+        with getmirrorlock(path):
+            if (path not in mirror_state and os.path.exists(path)
+                    and self.haverevision(rev, path)):
+                return path
+            if path not in mirror_state:
+                try:
+                    if os.path.exists(path):
+                        logging.debug("Updating mirror of %s" % self.remote)
+                        self.updatemirror(path)
+                    else:
+                        logging.debug("Creating mirror of %s" % self.remote)
+                        if not os.path.isdir(mirrors_dir):
+                            os.makedirs(mirrors_dir)
+                        tmppath = path + '.tmp'
+                        if os.path.exists(tmppath):
+                            shutil.rmtree(tmppath)
+                        self.createmirror(tmppath)
+                        os.rename(tmppath, path)
+                    mirror_state[path] = True
+                except VCSException as e:
+                    logging.warn("Could not update the mirror of %s, using the remote directly: %s"
+                                 % (self.remote, e.value))
+                    mirror_state[path] = False
+        if mirror_state[path]:
+            return path
+        return None
+
+    # Derived classes that support mirrors need to implement these
+    def createmirror(self, path):
+        raise VCSException("This VCS type doesn't support mirrors")
+
+    def updatemirror(self, path):
+        raise VCSException("This VCS type doesn't support mirrors")
+
     # Initialise and update submodules
     def initsubmodules(self):
         raise VCSException('Submodules not supported for this vcs type')
@@ -426,14 +591,31 @@ class vcs:
     def gettags(self):
         raise VCSException('gettags not supported for this vcs type')
 
-    # Get a list of latest number tags
-    def latesttags(self, number):
+    # Get the times of all the tags, as a dict of tag names to unix times.
+    # Derived classes need to implement this to support latesttags.
+    def gettagtimes(self):
         raise VCSException('latesttags not supported for this vcs type')
 
+    # Get the latest number tags out of alltags, ordered from oldest to
+    # newest. The tag times are only looked up once until the repository
+    # gets refreshed.
+    def latesttags(self, alltags, number):
+        if self.tagtimes is None:
+            self.tagtimes = self.gettagtimes()
+        tags = [(self.tagtimes[tag], tag) for tag in alltags
+                if tag in self.tagtimes]
+        return [tag for _, tag in sorted(tags)[-number:]]
+
     # Get current commit reference (hash, revision, etc)
     def getref(self):
         raise VCSException('getref not supported for this vcs type')
 
+    # Get the contents of a file at the given revision, without checking it
+    # out. path is relative to the root of the repository. Returns None if
+    # the file doesn't exist at that revision.
+    def getfile(self, rev, path):
+        raise VCSException('getfile not supported for this vcs type')
+
     # Returns the srclib (name, path) used in setting up the current
     # revision, or None.
     def getsrclib(self):
@@ -455,14 +637,62 @@ class vcs_git(vcs):
         if not result.endswith(self.local):
             raise VCSException('Repository mismatch')
 
+    def haverevision(self, rev, path=None):
+        if not rev or not re.match(r'^[0-9a-f]{40}$', rev):
+            return False
+        p = SilentPopen(['git', 'cat-file', '-e', rev + '^{commit}'], cwd=path or self.local)
+        return p.returncode == 0
+
+    # The mirror is a bare repository with the branches and tags of the
+    # remote, and its HEAD pointing at the default branch of the remote
+    def createmirror(self, path):
+        p = FDroidPopen(['git', 'clone', '--bare', self.remote, path])
+        if p.returncode != 0:
+            raise VCSException("Git clone failed", p.output)
+
+    def updatemirror(self, path):
+        p = FDroidPopen(['git', 'fetch', '--prune', 'origin',
+                         '+refs/heads/*:refs/heads/*',
+                         '+refs/tags/*:refs/tags/*'], cwd=path)
+        if p.returncode != 0:
+            raise VCSException("Git fetch failed", p.output)
+
+    # Point origin/HEAD at the default branch of the remote, as git clone
+    # would do it, in case it disappeared
+    def sethead(self, mirror):
+        if mirror:
+            p = SilentPopen(['git', 'symbolic-ref', 'HEAD'], cwd=mirror)
+            if p.returncode == 0:
+                branch = p.output.strip().replace('refs/heads/', '', 1)
+                p = SilentPopen(['git', 'remote', 'set-head', 'origin', branch], cwd=self.local)
+                if p.returncode == 0:
+                    return
+        p = SilentPopen(['git', 'remote', 'set-head', 'origin', '--auto'], cwd=self.local)
+        if p.returncode != 0:
+            lines = p.output.splitlines()
+            if 'Multiple remote HEAD branches' not in lines[0]:
+                raise VCSException("Git remote set-head failed", p.output)
+            branch = lines[1].split(' ')[-1]
+            p2 = SilentPopen(['git', 'remote', 'set-head', 'origin', branch], cwd=self.local)
+            if p2.returncode != 0:
+                raise VCSException("Git remote set-head failed", p.output + '\n' + p2.output)
+
     def gotorevisionx(self, rev):
         if not os.path.exists(self.local):
-            # Brand new checkout
-            p = FDroidPopen(['git', 'clone', self.remote, self.local])
+            # Brand new checkout, made from the mirror if there is one. A
+            # local clone hard-links the objects, so it costs neither network
+            # nor disk space, and doesn't depend on the mirror afterwards.
+            mirror = self.getmirror(rev)
+            p = FDroidPopen(['git', 'clone', mirror or self.remote, self.local])
             if p.returncode != 0:
                 self.clone_failed = True
                 raise VCSException("Git clone failed", p.output)
             self.checkrepo()
+            if mirror:
+                p = SilentPopen(['git', 'remote', 'set-url', 'origin', self.remote], cwd=self.local)
+                if p.returncode != 0:
+                    raise VCSException("Git remote set-url failed", p.output)
+            self.refreshed = mirror is None or mirror_state.get(mirror, False)
         else:
             self.checkrepo()
             # Discard any working tree changes
@@ -474,24 +704,24 @@ class vcs_git(vcs):
             p = SilentPopen(['git', 'clean', '-dffx'], cwd=self.local)
             if p.returncode != 0:
                 raise VCSException("Git clean failed", p.output)
-            if not self.refreshed:
-                # Get latest commits and tags from remote
-                p = FDroidPopen(['git', 'fetch', 'origin'], cwd=self.local)
-                if p.returncode != 0:
-                    raise VCSException("Git fetch failed", p.output)
-                p = SilentPopen(['git', 'fetch', '--prune', '--tags', 'origin'], cwd=self.local)
-                if p.returncode != 0:
-                    raise VCSException("Git fetch failed", p.output)
-                # Recreate origin/HEAD as git clone would do it, in case it disappeared
-                p = SilentPopen(['git', 'remote', 'set-head', 'origin', '--auto'], cwd=self.local)
-                if p.returncode != 0:
-                    lines = p.output.splitlines()
-                    if 'Multiple remote HEAD branches' not in lines[0]:
-                        raise VCSException("Git remote set-head failed", p.output)
-                    branch = lines[1].split(' ')[-1]
-                    p2 = SilentPopen(['git', 'remote', 'set-head', 'origin', branch], cwd=self.local)
-                    if p2.returncode != 0:
-                        raise VCSException("Git remote set-head failed", p.output + '\n' + p2.output)
+            if not self.refreshed and not self.haverevision(rev):
+                mirror = self.getmirror()
+                if mirror:
+                    # Get latest commits and tags from the mirror
+                    p = SilentPopen(['git', 'fetch', '--prune', mirror,
+                                     '+refs/heads/*:refs/remotes/origin/*',
+                                     '+refs/tags/*:refs/tags/*'], cwd=self.local)
+                    if p.returncode != 0:
+                        raise VCSException("Git fetch failed", p.output)
+                else:
+                    # Get latest commits and tags from remote
+                    p = FDroidPopen(['git', 'fetch', 'origin'], cwd=self.local)
+                    if p.returncode != 0:
+                        raise VCSException("Git fetch failed", p.output)
+                    p = SilentPopen(['git', 'fetch', '--prune', '--tags', 'origin'], cwd=self.local)
+                    if p.returncode != 0:
+                        raise VCSException("Git fetch failed", p.output)
+                self.sethead(mirror)
                 self.refreshed = True
         # origin/HEAD is the HEAD of the remote, e.g. the "default branch" on
         # a github repo. Most of the time this is the same as origin/master.
@@ -538,13 +768,27 @@ class vcs_git(vcs):
         p = SilentPopen(['git', 'tag'], cwd=self.local)
         return p.output.splitlines()
 
-    def latesttags(self, alltags, number):
+    def getfile(self, rev, path):
+        p = SilentPopen(['git', 'cat-file', 'blob', '%s:%s' % (rev, path)], cwd=self.local)
+        if p.returncode != 0:
+            return None
+        return p.output
+
+    # Tags are timed by the author date of the commit they point to, and
+    # tags that don't point to a commit are left out
+    def gettagtimes(self):
         self.checkrepo()
-        p = SilentPopen(['echo "' + '\n'.join(alltags) + '" | '
-                        + 'xargs -I@ git log --format=format:"%at @%n" -1 @ | '
-                        + 'sort -n | awk \'{print $2}\''],
-                        cwd=self.local, shell=True)
-        return p.output.splitlines()[-number:]
+        p = SilentPopen(['git', 'for-each-ref', '--format=%(refname)\t%(authordate:raw)\t%(*authordate:raw)',
+                         'refs/tags'], cwd=self.local)
+        if p.returncode != 0:
+            raise VCSException("Git for-each-ref failed", p.output)
+        tagtimes = {}
+        for line in p.iterlines():
+            ref, date, tagdate = line.split('\t')
+            date = date or tagdate
+            if date:
+                tagtimes[ref[len('refs/tags/'):]] = int(date.split()[0])
+        return tagtimes
 
 
 class vcs_gitsvn(vcs):
@@ -569,31 +813,93 @@ class vcs_gitsvn(vcs):
         if not result.endswith(self.local):
             raise VCSException('Repository mismatch')
 
+    def svnclone(self, path):
+        gitsvn_cmd = '%sgit svn clone%s' % self.userargs()
+        if ';' in self.remote:
+            remote_split = self.remote.split(';')
+            for i in remote_split[1:]:
+                if i.startswith('trunk='):
+                    gitsvn_cmd += ' -T %s' % i[6:]
+                elif i.startswith('tags='):
+                    gitsvn_cmd += ' -t %s' % i[5:]
+                elif i.startswith('branches='):
+                    gitsvn_cmd += ' -b %s' % i[9:]
+            p = SilentPopen([gitsvn_cmd + " %s %s" % (remote_split[0], path)], shell=True)
+        else:
+            p = SilentPopen([gitsvn_cmd + " %s %s" % (self.remote, path)], shell=True)
+        if p.returncode != 0:
+            raise VCSException("Git clone failed", p.output)
+
+    # git svn can't fetch from another git-svn clone, so the mirror is a
+    # full git-svn clone. Checkouts get its commits and refs with plain git,
+    # and a copy of the git-svn metadata, which is small.
+    def createmirror(self, path):
+        self.svnclone(path)
+
+    def updatemirror(self, path):
+        p = SilentPopen(['%sgit svn fetch %s' % self.userargs()], cwd=path, shell=True)
+        if p.returncode != 0:
+            raise VCSException("Git svn fetch failed")
+        p = SilentPopen(['%sgit svn rebase %s' % self.userargs()], cwd=path, shell=True)
+        if p.returncode != 0:
+            raise VCSException("Git svn rebase failed", p.output)
+
+    # Make a new checkout from the mirror. A local clone hardlinks the
+    # objects rather than copying them.
+    def clonemirror(self, mirror):
+        p = SilentPopen(['git', 'clone', '--no-checkout', mirror, self.local])
+        if p.returncode != 0:
+            raise VCSException("Git clone failed", p.output)
+        # Its remote-tracking refs would clash with the git-svn ones
+        p = SilentPopen(['git', 'config', '--remove-section', 'remote.origin'],
+                        cwd=self.local)
+        if p.returncode != 0:
+            raise VCSException("Git config failed", p.output)
+        self.syncmirror(mirror)
+
+    # Bring the refs and git-svn metadata of the checkout in line with the
+    # mirror, fetching only the objects it doesn't have yet
+    def syncmirror(self, mirror):
+        p = SilentPopen(['git', 'fetch', '--prune', '--update-head-ok',
+                         mirror, '+refs/*:refs/*'], cwd=self.local)
+        if p.returncode != 0:
+            raise VCSException("Git fetch failed", p.output)
+        p = SilentPopen(['git', 'config', '-f', os.path.join(mirror, '.git', 'config'),
+                         '--get-regexp', r'^(svn|svn-remote\..*)\.'])
+        svnconfig = [l.split(' ', 1) for l in p.output.splitlines() if l]
+        for section in set(k.rsplit('.', 1)[0] for k, _ in svnconfig):
+            SilentPopen(['git', 'config', '--remove-section', section], cwd=self.local)
+        for kv in svnconfig:
+            p = SilentPopen(['git', 'config', '--add'] + kv, cwd=self.local)
+            if p.returncode != 0:
+                raise VCSException("Git config failed", p.output)
+        svndir = os.path.join(self.local, '.git', 'svn')
+        if os.path.exists(svndir):
+            shutil.rmtree(svndir)
+        if os.path.exists(os.path.join(mirror, '.git', 'svn')):
+            shutil.copytree(os.path.join(mirror, '.git', 'svn'), svndir, symlinks=True)
+
     def gotorevisionx(self, rev):
         if not os.path.exists(self.local):
             # Brand new checkout
-            gitsvn_cmd = '%sgit svn clone%s' % self.userargs()
-            if ';' in self.remote:
-                remote_split = self.remote.split(';')
-                for i in remote_split[1:]:
-                    if i.startswith('trunk='):
-                        gitsvn_cmd += ' -T %s' % i[6:]
-                    elif i.startswith('tags='):
-                        gitsvn_cmd += ' -t %s' % i[5:]
-                    elif i.startswith('branches='):
-                        gitsvn_cmd += ' -b %s' % i[9:]
-                p = SilentPopen([gitsvn_cmd + " %s %s" % (remote_split[0], self.local)], shell=True)
-                if p.returncode != 0:
-                    self.clone_failed = True
-                    raise VCSException("Git clone failed", p.output)
+            mirror = self.getmirror()
+            if mirror:
+                self.clonemirror(mirror)
             else:
-                p = SilentPopen([gitsvn_cmd + " %s %s" % (self.remote, self.local)], shell=True)
-                if p.returncode != 0:
+                try:
+                    self.svnclone(self.local)
+                except VCSException:
                     self.clone_failed = True
-                    raise VCSException("Git clone failed", p.output)
+                    raise
             self.checkrepo()
+            self.refreshed = True
         else:
             self.checkrepo()
+            if not self.refreshed and self.getmirror():
+                # Get new commits, branches and tags from the mirror, which
+                # may move the checked out branch
+                self.syncmirror(self.mirrorpath())
+                self.refreshed = True
             # Discard any working tree changes
             p = SilentPopen(['git', 'reset', '--hard'], cwd=self.local)
             if p.returncode != 0:
@@ -732,7 +1038,7 @@ class vcs_hg(vcs):
             p = SilentPopen(['hg status -uS | xargs rm -rf'], cwd=self.local, shell=True)
             if p.returncode != 0:
                 raise VCSException("Hg clean failed", p.output)
-            if not self.refreshed:
+            if not self.refreshed and not self.haverevision(rev):
                 p = SilentPopen(['hg', 'pull'], cwd=self.local)
                 if p.returncode != 0:
                     raise VCSException("Hg pull failed", p.output)
@@ -755,10 +1061,34 @@ class vcs_hg(vcs):
         elif p.returncode != 0:
             raise VCSException("HG purge failed", p.output)
 
+    def haverevision(self, rev, path=None):
+        if not rev or not re.match(r'^[0-9a-f]{40}$', rev):
+            return False
+        p = SilentPopen(['hg', 'log', '-r', rev, '--template', '{node}'], cwd=path or self.local)
+        return p.returncode == 0 and p.output.strip() == rev
+
     def gettags(self):
         p = SilentPopen(['hg', 'tags', '-q'], cwd=self.local)
         return p.output.splitlines()[1:]
 
+    def getfile(self, rev, path):
+        p = SilentPopen(['hg', 'cat', '-r', rev, path], cwd=self.local)
+        if p.returncode != 0:
+            return None
+        return p.output
+
+    def gettagtimes(self):
+        p = SilentPopen(['hg', 'log', '-r', 'tag()', '--template', '{date|hgdate}\t{tags}\n'],
+                        cwd=self.local)
+        if p.returncode != 0:
+            raise VCSException("Hg log failed", p.output)
+        tagtimes = {}
+        for line in p.iterlines():
+            date, tags = line.split('\t', 1)
+            for tag in tags.split():
+                tagtimes[tag] = int(date.split()[0])
+        return tagtimes
+
 
 class vcs_bzr(vcs):
 
@@ -775,7 +1105,7 @@ class vcs_bzr(vcs):
             p = SilentPopen(['bzr', 'clean-tree', '--force', '--unknown', '--ignored'], cwd=self.local)
             if p.returncode != 0:
                 raise VCSException("Bzr revert failed", p.output)
-            if not self.refreshed:
+            if not self.refreshed and not self.haverevision(rev):
                 p = SilentPopen(['bzr', 'pull'], cwd=self.local)
                 if p.returncode != 0:
                     raise VCSException("Bzr update failed", p.output)
@@ -786,45 +1116,157 @@ class vcs_bzr(vcs):
         if p.returncode != 0:
             raise VCSException("Bzr revert of '%s' failed" % rev, p.output)
 
+    # Only revision ids are immutable, revision numbers can change when a
+    # branch is pulled
+    def haverevision(self, rev, path=None):
+        if not rev or not rev.startswith('revid:'):
+            return False
+        p = SilentPopen(['bzr', 'log', '-r', rev, '--line'], cwd=path or self.local)
+        return p.returncode == 0
+
     def gettags(self):
         p = SilentPopen(['bzr', 'tags'], cwd=self.local)
         return [tag.split('   ')[0].strip() for tag in
                 p.output.splitlines()]
 
+    def getfile(self, rev, path):
+        p = SilentPopen(['bzr', 'cat', '-r', rev, path], cwd=self.local)
+        if p.returncode != 0:
+            return None
+        return p.output
 
-def retrieve_string(app_dir, string, xmlfiles=None):
+    # bzr doesn't give out the times of tags, but can sort them by time, so
+    # the position of each tag in that order stands in for its time
+    def gettagtimes(self):
+        p = SilentPopen(['bzr', 'tags', '--sort=time'], cwd=self.local)
+        if p.returncode != 0:
+            raise VCSException("Bzr tags failed", p.output)
+        return dict((line.split('   ')[0].strip(), i) for i, line in
+                    enumerate(p.iterlines()))
+
+
+class StringIndex:
+    """The string resources of an app, read from the XML files in its
+    values directories in one go.
 
+    Like when looking a name up line by line, the first line that gives a
+    value for a name wins. The lines declaring entities are kept as they
+    are, as entities are looked up by substring.
+    """
+
+    name_search = re.compile(r'name="([^"]*)"').finditer
+    value_match = re.compile(r'.*?>([^<]+?)<').match
+
+    def __init__(self, xmlfiles):
+        self.strings = {}
+        self.entity_lines = []
+        for xmlfile in xmlfiles:
+            for line in file(xmlfile):
+                if '<!ENTITY' in line:
+                    self.entity_lines.append(line)
+                found = {}
+                for m in self.name_search(line):
+                    value = self.value_match(line, m.end())
+                    if value:
+                        found[m.group(1)] = value.group(1)
+                for name, value in found.iteritems():
+                    if name not in self.strings:
+                        self.strings[name] = value
+
+    def lookup(self, string):
+        """Get the value that a @string/ or &entity; reference points to, or
+        None if it isn't defined"""
+        if string.startswith('@string/'):
+            return self.strings.get(string[8:])
+        entity_search = re.compile(r'.*<!ENTITY.*' + string[1:-1] + '.*?"([^"]+?)".*>').search
+        for line in self.entity_lines:
+            matches = entity_search(line)
+            if matches:
+                return matches.group(1)
+        return None
+
+
+# The string indexes of the app directories used recently, by directory. Each
+# comes with the modification times of the directories and files it was made
+# from, so that it is only used while none of them has changed. They are
+# shared by the checkupdates threads, so all access goes through the lock.
+string_indexes = collections.OrderedDict()
+string_indexes_lock = threading.Lock()
+max_string_indexes = 64
+
+
+def get_string_index(app_dir):
     res_dirs = [
         os.path.join(app_dir, 'res'),
         os.path.join(app_dir, 'src/main'),
         ]
 
-    if xmlfiles is None:
-        xmlfiles = []
-        for res_dir in res_dirs:
-            for r, d, f in os.walk(res_dir):
-                if r.endswith('/values'):
-                    xmlfiles += [os.path.join(r, x) for x in f if x.endswith('.xml')]
-
-    string_search = None
-    if string.startswith('@string/'):
-        string_search = re.compile(r'.*name="' + string[8:] + '".*?>([^<]+?)<.*').search
-    elif string.startswith('&') and string.endswith(';'):
-        string_search = re.compile(r'.*<!ENTITY.*' + string[1:-1] + '.*?"([^"]+?)".*>').search
-
-    if string_search is not None:
-        for xmlfile in xmlfiles:
-            for line in file(xmlfile):
-                matches = string_search(line)
-                if matches:
-                    return retrieve_string(app_dir, matches.group(1), xmlfiles)
-        return None
+    def stamp(paths):
+        stamps = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamps.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                stamps.append((path, None, None))
+        return stamps
+
+    with string_indexes_lock:
+        cached = string_indexes.pop(app_dir, None)
+        if cached is not None:
+            string_indexes[app_dir] = cached
+    if cached is not None:
+        paths, stamps, index = cached
+        if stamp(paths) == stamps:
+            return index
+
+    valuesdirs = []
+    xmlfiles = []
+    for res_dir in res_dirs:
+        for r, d, f in os.walk(res_dir):
+            if r.endswith('/values'):
+                valuesdirs.append(r)
+                xmlfiles += [os.path.join(r, x) for x in f if x.endswith('.xml')]
+
+    # Any values directory coming or going changes the modification time of
+    # one of these
+    paths = list(res_dirs)
+    for valuesdir in valuesdirs:
+        paths += [os.path.dirname(valuesdir), valuesdir]
+    paths += xmlfiles
+    stamps = stamp(paths)
+
+    index = StringIndex(xmlfiles)
+    with string_indexes_lock:
+        string_indexes.pop(app_dir, None)
+        string_indexes[app_dir] = (paths, stamps, index)
+        while len(string_indexes) > max_string_indexes:
+            string_indexes.popitem(last=False)
+    return index
+
 
-    return string.replace("\\'", "'")
+def retrieve_string(app_dir, string, xmlfiles=None):
+
+    if xmlfiles is None:
+        index = get_string_index(app_dir)
+    else:
+        index = StringIndex(xmlfiles)
+
+    # Follow references to other strings, but not round in circles
+    for i in range(16):
+        if not (string.startswith('@string/')
+                or (string.startswith('&') and string.endswith(';'))):
+            return string.replace("\\'", "'")
+        string = index.lookup(string)
+        if string is None:
+            return None
+    return None
 
 
-# Return list of existing files that will be used to find the highest vercode
-def manifest_paths(app_dir, flavour):
+# Get the paths of the manifests and gradle files of an app that exist.
+# isfile can be used to check for them somewhere other than the working tree,
+# like in vcs.getfile.
+def manifest_paths(app_dir, flavour, isfile=os.path.isfile):
 
     possible_manifests = \
         [os.path.join(app_dir, 'AndroidManifest.xml'),
@@ -836,7 +1278,7 @@ def manifest_paths(app_dir, flavour):
         possible_manifests.append(
             os.path.join(app_dir, 'src', flavour, 'AndroidManifest.xml'))
 
-    return [path for path in possible_manifests if os.path.isfile(path)]
+    return [path for path in possible_manifests if isfile(path)]
 
 
 # Retrieve the package name. Returns the name, or None if not found.
@@ -907,18 +1349,27 @@ def ant_subprojects(root_dir):
 def remove_debuggable_flags(root_dir):
     # Remove forced debuggable flags
     logging.debug("Removing debuggable flags from %s" % root_dir)
-    for root, dirs, files in os.walk(root_dir):
-        if 'AndroidManifest.xml' in files:
-            path = os.path.join(root, 'AndroidManifest.xml')
-            p = FDroidPopen(['sed', '-i', 's/android:debuggable="[^"]*"//g', path])
-            if p.returncode != 0:
-                raise BuildException("Failed to remove debuggable flags of %s" % path)
+    visit_source(root_dir, [strip_debuggable_flags])
+
+
+debuggable_flag = re.compile(r'android:debuggable="[^"]*"')
+
+
+def strip_debuggable_flags(root, dirs, files):
+    if 'AndroidManifest.xml' in files:
+        path = os.path.join(root, 'AndroidManifest.xml')
+        try:
+            regsub_file(debuggable_flag, '', path)
+        except IOError:
+            raise BuildException("Failed to remove debuggable flags of %s" % path)
 
 
-# Extract some information from the AndroidManifest.xml at the given path.
+# Get the version name, version code and package name out of the given
+# manifest and gradle files. readlines can be used to read them from somewhere
+# other than the working tree, like in vcs.getfile.
 # Returns (version, vercode, package), any or all of which might be None.
 # All values returned are strings.
-def parse_androidmanifests(paths, ignoreversions=None):
+def parse_androidmanifests(paths, ignoreversions=None, readlines=file):
 
     if not paths:
         return (None, None, None)
@@ -945,7 +1396,7 @@ def parse_androidmanifests(paths, ignoreversions=None):
         # Remember package name, may be defined separately from version+vercode
         package = max_package
 
-        for line in file(path):
+        for line in readlines(path):
             if not package:
                 if gradle:
                     matches = psearch_g(line)
@@ -1084,8 +1535,7 @@ def getsrclib(spec, srclib_dir, srclibpaths=[], subdir=None,
             place_srclib(libdir, n, s_tuple[2])
             n += 1
 
-    remove_signing_keys(sdir)
-    remove_debuggable_flags(sdir)
+    visit_source(sdir, [strip_signing_keys, strip_debuggable_flags])
 
     if prepare:
 
@@ -1095,7 +1545,7 @@ def getsrclib(spec, srclib_dir, srclibpaths=[], subdir=None,
             p = FDroidPopen(['bash', '-x', '-c', cmd], cwd=libdir)
             if p.returncode != 0:
                 raise BuildException("Error running prepare command for srclib %s"
-                                     % name, p.output)
+                                     % name, failure_detail(p, 'srclib_' + name))
 
     if basepath:
         libdir = sdir
@@ -1147,7 +1597,8 @@ def prepare_source(vcs, app, build, build_dir, srclib_dir, extlib_dir, onserver=
         p = FDroidPopen(['bash', '-x', '-c', cmd], cwd=root_dir)
         if p.returncode != 0:
             raise BuildException("Error running init command for %s:%s" %
-                                 (app['id'], build['version']), p.output)
+                                 (app['id'], build['version']),
+                                 build_failure_detail(p, app, build))
 
     # Apply patches if any
     if build['patch']:
@@ -1256,9 +1707,6 @@ def prepare_source(vcs, app, build, build_dir, srclib_dir, extlib_dir, onserver=
                          'build.gradle'],
                         cwd=root_dir)
 
-    # Remove forced debuggable flags
-    remove_debuggable_flags(root_dir)
-
     # Insert version code and number into the manifest if necessary
     if build['forceversion']:
         logging.info("Changing the version name")
@@ -1313,7 +1761,14 @@ def prepare_source(vcs, app, build, build_dir, srclib_dir, extlib_dir, onserver=
             else:
                 logging.info("...but it didn't exist")
 
-    remove_signing_keys(build_dir)
+    # Remove signing keys and forced debuggable flags, going over the source
+    # just once
+    visitors = [strip_signing_keys]
+    if is_below(root_dir, build_dir):
+        visitors.append(visit_below(root_dir, strip_debuggable_flags))
+    else:
+        remove_debuggable_flags(root_dir)
+    visit_source(build_dir, visitors)
 
     # Add required external libraries
     if build['extlibs']:
@@ -1344,7 +1799,8 @@ def prepare_source(vcs, app, build, build_dir, srclib_dir, extlib_dir, onserver=
         p = FDroidPopen(['bash', '-x', '-c', cmd], cwd=root_dir)
         if p.returncode != 0:
             raise BuildException("Error running prebuild command for %s:%s" %
-                                 (app['id'], build['version']), p.output)
+                                 (app['id'], build['version']),
+                                 build_failure_detail(p, app, build))
 
     # Generate (or update) the ant build file, build.xml...
     if build['update'] and build['update'] != ['no'] and build['type'] == 'ant':
@@ -1393,8 +1849,9 @@ def getpaths(build_dir, build, field):
 
 
 # Scan the source code in the given directory (and all subdirectories)
-# and return the number of fatal problems encountered
-def scan_source(build_dir, root_dir, thisbuild):
+# and return the number of fatal problems encountered. Any visitors given are
+# run on each directory before it is scanned, in the same walk.
+def scan_source(build_dir, root_dir, thisbuild, visitors=[]):
 
     count = 0
 
@@ -1453,14 +1910,8 @@ def scan_source(build_dir, root_dir, thisbuild):
             return True
         return False
 
-    def insidedir(path, dirname):
-        return path.endswith('/%s' % dirname) or '/%s/' % dirname in path
-
     # Iterate through all files in the source code
-    for r, d, f in os.walk(build_dir):
-
-        if any(insidedir(r, d) for d in ('.hg', '.git', '.svn', '.bzr')):
-            continue
+    for r, d, f in walk_source(build_dir, visitors):
 
         for curfile in f:
 
@@ -1598,51 +2049,102 @@ def isApkDebuggable(apkfile, config):
 
     :param apkfile: full path to the apk to check"""
 
-    p = SilentPopen([os.path.join(config['sdk_path'], 'build-tools',
-                                  config['build_tools'], 'aapt'),
-                     'dump', 'xmltree', apkfile, 'AndroidManifest.xml'])
-    if p.returncode != 0:
-        logging.critical("Failed to get apk manifest information")
+    try:
+        return axml.get_apk_info(apkfile)['debuggable']
+    except axml.AXMLException, e:
+        logging.critical("Failed to get apk manifest information: " + str(e))
         sys.exit(1)
-    for line in p.output.splitlines():
-        if 'android:debuggable' in line and not line.endswith('0x0'):
-            return True
-    return False
 
 
-class AsynchronousFileReader(threading.Thread):
-    '''
-    Helper class to implement asynchronous reading of a file
-    in a separate thread. Pushes read lines on a queue to
-    be consumed in another thread.
-    '''
+class PopenResult(object):
+    """The outcome of running a command with FDroidPopen.
+
+    The output is spooled to a temporary file, which only moves to disk once
+    it gets big, and the last tail_size bytes of it are kept in memory as
+    tail.
+    """
+
+    spool_size = 1024 * 1024
+    tail_size = 32 * 1024
+
+    def __init__(self):
+        self.returncode = None
+        self.spool = tempfile.SpooledTemporaryFile(max_size=self.spool_size)
+        self.tailchunks = collections.deque()
+        self.taillen = 0
+
+    def add(self, chunk):
+        """Add a chunk of output"""
+        self.spool.write(chunk)
+        self.tailchunks.append(chunk)
+        self.taillen += len(chunk)
+        while self.taillen - len(self.tailchunks[0]) >= self.tail_size:
+            self.taillen -= len(self.tailchunks.popleft())
+
+    @property
+    def tail(self):
+        """The end of the output"""
+        return ''.join(self.tailchunks)[-self.tail_size:]
+
+    @property
+    def output(self):
+        """The whole output. Use tail, iterlines or writelog instead where
+        the output can be big."""
+        self.spool.seek(0)
+        data = self.spool.read()
+        self.spool.seek(0, os.SEEK_END)
+        return data
+
+    def iterlines(self):
+        """Go through the output line by line, without keeping it in memory"""
+        self.spool.seek(0)
+        while True:
+            line = self.spool.readline()
+            if not line:
+                break
+            yield line.rstrip('\n')
+        self.spool.seek(0, os.SEEK_END)
 
-    def __init__(self, fd, queue):
-        assert isinstance(queue, Queue.Queue)
-        assert callable(fd.readline)
-        threading.Thread.__init__(self)
-        self._fd = fd
-        self._queue = queue
+    def writelog(self, path):
+        """Write the whole output to the given file"""
+        logdir = os.path.dirname(path)
+        if logdir and not os.path.isdir(logdir):
+            os.makedirs(logdir)
+        self.spool.seek(0)
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(self.spool, f)
+        self.spool.seek(0, os.SEEK_END)
 
-    def run(self):
-        '''The body of the tread: read lines and put them on the queue.'''
-        for line in iter(self._fd.readline, ''):
-            self._queue.put(line)
 
-    def eof(self):
-        '''Check whether there is no more content to expect.'''
-        return not self.is_alive() and self._queue.empty()
+def build_failure_detail(p, app, build):
+    """Save the whole output of a failed build step in the log directory.
+
+    :returns: the end of the output, with a pointer to the log file, for use
+              as the detail of a BuildException.
+    """
+    return failure_detail(p, '%s_%s' % (app['id'], build['vercode']))
 
 
-class PopenResult:
-    returncode = None
-    output = ''
+def failure_detail(p, logname):
+    """Like build_failure_detail, for failures that don't belong to one
+    build, saving the output in logs/<logname>.log."""
+    logpath = os.path.join('logs', logname + '.log')
+    p.writelog(logpath)
+    return p.tail + "\n\nThe full output is in " + logpath
 
 
 def SilentPopen(commands, cwd=None, shell=False):
     return FDroidPopen(commands, cwd=cwd, shell=shell, output=False)
 
 
+# A thread can set popen_output.prefix to have the output of the commands it
+# runs echoed with that in front of each line, so that the output of commands
+# running in several threads at once can be told apart. The lines are written
+# under console_lock, so that they don't get mixed up either.
+popen_output = threading.local()
+console_lock = threading.Lock()
+
+
 def FDroidPopen(commands, cwd=None, shell=False, output=True):
     """
     Run a command and capture the possibly huge output.
@@ -1663,95 +2165,186 @@ def FDroidPopen(commands, cwd=None, shell=False, output=True):
     p = subprocess.Popen(commands, cwd=cwd, shell=shell, env=env,
                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
 
-    stdout_queue = Queue.Queue()
-    stdout_reader = AsynchronousFileReader(p.stdout, stdout_queue)
-    stdout_reader.start()
+    # Read the output as it comes, until the other end is closed. This
+    # blocks in read() rather than polling, so we are done as soon as the
+    # command is.
+    echo = output or options.verbose
+    prefix = getattr(popen_output, 'prefix', None)
+    pending = ''
+    fd = p.stdout.fileno()
+    while True:
+        try:
+            chunk = os.read(fd, 65536)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not chunk:
+            break
+        if echo and prefix is None:
+            # Output directly to console
+            sys.stderr.write(chunk)
+            sys.stderr.flush()
+        elif echo:
+            # Only write whole lines, unless a line gets very long
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            if len(pending) > 65536:
+                lines.append(pending)
+                pending = ''
+            if lines:
+                with console_lock:
+                    sys.stderr.write(''.join(prefix + l + '\n' for l in lines))
+                    sys.stderr.flush()
+        result.add(chunk)
+
+    if pending:
+        with console_lock:
+            sys.stderr.write(prefix + pending + '\n')
+            sys.stderr.flush()
+
+    p.wait()
+    result.returncode = p.returncode
+    return result
 
-    # Check the queue for output (until there is no more to get)
-    while not stdout_reader.eof():
-        while not stdout_queue.empty():
-            line = stdout_queue.get()
-            if output or options.verbose:
-                # Output directly to console
-                sys.stderr.write(line)
-                sys.stderr.flush()
-            result.output += line
 
-        time.sleep(0.1)
+# Directories of version control systems, which hold nothing that needs to be
+# changed or scanned in the source
+vcs_dirs = ('.git', '.hg', '.svn', '.bzr')
 
-    p.communicate()
-    result.returncode = p.returncode
-    return result
 
+def walk_source(top, visitors=[]):
+    """Walk the source tree at top, like os.walk but leaving out the
+    directories of version control systems.
 
-def remove_signing_keys(build_dir):
-    comment = re.compile(r'[ ]*//')
-    signing_configs = re.compile(r'^[\t ]*signingConfigs[ \t]*{[ \t]*$')
-    line_matches = [
-        re.compile(r'^[\t ]*signingConfig [^ ]*$'),
-        re.compile(r'.*android\.signingConfigs\.[^{]*$'),
-        re.compile(r'.*variant\.outputFile = .*'),
-        re.compile(r'.*\.readLine\(.*'),
-        ]
-    for root, dirs, files in os.walk(build_dir):
-        if 'build.gradle' in files:
-            path = os.path.join(root, 'build.gradle')
+    Each of the visitors is called with (root, dirs, files) for every
+    directory, in order, before it is yielded. A visitor that removes a file
+    or directory should take it out of files or dirs too, so that whatever
+    comes after it doesn't look for it.
+    """
+    for root, dirs, files in os.walk(top):
+        dirs[:] = [d for d in dirs if d not in vcs_dirs]
+        for visitor in visitors:
+            visitor(root, dirs, files)
+        yield root, dirs, files
 
-            with open(path, "r") as o:
-                lines = o.readlines()
 
-            changed = False
+def visit_source(top, visitors):
+    """Run the visitors over the source tree at top, walking it just once"""
+    for root, dirs, files in walk_source(top, visitors):
+        pass
 
-            opened = 0
-            with open(path, "w") as o:
-                for line in lines:
-                    if comment.match(line):
-                        continue
 
-                    if opened > 0:
-                        opened += line.count('{')
-                        opened -= line.count('}')
-                        continue
+def is_below(path, top):
+    path = os.path.normpath(path)
+    top = os.path.normpath(top)
+    return path == top or path.startswith(top + os.sep)
 
-                    if signing_configs.match(line):
-                        changed = True
-                        opened += 1
-                        continue
 
-                    if any(s.match(line) for s in line_matches):
-                        changed = True
-                        continue
+def visit_below(top, visitor):
+    """Make a visitor that only passes on the directories at or below top to
+    the given one"""
 
-                    if opened == 0:
-                        o.write(line)
+    def visit(root, dirs, files):
+        if is_below(root, top):
+            visitor(root, dirs, files)
 
-            if changed:
-                logging.info("Cleaned build.gradle of keysigning configs at %s" % path)
+    return visit
 
-        for propfile in [
-                'project.properties',
-                'build.properties',
-                'default.properties',
-                'ant.properties',
-                ]:
-            if propfile in files:
-                path = os.path.join(root, propfile)
 
-                with open(path, "r") as o:
-                    lines = o.readlines()
+def replace_file(path, lines):
+    """Replace the file at path with a new one holding the given lines, like
+    'sed -i' does. Writing through the old file would follow a symlink or a
+    hard link out of the source tree, so a new file is renamed over it."""
+    mode = stat.S_IMODE(os.stat(path).st_mode)
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.writelines(lines)
+        os.chmod(tmppath, mode)
+        os.rename(tmppath, path)
+    except:
+        os.remove(tmppath)
+        raise
+
+
+def regsub_file(pattern, repl, path):
+    """Do the substitution on each line of the file at path, like 'sed -i'
+    would. The file is only written back if anything changed."""
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    newlines = [pattern.sub(repl, line) for line in lines]
+    if newlines != lines:
+        replace_file(path, newlines)
+
+
+signing_comment = re.compile(r'[ ]*//')
+signing_configs = re.compile(r'^[\t ]*signingConfigs[ \t]*{[ \t]*$')
+signing_line_matches = [
+    re.compile(r'^[\t ]*signingConfig [^ ]*$'),
+    re.compile(r'.*android\.signingConfigs\.[^{]*$'),
+    re.compile(r'.*variant\.outputFile = .*'),
+    re.compile(r'.*\.readLine\(.*'),
+    ]
+
+
+def strip_signing_keys(root, dirs, files):
+    if 'build.gradle' in files:
+        path = os.path.join(root, 'build.gradle')
+
+        with open(path, "r") as o:
+            lines = o.readlines()
+
+        changed = False
+
+        opened = 0
+        newlines = []
+        for line in lines:
+            if signing_comment.match(line):
+                continue
+
+            if opened > 0:
+                opened += line.count('{')
+                opened -= line.count('}')
+                continue
+
+            if signing_configs.match(line):
+                changed = True
+                opened += 1
+                continue
+
+            if any(s.match(line) for s in signing_line_matches):
+                changed = True
+                continue
+
+            if opened == 0:
+                newlines.append(line)
 
-                changed = False
+        if newlines != lines:
+            replace_file(path, newlines)
 
-                with open(path, "w") as o:
-                    for line in lines:
-                        if any(line.startswith(s) for s in ('key.store', 'key.alias')):
-                            changed = True
-                            continue
+        if changed:
+            logging.info("Cleaned build.gradle of keysigning configs at %s" % path)
 
-                        o.write(line)
+    for propfile in [
+            'project.properties',
+            'build.properties',
+            'default.properties',
+            'ant.properties',
+            ]:
+        if propfile in files:
+            path = os.path.join(root, propfile)
 
-                if changed:
-                    logging.info("Cleaned %s of keysigning configs at %s" % (propfile, path))
+            with open(path, "r") as o:
+                lines = o.readlines()
+
+            newlines = [line for line in lines
+                        if not any(line.startswith(s) for s in ('key.store', 'key.alias'))]
+            changed = newlines != lines
+
+            if changed:
+                replace_file(path, newlines)
+                logging.info("Cleaned %s of keysigning configs at %s" % (propfile, path))
 
 
 def replace_config_vars(cmd):
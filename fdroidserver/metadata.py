@@ -21,6 +21,8 @@ import os
 import re
 import glob
 import cgi
+import cPickle
+import tempfile
 import logging
 
 from collections import OrderedDict
@@ -225,7 +227,8 @@ def check_metadata(info):
 
 # Formatter for descriptions. Create an instance, and call parseline() with
 # each line of the description source from the metadata. At the end, call
-# end() and then text_plain, text_wiki and text_html will contain the result.
+# end() and then text_plain, text_wiki and text_html will contain the result,
+# and links the app ids that were resolved with what they resolved to.
 class DescriptionFormatter:
     stNONE = 0
     stPARA = 1
@@ -241,6 +244,11 @@ class DescriptionFormatter:
 
     def __init__(self, linkres):
         self.linkResolver = linkres
+        self.links = {}
+        # The output is collected in lists and only joined at the end
+        self.plain = []
+        self.wiki = []
+        self.html = []
 
     def endcur(self, notstates=None):
         if notstates and self.state in notstates:
@@ -253,54 +261,54 @@ class DescriptionFormatter:
             self.endol()
 
     def endpara(self):
-        self.text_plain += '\n'
-        self.text_html += '</p>'
+        self.plain.append('\n')
+        self.html.append('</p>')
         self.state = self.stNONE
 
     def endul(self):
-        self.text_html += '</ul>'
+        self.html.append('</ul>')
         self.state = self.stNONE
 
     def endol(self):
-        self.text_html += '</ol>'
+        self.html.append('</ol>')
         self.state = self.stNONE
 
-    def formatted(self, txt, html):
-        formatted = ''
+    def formatted(self, txt, html, out):
         if html:
             txt = cgi.escape(txt)
         while True:
             index = txt.find("''")
             if index == -1:
-                return formatted + txt
-            formatted += txt[:index]
+                out.append(txt)
+                return
+            out.append(txt[:index])
             txt = txt[index:]
             if txt.startswith("'''"):
                 if html:
                     if self.bold:
-                        formatted += '</b>'
+                        out.append('</b>')
                     else:
-                        formatted += '<b>'
+                        out.append('<b>')
                 self.bold = not self.bold
                 txt = txt[3:]
             else:
                 if html:
                     if self.ital:
-                        formatted += '</i>'
+                        out.append('</i>')
                     else:
-                        formatted += '<i>'
+                        out.append('<i>')
                 self.ital = not self.ital
                 txt = txt[2:]
 
     def linkify(self, txt):
-        linkified_plain = ''
-        linkified_html = ''
         while True:
             index = txt.find("[")
             if index == -1:
-                return (linkified_plain + self.formatted(txt, False), linkified_html + self.formatted(txt, True))
-            linkified_plain += self.formatted(txt[:index], False)
-            linkified_html += self.formatted(txt[:index], True)
+                self.formatted(txt, False, self.plain)
+                self.formatted(txt, True, self.html)
+                return
+            self.formatted(txt[:index], False, self.plain)
+            self.formatted(txt[:index], True, self.html)
             txt = txt[index:]
             if txt.startswith("[["):
                 index = txt.find("]]")
@@ -308,11 +316,12 @@ class DescriptionFormatter:
                     raise MetaDataException("Unterminated ]]")
                 url = txt[2:index]
                 if self.linkResolver:
-                    url, urltext = self.linkResolver(url)
+                    self.links[url] = self.linkResolver(url)
+                    url, urltext = self.links[url]
                 else:
                     urltext = url
-                linkified_html += '<a href="' + url + '">' + cgi.escape(urltext) + '</a>'
-                linkified_plain += urltext
+                self.html.append('<a href="' + url + '">' + cgi.escape(urltext) + '</a>')
+                self.plain.append(urltext)
                 txt = txt[index + 2:]
             else:
                 index = txt.find("]")
@@ -325,82 +334,93 @@ class DescriptionFormatter:
                 else:
                     urltxt = url[index2 + 1:]
                     url = url[:index2]
-                linkified_html += '<a href="' + url + '">' + cgi.escape(urltxt) + '</a>'
-                linkified_plain += urltxt
+                self.html.append('<a href="' + url + '">' + cgi.escape(urltxt) + '</a>')
+                self.plain.append(urltxt)
                 if urltxt != url:
-                    linkified_plain += ' (' + url + ')'
+                    self.plain.append(' (' + url + ')')
                 txt = txt[index + 1:]
 
     def addtext(self, txt):
-        p, h = self.linkify(txt)
-        self.text_plain += p
-        self.text_html += h
+        self.linkify(txt)
 
     def parseline(self, line):
-        self.text_wiki += "%s\n" % line
+        self.wiki.append("%s\n" % line)
         if not line:
             self.endcur()
         elif line.startswith('* '):
             self.endcur([self.stUL])
             if self.state != self.stUL:
-                self.text_html += '<ul>'
+                self.html.append('<ul>')
                 self.state = self.stUL
-            self.text_html += '<li>'
-            self.text_plain += '* '
+            self.html.append('<li>')
+            self.plain.append('* ')
             self.addtext(line[1:])
-            self.text_html += '</li>'
+            self.html.append('</li>')
         elif line.startswith('# '):
             self.endcur([self.stOL])
             if self.state != self.stOL:
-                self.text_html += '<ol>'
+                self.html.append('<ol>')
                 self.state = self.stOL
-            self.text_html += '<li>'
-            self.text_plain += '* '  # TODO: lazy - put the numbers in!
+            self.html.append('<li>')
+            self.plain.append('* ')  # TODO: lazy - put the numbers in!
             self.addtext(line[1:])
-            self.text_html += '</li>'
+            self.html.append('</li>')
         else:
             self.endcur([self.stPARA])
             if self.state == self.stNONE:
-                self.text_html += '<p>'
+                self.html.append('<p>')
                 self.state = self.stPARA
             elif self.state == self.stPARA:
-                self.text_html += ' '
-                self.text_plain += ' '
+                self.html.append(' ')
+                self.plain.append(' ')
             self.addtext(line)
 
     def end(self):
         self.endcur()
+        self.text_plain = ''.join(self.plain)
+        self.text_wiki = ''.join(self.wiki)
+        self.text_html = ''.join(self.html)
+
+
+# The finished output of a DescriptionFormatter, without everything it needed
+# along the way.
+class FormattedDescription:
+
+    def __init__(self, ps):
+        self.text_plain = ps.text_plain
+        self.text_wiki = ps.text_wiki
+        self.text_html = ps.text_html
+        self.links = ps.links
 
 
 # Parse multiple lines of description as written in a metadata file, returning
-# a single string in plain text format.
-def description_plain(lines, linkres):
+# a FormattedDescription. Callers that need the same description several
+# times, like update for each repo index, keep it themselves.
+def format_description(lines, linkres):
     ps = DescriptionFormatter(linkres)
     for line in lines:
         ps.parseline(line)
     ps.end()
-    return ps.text_plain
+    return FormattedDescription(ps)
+
+
+# Parse multiple lines of description as written in a metadata file, returning
+# a single string in plain text format.
+def description_plain(lines, linkres):
+    return format_description(lines, linkres).text_plain
 
 
 # Parse multiple lines of description as written in a metadata file, returning
 # a single string in wiki format. Used for the Maintainer Notes field as well,
 # because it's the same format.
 def description_wiki(lines):
-    ps = DescriptionFormatter(None)
-    for line in lines:
-        ps.parseline(line)
-    ps.end()
-    return ps.text_wiki
+    return format_description(lines, None).text_wiki
 
 
 # Parse multiple lines of description as written in a metadata file, returning
 # a single string in HTML format.
 def description_html(lines, linkres):
-    ps = DescriptionFormatter(linkres)
-    for line in lines:
-        ps.parseline(line)
-    ps.end()
-    return ps.text_html
+    return format_description(lines, linkres).text_html
 
 
 def parse_srclib(metafile):
@@ -438,7 +458,82 @@ def parse_srclib(metafile):
     return thisinfo
 
 
-def read_srclibs():
+# Increase this whenever parse_metadata, parse_srclib or check_metadata change
+# what they produce or accept, so that cached results get thrown away.
+PARSER_VERSION = 1
+
+metadata_cache_path = os.path.join('tmp', 'metadata.pickle')
+
+
+def load_metadata_cache():
+    """Load the cache of parsed metadata files from previous runs.
+
+    :returns: the cache, which is empty if there was none, or if it was made
+              by a different version of the parser or can't be read.
+    """
+    empty = {'version': PARSER_VERSION, 'apps': {}, 'srclibs': {}}
+    if not os.path.exists(metadata_cache_path):
+        return empty
+    try:
+        with open(metadata_cache_path, 'rb') as f:
+            cache = cPickle.load(f)
+    except Exception, e:
+        logging.warn("Ignoring invalid metadata cache: %s" % e)
+        return empty
+    if not isinstance(cache, dict) or cache.get('version') != PARSER_VERSION:
+        logging.debug("Ignoring metadata cache from a different parser version")
+        return empty
+    return cache
+
+
+def save_metadata_cache(cache):
+    """Write the cache of parsed metadata files, if anything changed"""
+    if not cache.pop('changed', False):
+        return
+    try:
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(metadata_cache_path))
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfile, metadata_cache_path)
+    except (IOError, OSError), e:
+        logging.warn("Could not write the metadata cache: %s" % e)
+
+
+def parse_cached(cache, section, metafiles, parse, complete=True):
+    """Parse metadata files, using the results from the cache for the ones
+    that have the same modification time and size as when they were parsed.
+
+    :param cache: the cache, as from load_metadata_cache
+    :param section: 'apps' or 'srclibs'
+    :param metafiles: paths of the metadata files to parse
+    :param parse: function parsing a file which isn't in the cache
+    :param complete: True if metafiles are all the files of the section, so
+                     that the cached entries of any others can be dropped
+    :returns: the parsed files, in the same order
+    """
+    old = cache[section]
+    if complete:
+        new = {}
+    else:
+        new = dict(old)
+    results = []
+    for metafile in metafiles:
+        st = os.stat(metafile)
+        stamp = (st.st_mtime, st.st_size)
+        if metafile in old and old[metafile][0] == stamp:
+            info = old[metafile][1]
+        else:
+            info = parse(metafile)
+            cache['changed'] = True
+        new[metafile] = (stamp, info)
+        results.append(info)
+    if complete and len(new) != len(old):
+        cache['changed'] = True
+    cache[section] = new
+    return results
+
+
+def read_srclibs(cache=None):
     """Read all srclib metadata.
 
     The information read will be accessible as metadata.srclibs, which is a
@@ -447,6 +542,9 @@ def read_srclibs():
 
     A MetaDataException is raised if there are any problems with the srclib
     metadata.
+
+    :param cache: metadata cache to use, as from load_metadata_cache. If not
+                  given, it is loaded and saved here.
     """
     global srclibs
 
@@ -460,36 +558,60 @@ def read_srclibs():
     if not os.path.exists(srcdir):
         os.makedirs(srcdir)
 
-    for metafile in sorted(glob.glob(os.path.join(srcdir, '*.txt'))):
+    save = cache is None
+    if save:
+        cache = load_metadata_cache()
+
+    metafiles = sorted(glob.glob(os.path.join(srcdir, '*.txt')))
+    for metafile, info in zip(metafiles, parse_cached(cache, 'srclibs',
+                                                      metafiles, parse_srclib)):
         srclibname = os.path.basename(metafile[:-4])
-        srclibs[srclibname] = parse_srclib(metafile)
+        srclibs[srclibname] = info
 
+    if save and os.path.isdir(os.path.dirname(metadata_cache_path)):
+        save_metadata_cache(cache)
 
-# Read all metadata. Returns a list of 'app' objects (which are dictionaries as
-# returned by the parse_metadata function.
-def read_metadata(xref=True):
-    # Always read the srclibs before the apps, since they can use a srlib as
-    # their source repository.
-    read_srclibs()
-
-    apps = []
 
+# Read all metadata, or only that of the given app ids. Returns a list of
+# 'app' objects (which are dictionaries as returned by the parse_metadata
+# function), sorted by id. Ids without a metadata file are left out.
+def read_metadata(xref=True, appids=None):
     for basedir in ('metadata', 'tmp'):
         if not os.path.exists(basedir):
             os.makedirs(basedir)
 
-    for metafile in sorted(glob.glob(os.path.join('metadata', '*.txt'))):
+    # Files that haven't changed since the last run don't need parsing again
+    cache = load_metadata_cache()
+
+    # Always read the srclibs before the apps, since they can use a srlib as
+    # their source repository.
+    read_srclibs(cache)
+
+    def parse(metafile):
         appinfo = parse_metadata(metafile)
         check_metadata(appinfo)
-        apps.append(appinfo)
+        return appinfo
+
+    if appids is None:
+        metafiles = sorted(glob.glob(os.path.join('metadata', '*.txt')))
+    else:
+        metafiles = [os.path.join('metadata', appid + '.txt')
+                     for appid in sorted(set(appids))]
+        metafiles = [f for f in metafiles if os.path.isfile(f)]
+    apps = parse_cached(cache, 'apps', metafiles, parse,
+                        complete=appids is None)
+    save_metadata_cache(cache)
 
     if xref:
         # Parse all descriptions at load time, just to ensure cross-referencing
         # errors are caught early rather than when they hit the build server.
+        # When only some apps were read, the others just need to exist.
+        knownids = set(app['id'] for app in apps)
+
         def linkres(link):
-            for app in apps:
-                if app['id'] == link:
-                    return ("fdroid.app:" + link, "Dummy name - don't know yet")
+            if link in knownids or (appids is not None and os.path.isfile(
+                    os.path.join('metadata', link + '.txt'))):
+                return ("fdroid.app:" + link, "Dummy name - don't know yet")
             raise MetaDataException("Cannot resolve app id " + link)
 
         for app in apps:
@@ -502,6 +624,12 @@ def read_metadata(xref=True):
     return apps
 
 
+# Get the ids of all apps with metadata, without reading it.
+def read_appids():
+    return [os.path.basename(f)[:-4]
+            for f in sorted(glob.glob(os.path.join('metadata', '*.txt')))]
+
+
 # Read all metadata. Returns a list of 'app' objects (which are dictionaries as
 # returned by the parse_metadata function.
 def sen5_read_metadata(apk_id, xref=True):
@@ -85,18 +85,19 @@ def main():
     # and b) a sane-looking ID that would make its way into the repo.
     # Nonetheless, to be sure, before publishing we check that there are no
     # collisions, and refuse to do any publishing if that's the case...
-    allapps = metadata.read_metadata()
+    # Only the app ids are needed for that, not the full metadata.
+    allappids = metadata.read_appids()
     vercodes = common.read_pkg_args(args, True)
     allaliases = []
-    for app in allapps:
+    for appid in allappids:
         m = md5.new()
-        m.update(app['id'])
+        m.update(appid)
         keyalias = m.hexdigest()[:8]
         if keyalias in allaliases:
             logging.error("There is a keyalias collision - publishing halted")
             sys.exit(1)
         allaliases.append(keyalias)
-    logging.info("{0} apps, {0} key aliases".format(len(allapps),
+    logging.info("{0} apps, {0} key aliases".format(len(allappids),
                                                     len(allaliases)))
 
     # Process any apks that are waiting to be signed...
@@ -42,12 +42,16 @@ def main():
                       help="Restrict output to warnings and errors")
     parser.add_option("--nosvn", action="store_true", default=False,
                       help="Skip svn repositories - for test purposes, because they are too slow.")
+    parser.add_option("--prefetch", type="int", default=0, metavar="N",
+                      help="Fetch the repositories of all the apps first, N at a time")
     (options, args) = parser.parse_args()
 
     config = common.read_config(options)
 
     # Read all app and srclib metadata
-    allapps = metadata.read_metadata()
+    # Only read the metadata of the apps we were asked to scan, if any
+    appids = common.read_pkg_args(args, True).keys() or None
+    allapps = metadata.read_metadata(appids=appids)
     apps = common.read_app_args(args, allapps, True)
 
     problems = []
@@ -59,6 +63,24 @@ def main():
     srclib_dir = os.path.join(build_dir, 'srclib')
     extlib_dir = os.path.join(build_dir, 'extlib')
 
+    if options.prefetch > 0:
+        vcslist = []
+        for app in apps:
+            if app['Disabled'] or not app['builds']:
+                continue
+            if options.nosvn and app['Repo Type'] == 'svn':
+                continue
+            builds = [b for b in app['builds'] if not b['disable']]
+            if builds:
+                try:
+                    vcslist.append(common.getvcs(app['Repo Type'], app['Repo'],
+                                                 'build/' + app['id']))
+                    vcslist += common.getsrclibsvcs(builds)
+                except VCSException:
+                    # This will be reported when scanning the app
+                    pass
+        common.prefetch(vcslist, options.prefetch)
+
     for app in apps:
 
         if app['Disabled']:
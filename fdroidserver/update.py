@@ -26,7 +26,9 @@ import re
 import zipfile
 import hashlib
 import pickle
-from xml.dom.minidom import Document
+import sqlite3
+from StringIO import StringIO
+import multiprocessing
 from optparse import OptionParser
 import time
 from PIL import Image
@@ -34,7 +36,9 @@ import logging
 
 import common
 import metadata
-from common import FDroidPopen, SilentPopen
+import axml
+from axml import AXMLException
+from common import FDroidPopen
 from metadata import MetaDataException
 
 
@@ -62,11 +66,69 @@ def get_icon_dirs(repodir):
     yield os.path.join(repodir, "icons")
 
 
-def update_wiki(apps, apks):
+class RepoModel:
+    """The apps and apks of the repo and the archive, indexed by app id.
+
+    This is built once per run, so that the different phases of the update
+    don't each have to go through the full lists of apps and apks.
+    """
+
+    def __init__(self, apps, apks, archapks):
+        self.apps = dict((app['id'], app) for app in apps)
+        self.apks = self._index(apks)
+        self.archapks = self._index(archapks)
+        self.descriptions = {}
+
+    def _index(self, apks):
+        index = {}
+        for apk in apks:
+            index.setdefault(apk['id'], []).append(apk)
+        for apklist in index.itervalues():
+            apklist.sort(key=lambda apk: apk['versioncode'], reverse=True)
+        return index
+
+    def getapks(self, appid, archive=False):
+        """Get the apks of an app, most recent version first
+
+        :param appid: the application id
+        :param archive: True to get the apks in the archive rather than in
+                        the main repo
+        """
+        if archive:
+            return self.archapks.get(appid, [])
+        return self.apks.get(appid, [])
+
+    def getallapks(self, appid):
+        """Get the apks of an app in both the main repo and the archive"""
+        return self.getapks(appid) + self.getapks(appid, archive=True)
+
+    def archive(self, apk):
+        """Record that an apk was moved from the main repo to the archive"""
+        self.apks[apk['id']].remove(apk)
+        apklist = self.archapks.setdefault(apk['id'], [])
+        apklist.append(apk)
+        apklist.sort(key=lambda apk: apk['versioncode'], reverse=True)
+
+    def linkres(self, link):
+        """Link resolver for the app descriptions, see DescriptionFormatter"""
+        if link not in self.apps:
+            raise MetaDataException("Cannot resolve app id " + link)
+        return ("fdroid.app:" + link, self.apps[link]['Name'])
+
+    def describe(self, app):
+        """Get the FormattedDescription of an app. It is only formatted once
+        per run, however many indexes it goes into."""
+        if app['id'] not in self.descriptions:
+            self.descriptions[app['id']] = metadata.format_description(
+                app['Description'], self.linkres)
+        return self.descriptions[app['id']]
+
+
+def update_wiki(apps, model):
     """Update the wiki
 
     :param apps: fully populated list of all applications
-    :param apks: all apks, except...
+    :param model: the RepoModel of the repo and the archive
     """
     logging.info("Updating wiki")
     wikicat = 'Apps'
@@ -119,11 +181,10 @@ def update_wiki(apps, apks):
         gotcurrentver = False
         cantupdate = False
         buildfails = False
-        for apk in apks:
-            if apk['id'] == app['id']:
-                if str(apk['versioncode']) == app['Current Version Code']:
-                    gotcurrentver = True
-                apklist.append(apk)
+        for apk in model.getallapks(app['id']):
+            if str(apk['versioncode']) == app['Current Version Code']:
+                gotcurrentver = True
+            apklist.append(apk)
         # Include ones we can't build, as a special case...
         for thisbuild in app['builds']:
             if thisbuild['disable']:
@@ -263,6 +324,125 @@ def update_wiki(apps, apks):
     site.pages['Repository Maintenance'].purge()
 
 
+def sha256sum(filename):
+    """Calculate the sha256 of the given file"""
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            t = f.read(1024)
+            if len(t) == 0:
+                break
+            sha.update(t)
+    return sha.hexdigest()
+
+
+class ApkCache:
+    """Persistent cache of the information scanned from apks.
+
+    Entries are kept in an sqlite database in tmp/, and are read and written
+    one at a time. An entry is only used while the apk still has the size,
+    mtime and inode it had when it was scanned, so an apk that got replaced
+    under the same name is scanned again.
+    """
+
+    # Increase this when the layout of the table or of the cached
+    # information changes, which throws away the old entries.
+    schema_version = 1
+
+    def __init__(self, path=os.path.join('tmp', 'apkcache.db')):
+        self.path = path
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.execute('PRAGMA synchronous = NORMAL')
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.schema_version:
+            logging.debug("Creating apk cache version %d" % self.schema_version)
+            self.db.execute('DROP TABLE IF EXISTS apks')
+            self.db.execute('CREATE TABLE apks (name TEXT PRIMARY KEY, '
+                            'size INTEGER, mtime REAL, inode INTEGER, '
+                            'info BLOB)')
+            self.db.execute('PRAGMA user_version = %d' % self.schema_version)
+            self.db.commit()
+
+    def __contains__(self, apkfilename):
+        cur = self.db.execute('SELECT 1 FROM apks WHERE name = ?', (apkfilename,))
+        return cur.fetchone() is not None
+
+    def __delitem__(self, apkfilename):
+        self.db.execute('DELETE FROM apks WHERE name = ?', (apkfilename,))
+        self.db.commit()
+
+    def get(self, apkfilename, apkfile, verify=False):
+        """Get the cached information for an apk.
+
+        :param apkfilename: name of the apk, as used in the repo
+        :param apkfile: path to the apk file
+        :param verify: also check the sha256 of the file
+        :returns: the apk information, or None if there is no valid entry
+        """
+        row = self.db.execute('SELECT size, mtime, inode, info FROM apks '
+                              'WHERE name = ?', (apkfilename,)).fetchone()
+        if row is None:
+            return None
+        st = os.stat(apkfile)
+        if (st.st_size, st.st_mtime, st.st_ino) != tuple(row[:3]):
+            logging.debug(apkfilename + " has changed since it was cached")
+            return None
+        thisinfo = pickle.loads(str(row[3]))
+        if verify and sha256sum(apkfile) != thisinfo.get('sha256'):
+            logging.warn(apkfilename + " does not match its cached sha256")
+            return None
+        return thisinfo
+
+    def put(self, apkfilename, apkfile, thisinfo):
+        """Store the information for an apk, along with its current state"""
+        st = os.stat(apkfile)
+        self.db.execute('INSERT OR REPLACE INTO apks VALUES (?, ?, ?, ?, ?)',
+                        (apkfilename, st.st_size, st.st_mtime, st.st_ino,
+                         sqlite3.Binary(pickle.dumps(thisinfo, pickle.HIGHEST_PROTOCOL))))
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute('DELETE FROM apks')
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# The pickled apk cache used before ApkCache
+old_apkcache_path = os.path.join('tmp', 'apkcache')
+
+
+def import_old_apkcache(apkcache, repodirs):
+    """Move the entries of the old pickled tmp/apkcache into the new cache.
+
+    The old cache didn't record anything about the files, so its entries
+    are taken to be valid for the apks as they are now, like before.
+    """
+    apkcachefile = old_apkcache_path
+    if not os.path.exists(apkcachefile):
+        return
+    try:
+        with open(apkcachefile, 'rb') as cf:
+            oldcache = pickle.load(cf)
+    except Exception as e:
+        logging.warn("Could not read %s, removing it: %s" % (apkcachefile, e))
+        os.remove(apkcachefile)
+        return
+    for apkfilename, thisinfo in oldcache.iteritems():
+        for repodir in repodirs:
+            apkfile = os.path.join(repodir, apkfilename)
+            if os.path.exists(apkfile):
+                apkcache.put(apkfilename, apkfile, thisinfo)
+                break
+    os.remove(apkcachefile)
+    logging.info("Imported %d entries from %s" % (len(oldcache), apkcachefile))
+
+
 def delete_disabled_builds(apps, apkcache, repodirs):
     """Delete disabled build outputs.
 
@@ -318,21 +498,256 @@ def resize_all_icons(repodirs):
                 resize_icon(iconpath, density)
 
 
+def getsig(apkfile):
+    """Get the signature of an apk using getsig in a JVM"""
+    getsig_dir = os.path.join(os.path.dirname(__file__), 'getsig')
+    if not os.path.exists(getsig_dir + "/getsig.class"):
+        logging.critical("getsig.class not found. To fix: cd '%s' && ./make.sh" % getsig_dir)
+        sys.exit(1)
+    p = FDroidPopen(['java', '-cp', os.path.join(os.path.dirname(__file__), 'getsig'),
+                     'getsig', os.path.join(os.getcwd(), apkfile)])
+    if p.returncode != 0 or not p.output.startswith('Result:'):
+        logging.critical("Failed to get apk signature")
+        sys.exit(1)
+    return p.output[7:].strip()
+
+
+def scan_apk(apkfile, repodir):
+    """Scan a single apk that is not in the cache yet.
+
+    This also extracts the icons. Nothing outside of the icon directories is
+    modified, so it is safe to run several of these at the same time.
+
+    :param apkfile: path to the apk file
+    :param repodir: repo directory the apk is in
+    :returns: the apk information, or None if it could not be read.
+    """
+
+    apkfilename = apkfile[len(repodir) + 1:]
+
+    logging.debug("Processing " + apkfilename)
+
+    thisinfo = {}
+    thisinfo['apkname'] = apkfilename
+    srcfilename = apkfilename[:-4] + "_src.tar.gz"
+    if os.path.exists(os.path.join(repodir, srcfilename)):
+        thisinfo['srcname'] = srcfilename
+    thisinfo['size'] = os.path.getsize(apkfile)
+    thisinfo['permissions'] = []
+    thisinfo['features'] = []
+    thisinfo['icons_src'] = {}
+    thisinfo['icons'] = {}
+    try:
+        apkinfo = axml.get_apk_info(apkfile)
+    except AXMLException, e:
+        logging.debug(str(e))
+        if options.delete_unknown:
+            if os.path.exists(apkfile):
+                logging.error("Failed to get apk information, deleting " + apkfile)
+                os.remove(apkfile)
+            else:
+                logging.error("Could not find {0} to remove it".format(apkfile))
+        else:
+            logging.error("Failed to get apk information, skipping " + apkfile)
+        return None
+
+    if not re.match(r'^[a-zA-Z0-9._]+$', apkinfo.get('id', '')) \
+            or 'versioncode' not in apkinfo:
+        logging.error("Package matching failed for " + apkfile)
+        logging.info("Package was: '{0}' version code '{1}'".format(
+            apkinfo.get('id', ''), apkinfo.get('versioncode', '')))
+        sys.exit(1)
+    thisinfo['id'] = apkinfo['id']
+    thisinfo['versioncode'] = apkinfo['versioncode']
+    thisinfo['version'] = apkinfo['version']
+    thisinfo['name'] = apkinfo['name']
+    thisinfo['icons_src'] = apkinfo['icons_src']
+
+    if 'sdkversion' in apkinfo:
+        if apkinfo['sdkversion'].isdigit():
+            thisinfo['sdkversion'] = apkinfo['sdkversion']
+        else:
+            logging.error("'" + apkinfo['sdkversion'] + "'"
+                          + ' is not a valid minSdkVersion!')
+    if 'maxsdkversion' in apkinfo:
+        thisinfo['maxsdkversion'] = apkinfo['maxsdkversion']
+    if apkinfo['nativecode']:
+        thisinfo['nativecode'] = apkinfo['nativecode']
+    for perm in apkinfo['permissions']:
+        if perm.startswith("android.permission."):
+            perm = perm[19:]
+        thisinfo['permissions'].append(perm)
+    for perm in apkinfo['features']:
+        # Filter out this, it's only added with the latest SDK tools and
+        # causes problems for lots of apps.
+        if perm != "android.hardware.screen.portrait" \
+                and perm != "android.hardware.screen.landscape":
+            if perm.startswith("android.feature."):
+                perm = perm[16:]
+            thisinfo['features'].append(perm)
+
+    if 'sdkversion' not in thisinfo:
+        logging.warn("no SDK version information found")
+        thisinfo['sdkversion'] = 0
+
+    # Check for debuggable apks...
+    if apkinfo['debuggable']:
+        logging.warn('{0} is set to android:debuggable="true"!'.format(apkfile))
+
+    # Calculate the sha256...
+    thisinfo['sha256'] = sha256sum(apkfile)
+
+    # Get the signature (or md5 of, to be precise)...
+    try:
+        thisinfo['sig'] = axml.get_signature(apkfile)
+    except AXMLException, e:
+        logging.critical("Failed to get apk signature: " + str(e))
+        sys.exit(1)
+    if thisinfo['sig'] is None:
+        # Leave the unusual cases to the real thing
+        thisinfo['sig'] = getsig(apkfile)
+
+    apk = zipfile.ZipFile(apkfile, 'r')
+
+    iconfilename = "%s.%s.png" % (
+        thisinfo['id'],
+        thisinfo['versioncode'])
+
+    # Extract the icon file...
+    densities = get_densities()
+    empty_densities = []
+    for density in densities:
+        if density not in thisinfo['icons_src']:
+            empty_densities.append(density)
+            continue
+        iconsrc = thisinfo['icons_src'][density]
+        icon_dir = get_icon_dir(repodir, density)
+        icondest = os.path.join(icon_dir, iconfilename)
+
+        try:
+            iconfile = open(icondest, 'wb')
+            iconfile.write(apk.read(iconsrc))
+            iconfile.close()
+            thisinfo['icons'][density] = iconfilename
+
+        except:
+            logging.warn("Error retrieving icon file")
+            del thisinfo['icons'][density]
+            del thisinfo['icons_src'][density]
+            empty_densities.append(density)
+
+    if '-1' in thisinfo['icons_src']:
+        iconsrc = thisinfo['icons_src']['-1']
+        iconpath = os.path.join(
+            get_icon_dir(repodir, None), iconfilename)
+        iconfile = open(iconpath, 'wb')
+        iconfile.write(apk.read(iconsrc))
+        iconfile.close()
+        try:
+            im = Image.open(iconpath)
+            dpi = px_to_dpi(im.size[0])
+            for density in densities:
+                if density in thisinfo['icons']:
+                    break
+                if density == densities[-1] or dpi >= int(density):
+                    thisinfo['icons'][density] = iconfilename
+                    shutil.move(iconpath,
+                                os.path.join(get_icon_dir(repodir, density), iconfilename))
+                    empty_densities.remove(density)
+                    break
+        except Exception, e:
+            logging.warn("Failed reading {0} - {1}".format(iconpath, e))
+
+    if thisinfo['icons']:
+        thisinfo['icon'] = iconfilename
+
+    apk.close()
+
+    # First try resizing down to not lose quality
+    last_density = None
+    for density in densities:
+        if density not in empty_densities:
+            last_density = density
+            continue
+        if last_density is None:
+            continue
+        logging.debug("Density %s not available, resizing down from %s"
+                      % (density, last_density))
+
+        last_iconpath = os.path.join(
+            get_icon_dir(repodir, last_density), iconfilename)
+        iconpath = os.path.join(
+            get_icon_dir(repodir, density), iconfilename)
+        try:
+            im = Image.open(last_iconpath)
+        except:
+            logging.warn("Invalid image file at %s" % last_iconpath)
+            continue
+
+        size = dpi_to_px(density)
+
+        im.thumbnail((size, size), Image.ANTIALIAS)
+        im.save(iconpath, "PNG")
+        empty_densities.remove(density)
+
+    # Then just copy from the highest resolution available
+    last_density = None
+    for density in reversed(densities):
+        if density not in empty_densities:
+            last_density = density
+            continue
+        if last_density is None:
+            continue
+        logging.debug("Density %s not available, copying from lower density %s"
+                      % (density, last_density))
+
+        shutil.copyfile(
+            os.path.join(get_icon_dir(repodir, last_density), iconfilename),
+            os.path.join(get_icon_dir(repodir, density), iconfilename))
+
+        empty_densities.remove(density)
+
+    for density in densities:
+        icon_dir = get_icon_dir(repodir, density)
+        icondest = os.path.join(icon_dir, iconfilename)
+        resize_icon(icondest, density)
+
+    # Copy from icons-mdpi to icons since mdpi is the baseline density
+    baseline = os.path.join(get_icon_dir(repodir, '160'), iconfilename)
+    if os.path.isfile(baseline):
+        shutil.copyfile(baseline,
+                        os.path.join(get_icon_dir(repodir, None), iconfilename))
+
+    return thisinfo
+
+
+def scan_apk_job(args):
+    """Wrapper around scan_apk for use in a multiprocessing pool.
+
+    A sys.exit() in a pool worker would kill it and leave the pool waiting
+    forever, so it is handed back to the parent to act on instead.
+    """
+    try:
+        return scan_apk(*args)
+    except SystemExit, e:
+        return e
+
+
 def scan_apks(apps, apkcache, repodir, knownapks):
     """Scan the apks in the given repo directory.
 
-    This also extracts the icons.
+    This also extracts the icons. Apks that are not in the cache are scanned
+    in a pool of options.jobs processes, but the results are always merged
+    back in the same order, so the outcome doesn't depend on the number of
+    jobs.
 
     :param apps: list of all applications, as per metadata.read_metadata
     :param apkcache: current apk cache information
     :param repodir: repo directory to scan
     :param knownapks: known apks info
-    :returns: (apks, cachechanged) where apks is a list of apk information,
-              and cachechanged is True if the apkcache got changed.
+    :returns: list of apk information
     """
 
-    cachechanged = False
-
     icon_dirs = get_icon_dirs(repodir)
     for icon_dir in icon_dirs:
         if os.path.exists(icon_dir):
@@ -342,310 +757,405 @@ def scan_apks(apps, apkcache, repodir, knownapks):
         else:
             os.makedirs(icon_dir)
 
+    apkfiles = glob.glob(os.path.join(repodir, '*.apk'))
+    for apkfile in apkfiles:
+        if ' ' in apkfile[len(repodir) + 1:]:
+            logging.critical("Spaces in filenames are not allowed.")
+            sys.exit(1)
+
+    cached = {}
+    for apkfile in apkfiles:
+        apkfilename = apkfile[len(repodir) + 1:]
+        thisinfo = apkcache.get(apkfilename, apkfile, options.verify_cache)
+        if thisinfo is not None:
+            cached[apkfile] = thisinfo
+    newapkfiles = [f for f in apkfiles if f not in cached]
+    jobs = [(f, repodir) for f in newapkfiles]
+    if options.jobs > 1 and len(jobs) > 1:
+        logging.info("Scanning %d new apks using %d processes"
+                     % (len(jobs), options.jobs))
+        pool = multiprocessing.Pool(options.jobs)
+        try:
+            results = pool.map(scan_apk_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [scan_apk_job(job) for job in jobs]
+    scanned = dict(zip(newapkfiles, results))
+
     apks = []
-    name_pat = re.compile(".*name='([a-zA-Z0-9._]*)'.*")
-    vercode_pat = re.compile(".*versionCode='([0-9]*)'.*")
-    vername_pat = re.compile(".*versionName='([^']*)'.*")
-    label_pat = re.compile(".*label='(.*?)'(\n| [a-z]*?=).*")
-    icon_pat = re.compile(".*application-icon-([0-9]+):'([^']+?)'.*")
-    icon_pat_nodpi = re.compile(".*icon='([^']+?)'.*")
-    sdkversion_pat = re.compile(".*'([0-9]*)'.*")
-    string_pat = re.compile(".*'([^']*)'.*")
-    for apkfile in glob.glob(os.path.join(repodir, '*.apk')):
+    for apkfile in apkfiles:
 
         apkfilename = apkfile[len(repodir) + 1:]
-        if ' ' in apkfilename:
-            logging.critical("Spaces in filenames are not allowed.")
-            sys.exit(1)
 
-        if apkfilename in apkcache:
+        if apkfile in cached:
             logging.debug("Reading " + apkfilename + " from cache")
-            thisinfo = apkcache[apkfilename]
+            thisinfo = cached[apkfile]
 
         else:
-            logging.debug("Processing " + apkfilename)
-            thisinfo = {}
-            thisinfo['apkname'] = apkfilename
-            srcfilename = apkfilename[:-4] + "_src.tar.gz"
-            if os.path.exists(os.path.join(repodir, srcfilename)):
-                thisinfo['srcname'] = srcfilename
-            thisinfo['size'] = os.path.getsize(apkfile)
-            thisinfo['permissions'] = []
-            thisinfo['features'] = []
-            thisinfo['icons_src'] = {}
-            thisinfo['icons'] = {}
-            p = SilentPopen([config['aapt'], 'dump', 'badging', apkfile])
-            if p.returncode != 0:
-                if options.delete_unknown:
-                    if os.path.exists(apkfile):
-                        logging.error("Failed to get apk information, deleting " + apkfile)
-                        os.remove(apkfile)
-                    else:
-                        logging.error("Could not find {0} to remove it".format(apkfile))
-                else:
-                    logging.error("Failed to get apk information, skipping " + apkfile)
+            thisinfo = scanned[apkfile]
+            if isinstance(thisinfo, SystemExit):
+                sys.exit(thisinfo.code)
+            if thisinfo is None:
                 continue
-            for line in p.output.splitlines():
-                if line.startswith("package:"):
-                    try:
-                        thisinfo['id'] = re.match(name_pat, line).group(1)
-                        thisinfo['versioncode'] = int(re.match(vercode_pat, line).group(1))
-                        thisinfo['version'] = re.match(vername_pat, line).group(1)
-                    except Exception, e:
-                        logging.error("Package matching failed: " + str(e))
-                        logging.info("Line was: " + line)
-                        sys.exit(1)
-                elif line.startswith("application:"):
-                    thisinfo['name'] = re.match(label_pat, line).group(1)
-                    # Keep path to non-dpi icon in case we need it
-                    match = re.match(icon_pat_nodpi, line)
-                    if match:
-                        thisinfo['icons_src']['-1'] = match.group(1)
-                elif line.startswith("launchable-activity:"):
-                    # Only use launchable-activity as fallback to application
-                    if not thisinfo['name']:
-                        thisinfo['name'] = re.match(label_pat, line).group(1)
-                    if '-1' not in thisinfo['icons_src']:
-                        match = re.match(icon_pat_nodpi, line)
-                        if match:
-                            thisinfo['icons_src']['-1'] = match.group(1)
-                elif line.startswith("application-icon-"):
-                    match = re.match(icon_pat, line)
-                    if match:
-                        density = match.group(1)
-                        path = match.group(2)
-                        thisinfo['icons_src'][density] = path
-                elif line.startswith("sdkVersion:"):
-                    m = re.match(sdkversion_pat, line)
-                    if m is None:
-                        logging.error(line.replace('sdkVersion:', '')
-                                      + ' is not a valid minSdkVersion!')
-                    else:
-                        thisinfo['sdkversion'] = m.group(1)
-                elif line.startswith("maxSdkVersion:"):
-                    thisinfo['maxsdkversion'] = re.match(sdkversion_pat, line).group(1)
-                elif line.startswith("native-code:"):
-                    thisinfo['nativecode'] = []
-                    for arch in line[13:].split(' '):
-                        thisinfo['nativecode'].append(arch[1:-1])
-                elif line.startswith("uses-permission:"):
-                    perm = re.match(string_pat, line).group(1)
-                    if perm.startswith("android.permission."):
-                        perm = perm[19:]
-                    thisinfo['permissions'].append(perm)
-                elif line.startswith("uses-feature:"):
-                    perm = re.match(string_pat, line).group(1)
-                    # Filter out this, it's only added with the latest SDK tools and
-                    # causes problems for lots of apps.
-                    if perm != "android.hardware.screen.portrait" \
-                            and perm != "android.hardware.screen.landscape":
-                        if perm.startswith("android.feature."):
-                            perm = perm[16:]
-                        thisinfo['features'].append(perm)
-
-            if 'sdkversion' not in thisinfo:
-                logging.warn("no SDK version information found")
-                thisinfo['sdkversion'] = 0
-
-            # Check for debuggable apks...
-            if common.isApkDebuggable(apkfile, config):
-                logging.warn('{0} is set to android:debuggable="true"!'.format(apkfile))
-
-            # Calculate the sha256...
-            sha = hashlib.sha256()
-            with open(apkfile, 'rb') as f:
-                while True:
-                    t = f.read(1024)
-                    if len(t) == 0:
-                        break
-                    sha.update(t)
-                thisinfo['sha256'] = sha.hexdigest()
 
-            # Get the signature (or md5 of, to be precise)...
-            getsig_dir = os.path.join(os.path.dirname(__file__), 'getsig')
-            if not os.path.exists(getsig_dir + "/getsig.class"):
-                logging.critical("getsig.class not found. To fix: cd '%s' && ./make.sh" % getsig_dir)
-                sys.exit(1)
-            p = FDroidPopen(['java', '-cp', os.path.join(os.path.dirname(__file__), 'getsig'),
-                             'getsig', os.path.join(os.getcwd(), apkfile)])
-            if p.returncode != 0 or not p.output.startswith('Result:'):
-                logging.critical("Failed to get apk signature")
-                sys.exit(1)
-            thisinfo['sig'] = p.output[7:].strip()
+            # Record in known apks, getting the added date at the same time..
+            added = knownapks.recordapk(thisinfo['apkname'], thisinfo['id'])
+            if added:
+                thisinfo['added'] = added
 
-            apk = zipfile.ZipFile(apkfile, 'r')
+            apkcache.put(apkfilename, apkfile, thisinfo)
 
-            iconfilename = "%s.%s.png" % (
-                thisinfo['id'],
-                thisinfo['versioncode'])
+        apks.append(thisinfo)
 
-            # Extract the icon file...
-            densities = get_densities()
-            empty_densities = []
-            for density in densities:
-                if density not in thisinfo['icons_src']:
-                    empty_densities.append(density)
-                    continue
-                iconsrc = thisinfo['icons_src'][density]
-                icon_dir = get_icon_dir(repodir, density)
-                icondest = os.path.join(icon_dir, iconfilename)
+    return apks
 
-                try:
-                    iconfile = open(icondest, 'wb')
-                    iconfile.write(apk.read(iconsrc))
-                    iconfile.close()
-                    thisinfo['icons'][density] = iconfilename
 
-                except:
-                    logging.warn("Error retrieving icon file")
-                    del thisinfo['icons'][density]
-                    del thisinfo['icons_src'][density]
-                    empty_densities.append(density)
-
-            if '-1' in thisinfo['icons_src']:
-                iconsrc = thisinfo['icons_src']['-1']
-                iconpath = os.path.join(
-                    get_icon_dir(repodir, None), iconfilename)
-                iconfile = open(iconpath, 'wb')
-                iconfile.write(apk.read(iconsrc))
-                iconfile.close()
-                try:
-                    im = Image.open(iconpath)
-                    dpi = px_to_dpi(im.size[0])
-                    for density in densities:
-                        if density in thisinfo['icons']:
-                            break
-                        if density == densities[-1] or dpi >= int(density):
-                            thisinfo['icons'][density] = iconfilename
-                            shutil.move(iconpath,
-                                        os.path.join(get_icon_dir(repodir, density), iconfilename))
-                            empty_densities.remove(density)
-                            break
-                except Exception, e:
-                    logging.warn("Failed reading {0} - {1}".format(iconpath, e))
-
-            if thisinfo['icons']:
-                thisinfo['icon'] = iconfilename
-
-            apk.close()
-
-            # First try resizing down to not lose quality
-            last_density = None
-            for density in densities:
-                if density not in empty_densities:
-                    last_density = density
-                    continue
-                if last_density is None:
-                    continue
-                logging.debug("Density %s not available, resizing down from %s"
-                              % (density, last_density))
+repo_pubkey_fingerprint = None
 
-                last_iconpath = os.path.join(
-                    get_icon_dir(repodir, last_density), iconfilename)
-                iconpath = os.path.join(
-                    get_icon_dir(repodir, density), iconfilename)
-                try:
-                    im = Image.open(last_iconpath)
-                except:
-                    logging.warn("Invalid image file at %s" % last_iconpath)
-                    continue
 
-                size = dpi_to_px(density)
+def canonical(value):
+    """A string representation of nested dicts, lists and other values which,
+    unlike repr() or pickle, doesn't depend on the order of dict keys"""
+    if isinstance(value, dict):
+        return '{' + ','.join(canonical(k) + ':' + canonical(value[k])
+                              for k in sorted(value)) + '}'
+    if isinstance(value, (list, tuple, time.struct_time)):
+        return '[' + ','.join(canonical(v) for v in value) + ']'
+    return repr(value)
 
-                im.thumbnail((size, size), Image.ANTIALIAS)
-                im.save(iconpath, "PNG")
-                empty_densities.remove(density)
 
-            # Then just copy from the highest resolution available
-            last_density = None
-            for density in reversed(densities):
-                if density not in empty_densities:
-                    last_density = density
-                    continue
-                if last_density is None:
-                    continue
-                logging.debug("Density %s not available, copying from lower density %s"
-                              % (density, last_density))
+class IndexCache:
+    """Persistent cache of the application elements of the repo indexes.
 
-                shutil.copyfile(
-                    os.path.join(get_icon_dir(repodir, last_density), iconfilename),
-                    os.path.join(get_icon_dir(repodir, density), iconfilename))
+    An element is reused as long as the app, its apks in that repo, and the
+    names of the apps its description links to haven't changed.
+    """
 
-                empty_densities.remove(density)
+    # Increase this whenever write_app changes what it writes
+    schema_version = 1
+
+    def __init__(self, path=os.path.join('tmp', 'indexcache.db')):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.schema_version:
+            self.db.execute('DROP TABLE IF EXISTS fragments')
+            self.db.execute('CREATE TABLE fragments (appid TEXT, archive INTEGER, '
+                            'pretty INTEGER, key TEXT, fragment BLOB, links BLOB, '
+                            'PRIMARY KEY (appid, archive, pretty))')
+            self.db.execute('PRAGMA user_version = %d' % self.schema_version)
+            self.db.commit()
+
+    def key(self, app, apklist):
+        """Hash of everything about an app that ends up in its element"""
+        appinfo = dict((k, v) for k, v in app.iteritems()
+                       if k not in ('builds', 'comments'))
+        return hashlib.sha1(canonical([appinfo, apklist])).hexdigest()
+
+    def get(self, appid, archive, key, linkres):
+        """Get the cached element of an app, or None if it is out of date
+
+        :param linkres: link resolver to check the description links with
+        """
+        row = self.db.execute('SELECT key, fragment, links FROM fragments '
+                              'WHERE appid = ? AND archive = ? AND pretty = ?',
+                              (appid, archive, options.pretty)).fetchone()
+        if row is None or row[0] != key:
+            return None
+        links = pickle.loads(str(row[2]))
+        for link, resolved in links.iteritems():
+            try:
+                if linkres(link) != resolved:
+                    return None
+            except MetaDataException:
+                return None
+        return str(row[1])
+
+    def put(self, appid, archive, key, fragment, links):
+        self.db.execute('INSERT OR REPLACE INTO fragments VALUES (?, ?, ?, ?, ?, ?)',
+                        (appid, archive, options.pretty, key,
+                         sqlite3.Binary(fragment),
+                         sqlite3.Binary(pickle.dumps(links, pickle.HIGHEST_PROTOCOL))))
+
+    def clear(self):
+        self.db.execute('DELETE FROM fragments')
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class IndexWriter:
+    """Writes an xml document element by element.
+
+    The output is exactly what xml.dom.minidom's toxml() (or toprettyxml(),
+    when pretty is set) would give for the same tree, without having to hold
+    the whole tree in memory first.
+    """
 
-            for density in densities:
-                icon_dir = get_icon_dir(repodir, density)
-                icondest = os.path.join(icon_dir, iconfilename)
-                resize_icon(icondest, density)
+    def __init__(self, f, pretty=False, depth=0):
+        """
+        :param f: the file to write to
+        :param pretty: produce the output of toprettyxml() instead of toxml()
+        :param depth: depth in the document of what is going to be written,
+                      0 for a whole document including the xml declaration.
+        """
+        self.f = f
+        if pretty:
+            self.addindent = '\t'
+            self.newl = '\n'
+        else:
+            self.addindent = ''
+            self.newl = ''
+        self.depth = depth
+        # Name of each open element, and whether it has children yet
+        self.stack = []
+        if depth == 0:
+            self.f.write('<?xml version="1.0" ?>' + self.newl)
+
+    def _indent(self):
+        return self.addindent * (self.depth + len(self.stack))
+
+    def _child(self):
+        if self.stack and not self.stack[-1][1]:
+            self.f.write(">" + self.newl)
+            self.stack[-1][1] = True
+
+    def _escape(self, data):
+        return data.replace("&", "&amp;").replace("<", "&lt;"). \
+            replace("\"", "&quot;").replace(">", "&gt;")
+
+    def _starttag(self, name, attrs):
+        self._child()
+        self.f.write(self._indent() + "<" + name)
+        for a_name in sorted(attrs):
+            self.f.write(" %s=\"" % a_name)
+            if attrs[a_name]:
+                self.f.write(self._escape(attrs[a_name]))
+            self.f.write("\"")
+
+    def start(self, name, attrs={}):
+        """Open an element, which will contain other elements"""
+        self._starttag(name, attrs)
+        self.stack.append([name, False])
+
+    def end(self):
+        """Close the innermost open element"""
+        name, children = self.stack.pop()
+        if children:
+            self.f.write(self._indent() + "</%s>%s" % (name, self.newl))
+        else:
+            self.f.write("/>" + self.newl)
 
-            # Copy from icons-mdpi to icons since mdpi is the baseline density
-            baseline = os.path.join(get_icon_dir(repodir, '160'), iconfilename)
-            if os.path.isfile(baseline):
-                shutil.copyfile(baseline,
-                                os.path.join(get_icon_dir(repodir, None), iconfilename))
+    def element(self, name, value, attrs={}):
+        """Write an element containing just the given text"""
+        if not isinstance(value, basestring):
+            raise TypeError("node contents must be a string")
+        self._starttag(name, attrs)
+        self.f.write(">" + self._escape(value) + "</%s>%s" % (name, self.newl))
 
-            # Record in known apks, getting the added date at the same time..
-            added = knownapks.recordapk(thisinfo['apkname'], thisinfo['id'])
-            if added:
-                thisinfo['added'] = added
+    def raw(self, data):
+        """Write elements already written by another IndexWriter, which was
+        created with the depth of the current position"""
+        self._child()
+        self.f.write(data)
 
-            apkcache[apkfilename] = thisinfo
-            cachechanged = True
+    def close(self):
+        while self.stack:
+            self.end()
 
-        apks.append(thisinfo)
 
-    return apks, cachechanged
+def write_app(writer, app, apklist, model):
+    """Write the application element of an app to a repo index.
 
+    :param writer: the IndexWriter to write to
+    :param app: the application
+    :param apklist: its apks in the repo, most recent version first
+    :param model: the RepoModel, which formats the description
+    """
 
-repo_pubkey_fingerprint = None
+    writer.start("application", {"id": app['id']})
+
+    writer.element('id', app['id'])
+    if 'added' in app:
+        writer.element('added', time.strftime('%Y-%m-%d', app['added']))
+    if 'lastupdated' in app:
+        writer.element('lastupdated', time.strftime('%Y-%m-%d', app['lastupdated']))
+    writer.element('name', app['Name'])
+    writer.element('summary', app['Summary'])
+    if app['icon']:
+        writer.element('icon', app['icon'])
+
+    writer.element('desc', model.describe(app).text_html)
+    writer.element('license', app['License'])
+    if 'Categories' in app:
+        writer.element('categories', ','.join(app["Categories"]))
+        # We put the first (primary) category in LAST, which will have
+        # the desired effect of making clients that only understand one
+        # category see that one.
+        writer.element('category', app["Categories"][0])
+    writer.element('web', app['Web Site'])
+    writer.element('source', app['Source Code'])
+    writer.element('tracker', app['Issue Tracker'])
+    if app['Donate']:
+        writer.element('donate', app['Donate'])
+    if app['Bitcoin']:
+        writer.element('bitcoin', app['Bitcoin'])
+    if app['Litecoin']:
+        writer.element('litecoin', app['Litecoin'])
+    if app['Dogecoin']:
+        writer.element('dogecoin', app['Dogecoin'])
+    if app['FlattrID']:
+        writer.element('flattr', app['FlattrID'])
+
+    # These elements actually refer to the current version (i.e. which
+    # one is recommended. They are historically mis-named, and need
+    # changing, but stay like this for now to support existing clients.
+    writer.element('marketversion', app['Current Version'])
+    writer.element('marketvercode', app['Current Version Code'])
+
+    if app['AntiFeatures']:
+        af = app['AntiFeatures'].split(',')
+        # TODO: Temporarily not including UpstreamNonFree in the index,
+        # because current F-Droid clients do not understand it, and also
+        # look ugly when they encounter an unknown antifeature. This
+        # filtering can be removed in time...
+        if 'UpstreamNonFree' in af:
+            af.remove('UpstreamNonFree')
+        if af:
+            writer.element('antifeatures', ','.join(af))
+    if app['Provides']:
+        pv = app['Provides'].split(',')
+        writer.element('provides', ','.join(pv))
+    if app['Requires Root']:
+        writer.element('requirements', 'root')
+
+    # Check for duplicates - they will make the client unhappy...
+    for i in range(len(apklist) - 1):
+        if apklist[i]['versioncode'] == apklist[i + 1]['versioncode']:
+            logging.critical("duplicate versions: '%s' - '%s'" % (
+                apklist[i]['apkname'], apklist[i + 1]['apkname']))
+            sys.exit(1)
+
+    for apk in apklist:
+        writer.start("package")
+        writer.element('version', apk['version'])
+        writer.element('versioncode', str(apk['versioncode']))
+        writer.element('apkname', apk['apkname'])
+        if 'srcname' in apk:
+            writer.element('srcname', apk['srcname'])
+        for hash_type in ['sha256']:
+            if hash_type not in apk:
+                continue
+            writer.element('hash', apk[hash_type], {"type": hash_type})
+        writer.element('sig', apk['sig'])
+        writer.element('size', str(apk['size']))
+        writer.element('sdkver', str(apk['sdkversion']))
+        if 'maxsdkversion' in apk:
+            writer.element('maxsdkver', str(apk['maxsdkversion']))
+        if 'added' in apk:
+            writer.element('added', time.strftime('%Y-%m-%d', apk['added']))
+        if app['Requires Root']:
+            if 'ACCESS_SUPERUSER' not in apk['permissions']:
+                apk['permissions'].append('ACCESS_SUPERUSER')
 
+        if len(apk['permissions']) > 0:
+            writer.element('permissions', ','.join(apk['permissions']))
+        if 'nativecode' in apk and len(apk['nativecode']) > 0:
+            writer.element('nativecode', ','.join(apk['nativecode']))
+        if len(apk['features']) > 0:
+            writer.element('features', ','.join(apk['features']))
+        writer.end()
+
+    writer.end()
 
-def make_index(apps, apks, repodir, archive, categories):
-    """Make a repo index.
 
+def write_index(writer, apps, model, archive, repoattrs, repodesc, cache=None):
+    """Write the contents of a repo index.
+
+    :param writer: the IndexWriter to write to
     :param apps: fully populated apps list
-    :param apks: full populated apks list
-    :param repodir: the repo directory
+    :param model: the RepoModel of the repo and the archive
     :param archive: True if this is the archive repo, False if it's the
                     main one.
-    :param categories: list of categories
+    :param repoattrs: attributes of the repo element
+    :param repodesc: description of the repo
+    :param cache: IndexCache with the application elements of the previous
+                  runs, or None to write everything from scratch
     """
 
-    doc = Document()
+    writer.start("fdroid")
+
+    writer.start("repo", repoattrs)
+    writer.element('description', repodesc)
+    writer.end()
+
+    for app in apps:
+
+        if app['Disabled'] is not None:
+            continue
+
+        # Get a list of the apks for this app, in version order...
+        apklist = model.getapks(app['id'], archive)
+
+        if len(apklist) == 0:
+            continue
+
+        fragment = None
+        if cache is not None:
+            key = cache.key(app, apklist)
+            fragment = cache.get(app['id'], archive, key, model.linkres)
+
+        if fragment is None:
+            f = StringIO()
+            write_app(IndexWriter(f, options.pretty, depth=1), app, apklist,
+                      model)
+            fragment = f.getvalue()
+            if cache is not None and isinstance(fragment, str):
+                links = model.describe(app).links
+                cache.put(app['id'], archive, key, fragment, links)
+
+        writer.raw(fragment)
 
-    def addElement(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createTextNode(value))
-        parent.appendChild(el)
+    writer.end()
+    writer.close()
 
-    def addElementCDATA(name, value, doc, parent):
-        el = doc.createElement(name)
-        el.appendChild(doc.createCDATASection(value))
-        parent.appendChild(el)
 
-    root = doc.createElement("fdroid")
-    doc.appendChild(root)
+def make_index(apps, model, repodir, archive, categories, cache=None):
+    """Make a repo index.
 
-    repoel = doc.createElement("repo")
+    :param apps: fully populated apps list
+    :param model: the RepoModel of the repo and the archive
+    :param repodir: the repo directory
+    :param archive: True if this is the archive repo, False if it's the
+                    main one.
+    :param categories: list of categories
+    :param cache: IndexCache to reuse unchanged application elements from
+    """
 
+    repoattrs = {}
     if archive:
-        repoel.setAttribute("name", config['archive_name'])
+        repoattrs["name"] = config['archive_name']
         if config['repo_maxage'] != 0:
-            repoel.setAttribute("maxage", str(config['repo_maxage']))
-        repoel.setAttribute("icon", os.path.basename(config['archive_icon']))
-        repoel.setAttribute("url", config['archive_url'])
-        addElement('description', config['archive_description'], doc, repoel)
+            repoattrs["maxage"] = str(config['repo_maxage'])
+        repoattrs["icon"] = os.path.basename(config['archive_icon'])
+        repoattrs["url"] = config['archive_url']
+        repodesc = config['archive_description']
 
     else:
-        repoel.setAttribute("name", config['repo_name'])
+        repoattrs["name"] = config['repo_name']
         if config['repo_maxage'] != 0:
-            repoel.setAttribute("maxage", str(config['repo_maxage']))
-        repoel.setAttribute("icon", os.path.basename(config['repo_icon']))
-        repoel.setAttribute("url", config['repo_url'])
-        addElement('description', config['repo_description'], doc, repoel)
+            repoattrs["maxage"] = str(config['repo_maxage'])
+        repoattrs["icon"] = os.path.basename(config['repo_icon'])
+        repoattrs["url"] = config['repo_url']
+        repodesc = config['repo_description']
 
-    repoel.setAttribute("version", "12")
-    repoel.setAttribute("timestamp", str(int(time.time())))
+    repoattrs["version"] = "12"
+    repoattrs["timestamp"] = str(int(time.time()))
 
     if 'repo_keyalias' in config:
 
@@ -673,140 +1183,21 @@ def make_index(apps, apks, repodir, archive, categories):
             repo_pubkey_fingerprint = cert_fingerprint(p.output)
             return "".join("%02x" % ord(b) for b in p.output)
 
-        repoel.setAttribute("pubkey", extract_pubkey())
-
-    root.appendChild(repoel)
-
-    for app in apps:
-
-        if app['Disabled'] is not None:
-            continue
-
-        # Get a list of the apks for this app...
-        apklist = []
-        for apk in apks:
-            if apk['id'] == app['id']:
-                apklist.append(apk)
-
-        if len(apklist) == 0:
-            continue
-
-        apel = doc.createElement("application")
-        apel.setAttribute("id", app['id'])
-        root.appendChild(apel)
-
-        addElement('id', app['id'], doc, apel)
-        if 'added' in app:
-            addElement('added', time.strftime('%Y-%m-%d', app['added']), doc, apel)
-        if 'lastupdated' in app:
-            addElement('lastupdated', time.strftime('%Y-%m-%d', app['lastupdated']), doc, apel)
-        addElement('name', app['Name'], doc, apel)
-        addElement('summary', app['Summary'], doc, apel)
-        if app['icon']:
-            addElement('icon', app['icon'], doc, apel)
-
-        def linkres(link):
-            for app in apps:
-                if app['id'] == link:
-                    return ("fdroid.app:" + link, app['Name'])
-            raise MetaDataException("Cannot resolve app id " + link)
-        addElement('desc',
-                   metadata.description_html(app['Description'], linkres),
-                   doc, apel)
-        addElement('license', app['License'], doc, apel)
-        if 'Categories' in app:
-            addElement('categories', ','.join(app["Categories"]), doc, apel)
-            # We put the first (primary) category in LAST, which will have
-            # the desired effect of making clients that only understand one
-            # category see that one.
-            addElement('category', app["Categories"][0], doc, apel)
-        addElement('web', app['Web Site'], doc, apel)
-        addElement('source', app['Source Code'], doc, apel)
-        addElement('tracker', app['Issue Tracker'], doc, apel)
-        if app['Donate']:
-            addElement('donate', app['Donate'], doc, apel)
-        if app['Bitcoin']:
-            addElement('bitcoin', app['Bitcoin'], doc, apel)
-        if app['Litecoin']:
-            addElement('litecoin', app['Litecoin'], doc, apel)
-        if app['Dogecoin']:
-            addElement('dogecoin', app['Dogecoin'], doc, apel)
-        if app['FlattrID']:
-            addElement('flattr', app['FlattrID'], doc, apel)
-
-        # These elements actually refer to the current version (i.e. which
-        # one is recommended. They are historically mis-named, and need
-        # changing, but stay like this for now to support existing clients.
-        addElement('marketversion', app['Current Version'], doc, apel)
-        addElement('marketvercode', app['Current Version Code'], doc, apel)
-
-        if app['AntiFeatures']:
-            af = app['AntiFeatures'].split(',')
-            # TODO: Temporarily not including UpstreamNonFree in the index,
-            # because current F-Droid clients do not understand it, and also
-            # look ugly when they encounter an unknown antifeature. This
-            # filtering can be removed in time...
-            if 'UpstreamNonFree' in af:
-                af.remove('UpstreamNonFree')
-            if af:
-                addElement('antifeatures', ','.join(af), doc, apel)
-        if app['Provides']:
-            pv = app['Provides'].split(',')
-            addElement('provides', ','.join(pv), doc, apel)
-        if app['Requires Root']:
-            addElement('requirements', 'root', doc, apel)
+        repoattrs["pubkey"] = extract_pubkey()
 
-        # Sort the apk list into version order, just so the web site
-        # doesn't have to do any work by default...
-        apklist = sorted(apklist, key=lambda apk: apk['versioncode'], reverse=True)
-
-        # Check for duplicates - they will make the client unhappy...
-        for i in range(len(apklist) - 1):
-            if apklist[i]['versioncode'] == apklist[i + 1]['versioncode']:
-                logging.critical("duplicate versions: '%s' - '%s'" % (
-                    apklist[i]['apkname'], apklist[i + 1]['apkname']))
-                sys.exit(1)
-
-        for apk in apklist:
-            apkel = doc.createElement("package")
-            apel.appendChild(apkel)
-            addElement('version', apk['version'], doc, apkel)
-            addElement('versioncode', str(apk['versioncode']), doc, apkel)
-            addElement('apkname', apk['apkname'], doc, apkel)
-            if 'srcname' in apk:
-                addElement('srcname', apk['srcname'], doc, apkel)
-            for hash_type in ['sha256']:
-                if hash_type not in apk:
-                    continue
-                hashel = doc.createElement("hash")
-                hashel.setAttribute("type", hash_type)
-                hashel.appendChild(doc.createTextNode(apk[hash_type]))
-                apkel.appendChild(hashel)
-            addElement('sig', apk['sig'], doc, apkel)
-            addElement('size', str(apk['size']), doc, apkel)
-            addElement('sdkver', str(apk['sdkversion']), doc, apkel)
-            if 'maxsdkversion' in apk:
-                addElement('maxsdkver', str(apk['maxsdkversion']), doc, apkel)
-            if 'added' in apk:
-                addElement('added', time.strftime('%Y-%m-%d', apk['added']), doc, apkel)
-            if app['Requires Root']:
-                if 'ACCESS_SUPERUSER' not in apk['permissions']:
-                    apk['permissions'].append('ACCESS_SUPERUSER')
-
-            if len(apk['permissions']) > 0:
-                addElement('permissions', ','.join(apk['permissions']), doc, apkel)
-            if 'nativecode' in apk and len(apk['nativecode']) > 0:
-                addElement('nativecode', ','.join(apk['nativecode']), doc, apkel)
-            if len(apk['features']) > 0:
-                addElement('features', ','.join(apk['features']), doc, apkel)
-
-    of = open(os.path.join(repodir, 'index.xml'), 'wb')
-    if options.pretty:
-        output = doc.toprettyxml()
-    else:
-        output = doc.toxml()
-    of.write(output)
-    of.close()
+    # Write to a temporary file, so that a failure half way through doesn't
+    # leave a truncated index behind
+    indexfile = os.path.join(repodir, 'index.xml')
+    of = open(indexfile + '.new', 'wb')
+    try:
+        write_index(IndexWriter(of, options.pretty), apps, model, archive,
+                    repoattrs, repodesc, cache)
+        of.close()
+        os.rename(indexfile + '.new', indexfile)
+    finally:
+        if not of.closed:
+            of.close()
+            os.remove(indexfile + '.new')
 
     if 'repo_keyalias' in config:
 
@@ -848,18 +1239,12 @@ def make_index(apps, apks, repodir, archive, categories):
     f.close()
 
 
-def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversions):
+def archive_old_apks(apps, model, repodir, archivedir, defaultkeepversions):
 
     for app in apps:
 
-        # Get a list of the apks for this app...
-        apklist = []
-        for apk in apks:
-            if apk['id'] == app['id']:
-                apklist.append(apk)
-
-        # Sort the apk list into version order...
-        apklist = sorted(apklist, key=lambda apk: apk['versioncode'], reverse=True)
+        # Get a list of the apks for this app, in version order...
+        apklist = model.getapks(app['id'])
 
         if app['Archive Policy']:
             keepversions = int(app['Archive Policy'][:-9])
@@ -880,8 +1265,7 @@ def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversi
                     if os.path.exists(sigsrc):
                         shutil.move(sigsrc, os.path.join(archivedir, sigfile))
 
-                archapks.append(apk)
-                apks.remove(apk)
+                model.archive(apk)
 
 
 config = None
@@ -917,6 +1301,10 @@ def main():
                       help="Produce human-readable index.xml")
     parser.add_option("--clean", action="store_true", default=False,
                       help="Clean update - don't uses caches, reprocess all apks")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+                      help="Number of new apks to scan in parallel. Default is 1")
+    parser.add_option("--verify-cache", action="store_true", default=False,
+                      help="Check the sha256 of cached apks, not just their size and time")
     (options, args) = parser.parse_args()
 
     config = common.read_config(options)
@@ -951,31 +1339,26 @@ def main():
 
     # Gather information about all the apk files in the repo directory, using
     # cached data if possible.
-    apkcachefile = os.path.join('tmp', 'apkcache')
-    if not options.clean and os.path.exists(apkcachefile):
-        with open(apkcachefile, 'rb') as cf:
-            apkcache = pickle.load(cf)
+    apkcache = ApkCache()
+    if options.clean:
+        apkcache.clear()
+        # Otherwise the next run would import its stale entries
+        if os.path.exists(old_apkcache_path):
+            os.remove(old_apkcache_path)
     else:
-        apkcache = {}
-    cachechanged = False
+        import_old_apkcache(apkcache, repodirs)
 
     delete_disabled_builds(apps, apkcache, repodirs)
 
     # Scan all apks in the main repo
-    apks, cc = scan_apks(apps, apkcache, repodirs[0], knownapks)
-    if cc:
-        cachechanged = True
+    apks = scan_apks(apps, apkcache, repodirs[0], knownapks)
 
     # Generate warnings for apk's with no metadata (or create skeleton
     # metadata files, if requested on the command line)
     newmetadata = False
+    appids = set(app['id'] for app in apps)
     for apk in apks:
-        found = False
-        for app in apps:
-            if app['id'] == apk['id']:
-                found = True
-                break
-        if not found:
+        if apk['id'] not in appids:
             if options.create_metadata:
                 if 'name' not in apk:
                     logging.error(apk['id'] + ' does not have a name! Skipping...')
@@ -1010,12 +1393,12 @@ def main():
 
     # Scan the archive repo for apks as well
     if len(repodirs) > 1:
-        archapks, cc = scan_apks(apps, apkcache, repodirs[1], knownapks)
-        if cc:
-            cachechanged = True
+        archapks = scan_apks(apps, apkcache, repodirs[1], knownapks)
     else:
         archapks = []
 
+    model = RepoModel(apps, apks, archapks)
+
     # Some information from the apks needs to be applied up to the application
     # level. When doing this, we use the info from the most recent version's apk.
     # We deal with figuring out when the app was added and last updated at the
@@ -1024,17 +1407,16 @@ def main():
         bestver = 0
         added = None
         lastupdated = None
-        for apk in apks + archapks:
-            if apk['id'] == app['id']:
-                if apk['versioncode'] > bestver:
-                    bestver = apk['versioncode']
-                    bestapk = apk
-
-                if 'added' in apk:
-                    if not added or apk['added'] < added:
-                        added = apk['added']
-                    if not lastupdated or apk['added'] > lastupdated:
-                        lastupdated = apk['added']
+        for apk in model.getallapks(app['id']):
+            if apk['versioncode'] > bestver:
+                bestver = apk['versioncode']
+                bestapk = apk
+
+            if 'added' in apk:
+                if not added or apk['added'] < added:
+                    added = apk['added']
+                if not lastupdated or apk['added'] > lastupdated:
+                    lastupdated = apk['added']
 
         if added:
             app['added'] = added
@@ -1061,15 +1443,19 @@ def main():
     apps = sorted(apps, key=lambda app: app['Name'].upper())
 
     if len(repodirs) > 1:
-        archive_old_apks(apps, apks, archapks, repodirs[0], repodirs[1], config['archive_older'])
+        archive_old_apks(apps, model, repodirs[0], repodirs[1], config['archive_older'])
 
-    # Make the index for the main repo...
-    make_index(apps, apks, repodirs[0], False, categories)
+    # Make the index for the main repo, reusing what we can from last time...
+    indexcache = IndexCache()
+    if options.clean:
+        indexcache.clear()
+    make_index(apps, model, repodirs[0], False, categories, indexcache)
 
     # If there's an archive repo,  make the index for it. We already scanned it
     # earlier on.
     if len(repodirs) > 1:
-        make_index(apps, archapks, repodirs[1], True, categories)
+        make_index(apps, model, repodirs[1], True, categories, indexcache)
+    indexcache.close()
 
     if config['update_stats']:
 
@@ -1082,24 +1468,21 @@ def main():
             for line in file(os.path.join('stats', 'latestapps.txt')):
                 appid = line.rstrip()
                 data += appid + "\t"
-                for app in apps:
-                    if app['id'] == appid:
-                        data += app['Name'] + "\t"
-                        if app['icon'] is not None:
-                            data += app['icon'] + "\t"
-                        data += app['License'] + "\n"
-                        break
+                if appid in model.apps:
+                    app = model.apps[appid]
+                    data += app['Name'] + "\t"
+                    if app['icon'] is not None:
+                        data += app['icon'] + "\t"
+                    data += app['License'] + "\n"
             f = open(os.path.join(repodirs[0], 'latestapps.dat'), 'w')
             f.write(data)
             f.close()
 
-    if cachechanged:
-        with open(apkcachefile, 'wb') as cf:
-            pickle.dump(apkcache, cf)
+    apkcache.close()
 
     # Update the wiki...
     if options.wiki:
-        update_wiki(apps, apks + archapks)
+        update_wiki(apps, model)
 
     logging.info("Finished.")
 